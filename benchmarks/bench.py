@@ -0,0 +1,383 @@
+"""
+Benchmarks for pairing, scoring, reading history and the whole `main` flow,
+over a grid of roster sizes and history depths, with generated data.  The
+Google Spreadsheet and the mail server are replaced by local stand-ins, so
+nothing goes over the network.
+
+    poetry run python benchmarks/bench.py --output bench_output.json
+
+Results are written as JSON, to compare between versions.
+"""
+
+# Dependencies
+import json
+import platform
+import random
+import socketserver
+import smtplib
+import sys
+import tempfile
+import threading
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from datetime import datetime, timedelta
+from os import environ, path
+from time import perf_counter
+from unittest import mock
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from synapse import cli  # noqa: E402
+from synapse.history import HistoryIndex  # noqa: E402
+
+
+# Grid of roster sizes and history depths (in rounds)
+ROSTER_SIZES = [10, 100, 1000, 10000]
+HISTORY_DEPTHS = [1, 10, 100, 500]
+
+# Random pairings sampled per pairing; much less than the CLI default, so
+# the large rosters finish in a reasonable time
+SAMPLE_COUNT = 200
+
+# Matchers to time, and the largest roster each is timed for
+MATCHER_LIMITS = {"random": 10000, "anneal": 10000, "optimal": 1000}
+
+EMAIL_DOMAIN = "example.com"
+
+
+def main():
+    parser = ArgumentParser(
+        description="Benchmark pairing, scoring and sending with local stand-ins.",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=ROSTER_SIZES,
+        help="Roster sizes to benchmark.",
+    )
+    parser.add_argument(
+        "--depths",
+        type=int,
+        nargs="+",
+        default=HISTORY_DEPTHS,
+        help="History depths, in rounds, to benchmark.",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=SAMPLE_COUNT,
+        help="Random pairings sampled per pairing.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Times to run each benchmark; the fastest time is kept.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="File to write results to, as JSON; prints them if not provided.",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.depths, args.samples, args.repeat)
+    output = json.dumps(
+        {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "samples": args.samples,
+            "repeat": args.repeat,
+            "results": results,
+        },
+        indent=2,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def run_benchmarks(sizes, depths, samples, repeat):
+    """
+    Run every benchmark for every roster size and history depth.
+
+    :returns: List of results, each a dict with the benchmark name, roster
+        size, history depth and the fastest time in seconds.
+    """
+    environ["SYNAPSE_VALID_EMAIL_REGEX"] = f"@{EMAIL_DOMAIN}$"
+    environ["SYNAPSE_GMAIL_USERNAME"] = f"synapse@{EMAIL_DOMAIN}"
+
+    with SMTPSink() as sink:
+        return run_grid(sizes, depths, samples, repeat, sink)
+
+
+def run_grid(sizes, depths, samples, repeat, sink):
+    results = []
+    for size in sizes:
+        emails = generate_emails(size)
+
+        # Does not depend on history
+        results.append(
+            measure(
+                "filter_emails",
+                size,
+                0,
+                repeat,
+                lambda: cli.filter_emails(emails + ["Email", "other@elsewhere.org"]),
+            )
+        )
+
+        for depth in depths:
+            rows = generate_history_rows(emails, depth)
+            history = cli.transform_history_rows(rows)
+            index = HistoryIndex(history)
+            pairs = cli.pair_emails(emails, history=index, sample_count=1, seed=0)[1]
+
+            def add(name, function):
+                results.append(measure(name, size, depth, repeat, function))
+                eprint(
+                    f"{name:>32} {size:>6} emails {depth:>4} rounds {results[-1]['seconds']:.4f}s"
+                )
+
+            add(
+                "read_history",
+                lambda: HistoryIndex(cli.transform_history_rows(rows)),
+            )
+            add(
+                "calculate_history_score",
+                lambda: cli.calculate_history_score(pairs, index),
+            )
+            add(
+                "calculate_history_score (list)",
+                lambda: cli.calculate_history_score(pairs, history),
+            )
+            add(
+                "has_pair_in_pairs",
+                lambda: [
+                    cli.has_pair_in_pairs(pair, round["pairs"])
+                    for pair in pairs[:10]
+                    for round in history
+                ],
+            )
+
+            for matcher, limit in MATCHER_LIMITS.items():
+                if size <= limit:
+                    add(
+                        f"pair_emails ({matcher})",
+                        lambda: cli.pair_emails(
+                            emails,
+                            history=index,
+                            sample_count=samples,
+                            matcher=matcher,
+                            seed=0,
+                        ),
+                    )
+
+            add("main", lambda: run_main(emails, rows, samples, sink))
+
+    return results
+
+
+def measure(name, size, depth, repeat, function):
+    """Time a function, keeping the fastest of `repeat` runs."""
+    times = []
+    for _ in range(max(repeat, 1)):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+
+    return {
+        "name": name,
+        "roster_size": size,
+        "history_rounds": depth,
+        "seconds": min(times),
+    }
+
+
+def generate_emails(size, seed=0):
+    """Generate a roster of unique emails."""
+    rng = random.Random(seed)
+    names = [f"person{i}.{rng.randrange(10**6):06d}" for i in range(size)]
+
+    return [f"{name}@{EMAIL_DOMAIN}" for name in names]
+
+
+def generate_history_rows(emails, depth, seed=0):
+    """
+    Generate history rows as they are in the history sheet, one round a
+    week going back from today.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for week in range(depth, 0, -1):
+        shuffled = emails.copy()
+        rng.shuffle(shuffled)
+        pairs = [shuffled[i : i + 2] for i in range(0, len(shuffled) - 1, 2)]
+        if len(shuffled) % 2:
+            pairs[-1].append(shuffled[-1])
+
+        date = datetime.now() - timedelta(weeks=week)
+        rows.append((date.isoformat(), json.dumps(pairs)))
+
+    return rows
+
+
+def run_main(emails, rows, samples, sink):
+    """
+    Run the whole `main` flow, reading a fake spreadsheet and sending to a
+    local SMTP sink.
+    """
+    sent = sink.count()
+    spreadsheet = FakeSpreadsheet(
+        {
+            "Emails": [["Email"]] + [[email] for email in emails],
+            cli.HISTORY_SHEET_NAME: [cli.HISTORY_HEADERS] + [list(r) for r in rows],
+        }
+    )
+
+    with tempfile.TemporaryDirectory() as cache, mock.patch.multiple(
+        cli,
+        global_gpread_client=spreadsheet,
+        global_spreadsheet_sessions={},
+        global_sheets_scheduler=None,
+        global_mail_handler=None,
+        EMAIL_MATCH_PERMUTATIONS=samples,
+        connect_mail_server=lambda: smtplib.SMTP(*sink.address),
+    ), mock.patch.object(
+        sys,
+        "argv",
+        [
+            "synapse",
+            "--send",
+            "--quiet",
+            "--spreadsheet",
+            "benchmark",
+            "--cache-dir",
+            cache,
+            "--emails-per-minute",
+            "1000000000",
+            "--email-burst",
+            "1000000000",
+            "--sheets-calls-per-minute",
+            "1000000000",
+        ],
+    ):
+        cli.main()
+
+        if sink.count() - sent != len(emails) // 2:
+            raise Exception(
+                f"Expected {len(emails) // 2} emails, the SMTP sink got {sink.count() - sent}."
+            )
+
+
+class FakeSpreadsheet:
+    """
+    Stand-in for a gspread client and spreadsheet, with the parts of the
+    API that are used, kept in memory.
+    """
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def open_by_key(self, key):
+        return self
+
+    def fetch_sheet_metadata(self, params=None):
+        return {
+            "sheets": [
+                {"properties": {"sheetId": i, "title": title, "index": i}}
+                for i, title in enumerate(self.sheets)
+            ]
+        }
+
+    def values_batch_get(self, ranges):
+        value_ranges = []
+        for range_name in ranges:
+            title, cells = range_name.rsplit("!", 1)
+            rows = self.sheets[title[1:-1].replace("''", "'")]
+            start = int(cells.split(":")[0][1:] or 1)
+            width = 1 if cells.endswith(":A") else 2
+            value_ranges.append({"values": [row[:width] for row in rows[start - 1 :]]})
+
+        return {"valueRanges": value_ranges}
+
+    def batch_update(self, body):
+        for request in body["requests"]:
+            titles = list(self.sheets)
+            if "addSheet" in request:
+                self.sheets[request["addSheet"]["properties"]["title"]] = []
+            elif "appendCells" in request:
+                sheet = self.sheets[titles[request["appendCells"]["sheetId"]]]
+                for row in request["appendCells"]["rows"]:
+                    sheet.append(
+                        [v["userEnteredValue"]["stringValue"] for v in row["values"]]
+                    )
+
+
+class SMTPSink:
+    """
+    Local SMTP server that accepts every message and throws it away, counting
+    messages.  Only plain SMTP is spoken; no TLS or login.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode("ascii") + b"\r\n")
+
+            def handle(self):
+                self.reply("220 sink ready")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+
+                    command = line[:4].upper()
+                    if command == b"DATA":
+                        self.reply("354 go ahead")
+                        while self.rfile.readline() not in (b".\r\n", b""):
+                            pass
+                        with sink.lock:
+                            sink.messages += 1
+                        self.reply("250 ok")
+                    elif command == b"QUIT":
+                        self.reply("221 bye")
+                        return
+                    else:
+                        self.reply("250 ok")
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self):
+        with self.lock:
+            return self.messages
+
+
+def eprint(*args, **kwargs):
+    """Print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+# Dependencies
+import csv
+import json
+from os import makedirs, path, replace
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+# Schemes of roster URIs
+BACKEND_SCHEMES = ["gsheet", "file"]
+
+# Sheet of a Google Spreadsheet where history is kept, and its header
+HISTORY_SHEET_NAME = "Sent history (DO NOT EDIT)"
+HISTORY_HEADERS = ["Date", "Email pairs"]
+
+
+def parse_backend_uri(uri):
+    """
+    Parse a roster URI, like `gsheet://ID/0` for a sheet of a Google
+    Spreadsheet or `file:///path/roster.csv` for a local file; a plain path
+    is a local file too.
+
+    :returns: Tuple of `(scheme, location, options)`; location is
+        `(spreadsheet, sheet)` for gsheet and the file path for file, and
+        options is a dict of query values.
+    """
+    parsed = urlparse(uri)
+    options = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+
+    if parsed.scheme == "gsheet":
+        sheet = parsed.path.strip("/") or "0"
+        return ("gsheet", (parsed.netloc, sheet), options)
+    elif parsed.scheme == "file":
+        return ("file", unquote(parsed.netloc + parsed.path), options)
+    elif parsed.scheme == "" or len(parsed.scheme) == 1:
+        # A path, or a Windows path with a drive letter
+        return ("file", uri, {})
+
+    raise Exception(
+        f"Unknown roster '{uri}'; use a URI starting with one of {BACKEND_SCHEMES}."
+    )
+
+
+def get_backend(uri, open_session=None):
+    """
+    Get the backend of a roster, which all have the same methods to read
+    emails and history, add history, and give the URL where people can
+    manage their emails: `FileBackend` and `SheetBackend`.
+
+    :param uri: URI of the roster, see `parse_backend_uri`.
+    :param open_session: For Google Spreadsheets, function returning the
+        `synapse.sheets.SpreadsheetSession` of a spreadsheet ID.
+    """
+    scheme, location, options = parse_backend_uri(uri)
+
+    if scheme == "gsheet":
+        spreadsheet, sheet = location
+        return SheetBackend(spreadsheet, sheet, open_session)
+
+    return FileBackend(location, history=options.get("history"), url=options.get("url"))
+
+
+class FileBackend:
+    """
+    Roster and history in local files: emails are the first column of a CSV
+    file (or a file with one email per line), and history is a JSON Lines
+    file with one `{"date": ..., "pairs": ...}` object per round, after an
+    optional `{"snapshot": ...}` object of compacted rounds.
+
+    Both are read line by line, so large rosters are never loaded whole.
+    """
+
+    def __init__(self, roster, history=None, url=None):
+        """
+        :param roster: Path to the roster file.
+        :param history: Path to the history file, defaults to the roster path
+            with `-history.jsonl` in place of its extension.
+        :param url: Where people can manage their emails, for the emails; a
+            local file can not be linked to, so there is none by default.
+        """
+        self.roster = roster
+        self.history = history or f"{path.splitext(roster)[0]}-history.jsonl"
+        self.manage_url = url
+
+    def url(self):
+        """URL where people can manage their emails, or None."""
+        return self.manage_url
+
+    def history_key(self):
+        """Rosters with the same key share history."""
+        return ("file", path.abspath(self.history))
+
+    def read_emails(self):
+        """Yield the first cell of each row of the roster."""
+        with open(self.roster, "r", newline="") as f:
+            for row in csv.reader(f):
+                if row:
+                    yield row[0].strip()
+
+    def read_column(self, column):
+        """
+        Yield the first cell and another cell of each row of the roster, as
+        `(first, other)` tuples, with other empty if the row is shorter.
+
+        :param column: Position of the other cell, from 0.
+        """
+        with open(self.roster, "r", newline="") as f:
+            for row in csv.reader(f):
+                if row:
+                    yield (row[0], row[column] if column < len(row) else "")
+
+    def read_history(self):
+        """
+        Yield history rows as `(date, pairs)` tuples, or nothing if there is
+        no history file yet.  Lines that are not valid JSON are skipped.
+        """
+        if not path.exists(self.history):
+            return
+
+        with open(self.history, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+
+                if "date" in record:
+                    yield (record["date"], record["pairs"])
+
+    def read_snapshot(self):
+        """Snapshot saved by `compact`, or None."""
+        if not path.exists(self.history):
+            return None
+
+        with open(self.history, "r") as f:
+            try:
+                record = json.loads(f.readline())
+            except json.decoder.JSONDecodeError:
+                return None
+
+        return record.get("snapshot")
+
+    def has_history(self):
+        return path.exists(self.history)
+
+    def compact(self, snapshot, rows):
+        """
+        Rewrite the history file as a snapshot followed by the rows that are
+        kept; the file is replaced at once, so a crash leaves either the old
+        or the new file.
+
+        :param snapshot: Snapshot of compacted rounds, anything that can be
+            dumped as JSON.
+        :param rows: List of `(date, pairs)` tuples to keep.
+        """
+        temporary = f"{self.history}.tmp"
+        with open(temporary, "w") as f:
+            f.write(json.dumps({"snapshot": snapshot}) + "\n")
+            for date, pairs in rows:
+                f.write(json.dumps({"date": date, "pairs": pairs}) + "\n")
+
+        replace(temporary, self.history)
+
+    def append_history(self, rows):
+        """
+        Append history rows.
+
+        :param rows: List of `(date, pairs)` tuples, with pairs as a list.
+        """
+        directory = path.dirname(self.history)
+        if directory:
+            makedirs(directory, exist_ok=True)
+
+        with open(self.history, "a") as f:
+            for date, pairs in rows:
+                f.write(json.dumps({"date": date, "pairs": pairs}) + "\n")
+
+
+class SheetBackend:
+    """
+    Roster and history in a Google Spreadsheet: emails are the first column of
+    a sheet, and history is the HISTORY_SHEET_NAME sheet, with one `[date,
+    pairs]` row per batch of a round, with pairs as JSON, after a header.
+
+    Requests go through a `synapse.sheets.SpreadsheetSession`, opened when
+    first needed.
+    """
+
+    def __init__(self, spreadsheet, sheet="0", open_session=None):
+        """
+        :param spreadsheet: ID of the spreadsheet.
+        :param sheet: ID of the sheet with emails.
+        :param open_session: Function returning the `SpreadsheetSession` of a
+            spreadsheet ID.
+        """
+        self.spreadsheet = spreadsheet
+        self.sheet = sheet
+        self.open_session = open_session
+
+    @property
+    def session(self):
+        return self.open_session(self.spreadsheet)
+
+    def url(self):
+        """URL where people can manage their emails."""
+        return f"https://docs.google.com/spreadsheets/d/{self.spreadsheet}/edit#gid={self.sheet}"
+
+    def history_key(self):
+        """Rosters with the same key share history."""
+        return ("gsheet", self.spreadsheet)
+
+    def read_emails(self):
+        """Yield the first cell of each row of the sheet."""
+        for row in self.read_range("A:A"):
+            if row:
+                yield row[0]
+
+    def read_column(self, column):
+        """
+        Yield the first cell and another cell of each row of the sheet, as
+        `(first, other)` tuples, with other empty if the row is shorter.
+
+        :param column: Position of the other cell, from 0.
+        """
+        for row in self.read_range(f"A:{column_letters(column)}"):
+            if row:
+                yield (row[0], row[column] if column < len(row) else "")
+
+    def read_range(self, range_name):
+        title = self.session.sheet_by_index(int(self.sheet))["title"]
+        return self.session.batch_get([(title, range_name)])[0]
+
+    def has_history(self):
+        return self.session.sheet_by_title(HISTORY_SHEET_NAME) is not None
+
+    def read_history(self):
+        """
+        Yield history rows as `(date, pairs)` tuples, with pairs as JSON, or
+        nothing if there is no history sheet yet.
+        """
+        if not self.has_history():
+            return
+
+        values = self.session.batch_get([(HISTORY_SHEET_NAME, "A:B")])[0]
+        for date, pairs in normalize_history_rows(values)[1:]:
+            yield (date, pairs)
+
+    def append_history(self, rows):
+        """
+        Append history rows, in one request; the history sheet is made, with
+        a header, if not found.  If the request fails in a way that it may
+        have been made anyway, the history is read again and it is only
+        retried if the rows are not there.
+
+        :param rows: List of `(date, pairs)` tuples, with pairs as a list.
+        """
+        from synapse.sheets import (
+            append_cells_request,
+            format_row_request,
+            sheets_error_status,
+        )
+
+        session = self.session
+        requests = []
+        values = [[date, json.dumps(pairs)] for date, pairs in rows]
+
+        # Get history sheet, make one if not found
+        history_sheet = session.sheet_by_title(HISTORY_SHEET_NAME)
+        if history_sheet is not None:
+            sheet_id = history_sheet.get("sheetId", 0)
+        else:
+            sheet_id, request = session.add_sheet_request(
+                HISTORY_SHEET_NAME, rows=1000, columns=3, frozen_rows=1
+            )
+            requests.append(request)
+
+            # Add headers
+            values.insert(0, HISTORY_HEADERS)
+
+            # Some niceties: Format first row
+            requests.append(
+                format_row_request(
+                    sheet_id,
+                    0,
+                    3,
+                    {
+                        "backgroundColor": {"red": 50, "green": 50, "blue": 50},
+                        "textFormat": {"bold": True},
+                    },
+                )
+            )
+
+        # Add new history
+        requests.append(append_cells_request(sheet_id, values))
+        appended = [[date, json.dumps(pairs)] for date, pairs in rows]
+
+        def applied():
+            try:
+                history = session.batch_get([(HISTORY_SHEET_NAME, "A:B")])[0]
+            except Exception as error:
+                # No history sheet, as the one being made was not
+                if history_sheet is None and sheets_error_status(error) == 400:
+                    return False
+                raise
+
+            return (
+                normalize_history_rows(history)[len(history) - len(appended) :]
+                == appended
+            )
+
+        session.batch_update(requests, applied=applied)
+
+
+def normalize_history_rows(values):
+    """Make sure every row from the history sheet has a date and pairs cell."""
+    return [(list(row) + ["", ""])[:2] for row in values]
+
+
+def column_letters(index):
+    """Letters of a column from its position, like A for 0 and AB for 27."""
+    letters = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+
+    return letters
@@ -2,30 +2,125 @@
 import json
 import random
 import re
-import smtplib
 import sys
+import threading
+from base64 import b64encode
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 from datetime import datetime
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from os import getenv, path
-from random import shuffle
-from time import sleep
+from itertools import combinations
+from os import cpu_count, getenv, path
+from time import perf_counter
 from urllib.parse import urlencode
 
-import gspread
-from dotenv import load_dotenv
-
-# Load env variables from .env file
-load_dotenv()
+from synapse.backends import (
+    HISTORY_HEADERS,
+    HISTORY_SHEET_NAME,
+    FileBackend,
+    SheetBackend,
+    get_backend,
+    normalize_history_rows,
+)
+from synapse.delivery import Mailer
+from synapse.exclusions import (
+    ExclusionIndex,
+    column_index,
+    exclusions_from_rows,
+    read_exclusion_file,
+)
+from synapse.history import (
+    HistoryIndex,
+    HistoryRound,
+    HistorySnapshot,
+    build_history_index,
+)
+from synapse.journal import SendJournal
+from synapse.outbox import Outbox
+from synapse.pairings import PairingCache
+from synapse.metrics import get_metrics, timed
+from synapse.sheets import SheetsScheduler, SpreadsheetSession
+from synapse.matching import (
+    ALTERNATIVES_MAXIMUM,
+    EMAIL_MATCHERS,
+    EMAIL_MATCH_PERMUTATIONS,
+    GROUP_SIZE,
+    LOCAL_SEARCH_ITERATIONS,
+    SCORING_BACKENDS,
+    get_vectorized_backend,
+    pair_emails,
+    pair_emails_alternatives,
+)
+
+# Modules that are slow to import and only needed by some code paths, so
+# are imported where they are used; checked by the tests to keep startup fast
+LAZY_IMPORTS = [
+    "concurrent.futures",
+    "dotenv",
+    "email.mime.multipart",
+    "hashlib",
+    "gspread",
+    "multiprocessing",
+    "numpy",
+    "smtplib",
+    "sqlite3",
+]
 
 
 # History baseline for comparing pairs in number of days.  If a pair was
 # not paired before this time, then it is assumed to be new.
 HISTORY_SCORE_MAXIMUM = 300
-HISTORY_SHEET_NAME = "Sent history (DO NOT EDIT)"
-TIME_TO_WAIT_BETWEEN_EMAILS = 15
-EMAIL_MATCH_PERMUTATIONS = 20000
+
+# Score of rounds older than HISTORY_SCORE_MAXIMUM days; as it no longer
+# changes, those rounds are compacted into a snapshot
+HISTORY_EXPIRED_SCORE = 1
+HISTORY_CACHE_DIRECTORY = path.join(path.expanduser("~"), ".cache", "synapse")
+PAIRING_CACHE_HOURS = 24
+# One email every 15 seconds, as emails have always been sent; raise it to
+# what your mail provider allows
+EMAILS_PER_MINUTE = 4
+EMAIL_BURST = 1
+MAIL_CONNECTIONS = 2
+MAIL_RETRIES = 3
+SHEETS_CALLS_PER_MINUTE = 60
+SHEETS_BURST = 10
+SHEETS_RETRIES = 5
+SHEETS_CACHE_SECONDS = 30
+
+# Pairs saved to history at a time while sending a round
+HISTORY_FLUSH_SIZE = 25
+
+# Rows of the local copy of history checked against the sheet each run, at
+# random, to notice edits without reading the whole sheet
+HISTORY_CHECK_ROWS = 8
+
+# Messages written to the outbox at once
+OUTBOX_WRITERS = 8
+
+# Defaults for simulating future rounds; the anneal matcher keeps a year of
+# rounds of a large roster to seconds, where random sampling takes minutes
+SIMULATION_ROUNDS = 52
+SIMULATION_INTERVAL_DAYS = 7
+SIMULATION_MATCHER = "anneal"
+
+# Rosters read and paired at once in batch mode, and what each can set
+BATCH_CONCURRENCY = 8
+BATCH_ROSTER_OPTIONS = [
+    "roster",
+    "spreadsheet",
+    "sheet",
+    "matcher",
+    "backend",
+    "seed",
+    "group_size",
+    "exclusions",
+    "exclusions_column",
+    "time_budget",
+    "target_score",
+]
+
+# Templates have slots like [[[NAMES]]]
+TEMPLATE_SLOT_PATTERN = re.compile(r"\[\[\[([A-Z_]+)\]\]\]")
+MESSAGE_TEMPLATE = "message"
+PROGRESS_INTERVAL_SECONDS = 1
 
 
 # Potential subjects to use
@@ -40,9 +135,15 @@ POTENTIAL_SUBJECTS = [
 
 # Values to define as needed
 global_gpread_client = None
+global_gpread_client_lock = threading.Lock()
+global_spreadsheet_sessions = {}
+global_spreadsheet_sessions_lock = threading.Lock()
 global_google_auth_token = None
 global_mail_handler = None
+global_sheets_scheduler = None
 global_quiet_output = False
+global_progress_printed = None
+global_templates = {}
 
 
 def main():
@@ -74,6 +175,123 @@ def main():
         type=str,
         help="Google Spreadsheet Sheet ID; will also use SYNAPSE_SHEET if not provided.  Will use 0 if not provided in either place.",
     )
+    parser.add_argument(
+        "--roster",
+        type=str,
+        help="Where to read emails and keep history, as a URI like gsheet://ID/0 for a Google Spreadsheet sheet, or file:///path/roster.csv for a local CSV file with history kept next to it in roster-history.jsonl; will also use SYNAPSE_ROSTER if not provided.  Will use the spreadsheet and sheet if not provided in either place.",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        help="JSON file listing many rosters to read, match and send emails for in one run, instead of one roster from --roster, --spreadsheet and --sheet; see the README for its format.",
+    )
+    parser.add_argument(
+        "--matcher",
+        type=str,
+        choices=EMAIL_MATCHERS,
+        help="How to find pairs: best of many random samples, an exact minimum repetition matching, or a local search that improves a random pairing with swaps; will also use SYNAPSE_MATCHER if not provided.  Will use random if not provided in either place.",
+    )
+    parser.add_argument(
+        "--group-size",
+        type=int,
+        help=f"Number of people to put in each group; a leftover person joins a group, so some groups have one more.  Groups of more than two are scored as the sum of their pairs, and need the random or anneal matcher.  Will also use SYNAPSE_GROUP_SIZE if not provided.  Will use {GROUP_SIZE} if not provided in either place.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for random pairing, so that results can be reproduced.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes to split random samples across.  Will use 1 if not provided, or the number of CPUs with --config.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=SCORING_BACKENDS,
+        help="How random pairings are generated and scored; numpy scores them in large batches and needs NumPy installed.  Will also use SYNAPSE_BACKEND if not provided.  Will use python if not provided in either place.",
+    )
+    parser.add_argument(
+        "--emails-per-minute",
+        type=float,
+        help=f"Maximum number of emails to send per minute; will also use SYNAPSE_EMAILS_PER_MINUTE if not provided.  Will use {EMAILS_PER_MINUTE} if not provided in either place.",
+    )
+    parser.add_argument(
+        "--email-burst",
+        type=int,
+        help=f"Number of emails that can be sent back to back before the rate limit applies; will also use SYNAPSE_EMAIL_BURST if not provided.  Will use {EMAIL_BURST} if not provided in either place.",
+    )
+    parser.add_argument(
+        "--mail-connections",
+        type=int,
+        help=f"Number of SMTP connections to send emails over at once; will also use SYNAPSE_MAIL_CONNECTIONS if not provided.  Will use {MAIL_CONNECTIONS} if not provided in either place.",
+    )
+    parser.add_argument(
+        "--sheets-calls-per-minute",
+        type=float,
+        help=f"Quota of Google Sheets API requests per minute; requests wait their turn so the quota is not exceeded, and are retried if refused anyway.  Will also use SYNAPSE_SHEETS_CALLS_PER_MINUTE if not provided.  Will use {SHEETS_CALLS_PER_MINUTE} if not provided in either place.",
+    )
+    parser.add_argument(
+        "--outbox",
+        type=str,
+        help="Write the rendered emails to this Maildir directory and exit, instead of sending them; send them later with the deliver subcommand.  Will also use SYNAPSE_OUTBOX if not provided.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Read the whole history sheet instead of keeping a local copy and only fetching new rows.",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        help="Seconds to search for a better pairing, instead of a fixed number of samples or swaps; the best pairing found is used when they are up.  Will also use SYNAPSE_TIME_BUDGET if not provided.",
+    )
+    parser.add_argument(
+        "--target-score",
+        type=int,
+        help="Stop searching once a pairing scores this or less; searching always stops at 0.  Will also use SYNAPSE_TARGET_SCORE if not provided.",
+    )
+    parser.add_argument(
+        "--alternatives",
+        type=int,
+        help=f"Keep this many of the best distinct pairings found by the random matcher, and choose between them when asked to confirm; up to {ALTERNATIVES_MAXIMUM}.",
+    )
+    parser.add_argument(
+        "--exclusions",
+        type=str,
+        help="CSV file of people who must never be grouped together, like a manager and their reports, one set of people per row; will also use SYNAPSE_EXCLUSIONS if not provided.",
+    )
+    parser.add_argument(
+        "--exclusions-column",
+        type=str,
+        help="Column of the roster, like B, listing the people each email must never be grouped with; will also use SYNAPSE_EXCLUSIONS_COLUMN if not provided.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help=f"Where to keep the local copy of history; will also use SYNAPSE_CACHE_DIR if not provided.  Will use {HISTORY_CACHE_DIRECTORY} if not provided in either place.",
+    )
+    parser.add_argument(
+        "--no-pairing-cache",
+        action="store_true",
+        help="Pair again instead of using the pairing of an earlier run with the same emails, history and options, like a --no-send preview.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Finish sending a round that was interrupted, without pairing again.",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print how long each stage took, and counts like samples evaluated and API calls made, at the end.",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        help="File to write timings and counts to, as JSON, at the end.",
+    )
     parser.add_argument(
         "--quiet",
         action="store_true",
@@ -85,141 +303,1126 @@ def main():
         help="More output, specifically show individual email pairings.",
     )
 
+    # Subcommands, with the options above before them
+    subparsers = parser.add_subparsers(dest="command")
+    simulate_parser = subparsers.add_parser(
+        "simulate",
+        description="Pair a roster for many future rounds in memory, each round added to history, and report how often people are paired again.  Nothing is sent or saved.  Rounds use the anneal matcher unless --matcher or SYNAPSE_MATCHER says otherwise: 52 rounds of 1000 people take about a second with it, and about 9 minutes with the random matcher's 20000 samples per round.",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    simulate_parser.add_argument(
+        "--rounds",
+        type=int,
+        default=SIMULATION_ROUNDS,
+        help="Number of rounds to simulate.",
+    )
+    simulate_parser.add_argument(
+        "--interval",
+        type=int,
+        default=SIMULATION_INTERVAL_DAYS,
+        help="Days between rounds.",
+    )
+    simulate_parser.add_argument(
+        "--samples",
+        type=int,
+        help=f"Swaps tried per round with the anneal matcher, or random pairings sampled with the random matcher; {LOCAL_SEARCH_ITERATIONS} swaps or {EMAIL_MATCH_PERMUTATIONS} samples if not provided.",
+    )
+    simulate_parser.add_argument(
+        "--window",
+        type=int,
+        default=HISTORY_SCORE_MAXIMUM,
+        help="Days after which a pair no longer counts as recent, to try another decay window; existing history is scored again for it.",
+    )
+    simulate_parser.add_argument(
+        "--people",
+        type=int,
+        help="Simulate a made up roster of this many people with no history, instead of reading the roster.",
+    )
+
+    subparsers.add_parser(
+        "deliver",
+        description="Send the emails in the --outbox directory within the rate limit, saving each pair to history once sent.  Can be stopped and started again at any point.",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+
     # Parse arguments
     args = parser.parse_args()
 
+    # Load env variables from .env file
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
     # Define output
     global global_quiet_output
     global_quiet_output = args.quiet
 
+    # Sheets API quota, shared by every spreadsheet of the run
+    get_sheets_scheduler(rate_per_minute=args.sheets_calls_per_minute)
+
+    # Run, and report on it even if something goes wrong
+    try:
+        if args.command == "simulate":
+            run_simulation(args)
+        elif args.command == "deliver":
+            run_delivery(args)
+        elif args.config:
+            run_batch(args)
+        else:
+            run(args)
+    finally:
+        report_metrics(timings=args.timings, metrics_json=args.metrics_json)
+
+
+def run(args):
+    """
+    Read, match and send emails, with arguments from `main`.
+
+    :param args: Parsed CLI arguments.
+    """
+
     # Use env variables if not provided
     spreadsheet = args.spreadsheet or getenv("SYNAPSE_SPREADSHEET")
     sheet = args.sheet or getenv("SYNAPSE_SHEET", "0")
+    roster = get_roster(args)
+    matcher = args.matcher or getenv("SYNAPSE_MATCHER", "random")
+    backend = args.backend or getenv("SYNAPSE_BACKEND", "python")
+    group_size = args.group_size or int(getenv("SYNAPSE_GROUP_SIZE", GROUP_SIZE))
+    exclusions_file = args.exclusions or getenv("SYNAPSE_EXCLUSIONS")
+    exclusions_column = args.exclusions_column or getenv("SYNAPSE_EXCLUSIONS_COLUMN")
+    time_budget, target_score = get_search_budget(args)
+    outbox = get_outbox(args)
+
+    # A round that was interrupted must be finished first
+    journal = get_send_journal(roster, args.cache_dir)
+    if outbox is not None:
+        check_outbox(outbox, args, [roster])
+
+    if args.resume:
+        if journal.is_finished():
+            eprint("  ✅ Nothing to resume, the last round was finished.")
+            return
+
+        pairs = journal.pairs
+        eprint(
+            f"  📧 Resuming round of {journal.date}, with {len(journal.pending())} of {len(pairs)} emails left to send."
+        )
+    elif not journal.is_finished():
+        raise Exception(
+            f"The round of {journal.date} was interrupted with {len(journal.pending())} of {len(journal.pairs)} emails left to send; use --resume to finish it, or remove {journal.filename} to start over."
+        )
+    else:
+        # Get list of emails and history from roster
+        eprint("  💾 Loading emails...")
+        emails, history = read_roster(
+            roster,
+            use_cache=not args.no_cache,
+            cache_directory=args.cache_dir,
+        )
+        exclusions = read_exclusions(
+            roster, column=exclusions_column, filename=exclusions_file
+        )
+
+        # Make pairs, or use the pairing of an earlier run like a preview,
+        # showing the best score as it improves when searching for a while
+        eprint(
+            f"  💾 Pairing emails for up to {time_budget:g} seconds..."
+            if time_budget is not None
+            else "  💾 Pairing emails..."
+        )
+        progress = print_progress if time_budget is not None else None
+        if progress is not None:
+            get_metrics().subscribe("best score", progress)
+        try:
+            pairings = pair_emails_alternatives_cached(
+                emails,
+                history=history,
+                use_cache=not args.no_pairing_cache,
+                cache_directory=args.cache_dir,
+                matcher=matcher,
+                seed=args.seed,
+                workers=args.workers,
+                backend=backend,
+                group_size=group_size,
+                exclusions=exclusions,
+                time_budget=time_budget,
+                target_score=target_score,
+                alternatives=args.alternatives or 1,
+            )
+        finally:
+            if progress is not None:
+                get_metrics().unsubscribe("best score", progress)
+
+        # The best pairing, unless asked to choose between alternatives
+        score, pairs = pairings[0]
+
+        # No send
+        if args.no_send:
+            if args.alternatives is not None:
+                print_pairings(pairings, verbose=args.verbose)
+            eprint(
+                f"\n  ⛔️ Not sending {len(emails)} emails in {len(pairs)} pairs with a repetition score of {score} (lower is better, 0 is no repetition)."
+            )
+            eprint(
+                "    Make sure to remove the --no-send flag to actually send emails."
+            )
+            return
+
+        # Prompt user for sending emails
+        if not args.send:
+            eprint(
+                f"  📧 Will send {len(emails)} emails in {len(pairs)} pairs with a repetition score of {score} (lower is better, 0 is no repetition)."
+            )
+
+            # Choose between alternatives
+            if len(pairings) > 1:
+                print_pairings(pairings, verbose=args.verbose)
+                choice = input(
+                    f"     Send which pairing? (1-{len(pairings)}, or n): "
+                ).strip()
+                if not choice.isdigit() or not 1 <= int(choice) <= len(pairings):
+                    discard_cached_pairing(pairs, args.cache_dir)
+                    eprint("\nExiting.")
+                    return
+                score, pairs = pairings[int(choice) - 1]
+            else:
+                # Only show emails if verbose
+                if args.verbose:
+                    for pair in pairs:
+                        eprint(f"     - {', '.join(pair)}")
+
+                email_confirmation = input("     Send emails? (y/n): ")
+                if re.match(r"(y|Y|yes|YES)", email_confirmation) is None:
+                    discard_cached_pairing(pairs, args.cache_dir)
+                    eprint("\nExiting.")
+                    return
+
+        # Render to the outbox, to be delivered later
+        if outbox is not None:
+            queue_round(outbox, roster, pairs, spreadsheet, sheet)
+            return
+
+        # Write pairs down before sending anything
+        journal.start(roster, datetime.now().isoformat(), pairs)
+
+    # Send emails, saving history as they go
+    eprint(f"  📧 Sending {len(journal.pending())} emails...")
+    get_mail_handler(
+        rate_per_minute=args.emails_per_minute,
+        burst=args.email_burst,
+        connections=args.mail_connections,
+    )
+    try:
+        send_round(journal, spreadsheet, sheet)
+    finally:
+        # Close mail handler
+        mail_handler = get_mail_handler()
+        if mail_handler is not None:
+            mail_handler.quit()
+
+    journal.finish()
+    compact_roster_history(roster)
+    eprint("  💾 History saved.")
+
+
+def get_outbox(args):
+    """`Outbox` from CLI arguments, then environment variables, or None."""
+    directory = args.outbox or getenv("SYNAPSE_OUTBOX")
+    return Outbox(directory) if directory else None
+
+
+def check_outbox(outbox, args, rosters):
+    """
+    Raise if a roster has emails in the outbox that were not delivered, or
+    not saved to history, as pairing it again would not know about them, or
+    if asked to resume, which the outbox does not need.
+
+    :param outbox: `Outbox`.
+    :param args: Parsed CLI arguments.
+    :param rosters: List of URIs of rosters about to be paired.
+    """
+    if args.resume:
+        raise Exception(
+            "Rounds are not resumed with --outbox; finish them without it first."
+        )
+
+    queued = outbox.rosters()
+    for roster in rosters:
+        if roster in queued:
+            raise Exception(
+                f"The outbox {outbox.directory} has {queued[roster]} emails of {roster} that were not delivered yet; run the deliver subcommand first."
+            )
+
+
+@timed("queue emails")
+def queue_round(outbox, roster, pairs, spreadsheet, sheet):
+    """
+    Render the emails of a round to the outbox, to be sent by `run_delivery`.
+
+    :param outbox: `Outbox`.
+    :param roster: URI of the roster of the round.
+    :param pairs: List of pairs to send emails to.
+    :param spreadsheet: ID of the spreadsheet, for the emails.
+    :param sheet: ID of the sheet, for the emails.
+    """
+    messages = render_emails(
+        pairs, spreadsheet, sheet, spreadsheet_url=roster_url(roster)
+    )
+    with get_metrics().span("write outbox"):
+        outbox.add_all(
+            roster,
+            datetime.now().isoformat(),
+            pairs,
+            messages,
+            writers=OUTBOX_WRITERS,
+        )
+    get_metrics().count("emails queued", len(messages))
+    eprint(
+        f"  📬 Wrote {len(messages)} emails to {outbox.directory}; send them with the deliver subcommand."
+    )
+
+
+def run_delivery(args):
+    """
+    Send the emails in the outbox, oldest first, within the rate limit, and
+    save their pairs to history as they go, with arguments from `main`.  A
+    delivery that is stopped picks up where it left off when run again.
+
+    :param args: Parsed CLI arguments.
+    """
+    outbox = get_outbox(args)
+    if outbox is None:
+        raise Exception(
+            "Outbox not provided via --outbox CLI argument or SYNAPSE_OUTBOX environment variable."
+        )
+
+    # Save any pairs sent but not saved before an interruption
+    flush_outbox_history(outbox)
+
+    pending = outbox.pending()
+    if not pending:
+        eprint(f"  ✅ Nothing to deliver in {outbox.directory}.")
+        return
+
+    eprint(f"  📧 Delivering {len(pending)} emails...")
+    rosters = set()
+    rejected = []
+    get_mail_handler(
+        rate_per_minute=args.emails_per_minute,
+        burst=args.email_burst,
+        connections=args.mail_connections,
+    )
+    try:
+        for start in range(0, len(pending), HISTORY_FLUSH_SIZE):
+            names = pending[start : start + HISTORY_FLUSH_SIZE]
+            messages = []
+            for name in names:
+                message = outbox.read("new", name)
+                rosters.add(message["roster"])
+                messages.append((message["from_"], message["to"], message["message"]))
+
+            # Rejected emails are put aside, so they don't hold up the rest
+            def on_failed(i, error, names=names, messages=messages):
+                outbox.mark_failed(names[i])
+                rejected.append((messages[i][1], error))
+
+            with get_metrics().span("send emails"):
+                get_mail_handler().send_all(
+                    messages,
+                    on_sent=lambda i, names=names: outbox.mark_sent(names[i]),
+                    on_failed=on_failed,
+                )
+            flush_outbox_history(outbox)
+    finally:
+        # Don't lose what was sent if something went wrong
+        flush_outbox_history(outbox)
+        report_rejected(rejected, f"flagged in {outbox.folder('cur')}")
+
+        # Close mail handler
+        mail_handler = get_mail_handler()
+        if mail_handler is not None:
+            mail_handler.quit()
+
+    for roster in sorted(rosters):
+        compact_roster_history(roster)
+
+    eprint("  💾 History saved.")
+
+
+def report_rejected(rejected, where):
+    """
+    Print the emails the mail server rejected for good, which were not sent
+    again nor saved to history.
+
+    :param rejected: List of `(to, error)` tuples.
+    :param where: Where the rejected emails were put aside.
+    """
+    if not rejected:
+        return
+
+    eprint(
+        f"  ⚠️  {len(rejected)} emails were rejected by the mail server and not saved to history, {where}:"
+    )
+    for to, error in rejected:
+        eprint(f"     - {', '.join(to)}: {error}")
+
+
+def flush_outbox_history(outbox):
+    """Save the pairs of emails that were delivered but are not saved yet."""
+    rounds = {}
+    for name in outbox.unsaved():
+        message = outbox.read("cur", name)
+        rounds.setdefault((message["roster"], message["date"]), []).append(
+            (name, message["pair"])
+        )
+
+    for (roster, date), messages in rounds.items():
+        save_roster_history(roster, [pair for name, pair in messages], date=date)
+        outbox.mark_saved([name for name, pair in messages])
+
+
+def print_pairings(pairings, verbose=False):
+    """
+    Print alternative pairings to choose between, with their scores and how
+    many of their pairs differ from the best one.
+
+    :param pairings: List of `(score, pairs)` tuples, best first.
+    :param verbose: Whether to show the pairs of each.
+    """
+    best = {frozenset(pair) for pair in pairings[0][1]}
+    for i, (score, pairs) in enumerate(pairings):
+        different = sum(1 for pair in pairs if frozenset(pair) not in best)
+        eprint(
+            f"     {i + 1}. Score {score}"
+            + (f", {different} of {len(pairs)} pairs differ from 1" if i else "")
+        )
+        if verbose:
+            for pair in pairs:
+                eprint(f"        - {', '.join(pair)}")
+
+
+def get_search_budget(args, entry=None):
+    """
+    Time budget and target score for pairing, from a batch config entry, then
+    CLI arguments, then environment variables.
+
+    :returns: Tuple of `(time_budget, target_score)`, each None if not set.
+    """
+    entry = entry or {}
+    time_budget = entry.get("time_budget", args.time_budget)
+    if time_budget is None and getenv("SYNAPSE_TIME_BUDGET"):
+        time_budget = float(getenv("SYNAPSE_TIME_BUDGET"))
+    target_score = entry.get("target_score", args.target_score)
+    if target_score is None and getenv("SYNAPSE_TARGET_SCORE"):
+        target_score = int(getenv("SYNAPSE_TARGET_SCORE"))
+
+    return (time_budget, target_score)
+
+
+def print_progress(seconds, score):
+    """
+    Print the best score so far, when it improves, at most once every
+    PROGRESS_INTERVAL_SECONDS; subscribed to the "best score" metric.
+    """
+    global global_progress_printed
+
+    if (
+        global_progress_printed is None
+        or seconds - global_progress_printed >= PROGRESS_INTERVAL_SECONDS
+        or score == 0
+    ):
+        global_progress_printed = seconds
+        eprint(f"     Best score {score} at {seconds:.1f}s")
+
+
+def get_roster(args):
+    """
+    URI of the roster from CLI arguments, then environment variables, then
+    the spreadsheet and sheet.
+    """
+    spreadsheet = args.spreadsheet or getenv("SYNAPSE_SPREADSHEET")
+    sheet = args.sheet or getenv("SYNAPSE_SHEET", "0")
+
+    return (
+        args.roster
+        or getenv("SYNAPSE_ROSTER")
+        or f"gsheet://{spreadsheet or ''}/{sheet}"
+    )
+
+
+def run_simulation(args):
+    """
+    Simulate future rounds of a roster and print how they went, with
+    arguments from `main`.
+
+    :param args: Parsed CLI arguments.
+    """
+    exclusions_file = args.exclusions or getenv("SYNAPSE_EXCLUSIONS")
+    time_budget, target_score = get_search_budget(args)
+    if args.people:
+        emails = [f"person{i}@example.com" for i in range(args.people)]
+        history = None
+        exclusions = read_exclusions(None, filename=exclusions_file)
+    else:
+        eprint("  💾 Loading emails...")
+        emails, history = read_roster(
+            get_roster(args),
+            use_cache=not args.no_cache,
+            cache_directory=args.cache_dir,
+        )
+        exclusions = read_exclusions(
+            get_roster(args),
+            column=args.exclusions_column or getenv("SYNAPSE_EXCLUSIONS_COLUMN"),
+            filename=exclusions_file,
+        )
+
+    eprint(
+        f"  🔮 Simulating {args.rounds} rounds of {len(emails)} emails, every {args.interval} days..."
+    )
+    executor = None
+    if args.workers is not None and args.workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(max_workers=args.workers)
+
+    try:
+        results = []
+        print(
+            f"{'Round':>5}  {'Day':>5}  {'Score':>8}  {'Repeats':>8}  {'Recent':>8}  {'Seconds':>8}"
+        )
+        for result in simulate_rounds(
+            emails,
+            history=history,
+            rounds=args.rounds,
+            interval=args.interval,
+            window=args.window,
+            sample_count=args.samples,
+            matcher=args.matcher or getenv("SYNAPSE_MATCHER", SIMULATION_MATCHER),
+            seed=args.seed,
+            workers=args.workers,
+            backend=args.backend or getenv("SYNAPSE_BACKEND", "python"),
+            group_size=args.group_size or int(getenv("SYNAPSE_GROUP_SIZE", GROUP_SIZE)),
+            exclusions=exclusions,
+            time_budget=time_budget,
+            target_score=target_score,
+            executor=executor,
+        ):
+            results.append(result)
+            print(
+                f"{result['round']:>5}  {result['day']:>5}  {result['score']:>8}  {result['repeats']:>8}  {result['recent_repeats']:>8}  {result['seconds']:>8.3f}"
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print()
+    print(summarize_simulation(results))
+
+
+@timed("simulate")
+def simulate_rounds(
+    emails,
+    history=None,
+    rounds=SIMULATION_ROUNDS,
+    interval=SIMULATION_INTERVAL_DAYS,
+    window=None,
+    seed=None,
+    **pairing,
+):
+    """
+    Pair emails for future rounds in memory, adding each round to history
+    and aging history between rounds, without sending or saving anything.
+    History is updated in place, so each round costs about as much as one
+    pairing, however many rounds came before.
+
+    :param emails: List of emails to pair.
+    :param history: `HistoryIndex` of rounds so far, which is changed, or
+        None to start with no history.
+    :param rounds: Number of rounds.
+    :param interval: Days between rounds.
+    :param window: Decay window in days, defaults to HISTORY_SCORE_MAXIMUM;
+        history is scored again as if it were this long, except rounds that
+        were already compacted.
+    :param seed: Seed for the random number generator; each round gets its
+        own seed from it.
+    :param pairing: Other arguments for `pair_emails`.
+    :returns: Generator of a dict per round, with its number, day, score,
+        number of pairs of people that were grouped before at all
+        (`repeats`) and within the decay window (`recent_repeats`), number
+        of pairs of people, and seconds taken.
+    """
+    index = build_history_index(history)
+    window = window if window is not None else HISTORY_SCORE_MAXIMUM
+    if window != HISTORY_SCORE_MAXIMUM:
+        index.age(HISTORY_SCORE_MAXIMUM - window, HISTORY_EXPIRED_SCORE)
+
+    rng = random.Random(seed)
+    for r in range(rounds):
+        start = perf_counter()
+        if r > 0:
+            index.age(interval, HISTORY_EXPIRED_SCORE)
+
+        score, pairs = pair_emails(
+            emails,
+            history=index,
+            seed=rng.randrange(2**32) if seed is not None else None,
+            **pairing,
+        )
+
+        # Pairs of people in the round, and which of them met before
+        people_pairs = repeats = recent_repeats = 0
+        for group in pairs:
+            for a, b in combinations(group, 2):
+                people_pairs += 1
+                if index.pair_score(a, b) > 0:
+                    repeats += 1
+                    last = index.last_round_score(a, b)
+                    if last is not None and last > HISTORY_EXPIRED_SCORE:
+                        recent_repeats += 1
+
+        index.add_round(pairs, window)
+        seconds = perf_counter() - start
+
+        get_metrics().record("round score", score)
+        yield {
+            "round": r + 1,
+            "day": r * interval,
+            "score": score,
+            "pairs": people_pairs,
+            "repeats": repeats,
+            "recent_repeats": recent_repeats,
+            "seconds": seconds,
+        }
+
+
+def summarize_simulation(results):
+    """Summary of simulated rounds from `simulate_rounds`, as text to print."""
+    from statistics import mean, median, quantiles
+
+    if not results:
+        return "No rounds simulated."
+
+    scores = [result["score"] for result in results]
+    seconds = [result["seconds"] for result in results]
+    people_pairs = sum(result["pairs"] for result in results) or 1
+    repeats = sum(result["repeats"] for result in results)
+    recent_repeats = sum(result["recent_repeats"] for result in results)
+    p90 = (
+        quantiles(scores, n=10, method="inclusive")[-1]
+        if len(scores) > 1
+        else scores[0]
+    )
+
+    return "\n".join(
+        [
+            f"Rounds           {len(results)}",
+            f"Score            min {min(scores)}, median {median(scores)}, mean {mean(scores):.1f}, p90 {p90:.1f}, max {max(scores)}",
+            f"Repeat rate      {repeats / people_pairs:.2%} ({repeats} of {people_pairs} pairs of people met before)",
+            f"Recent repeats   {recent_repeats / people_pairs:.2%} ({recent_repeats} met within the decay window)",
+            f"Seconds/round    mean {mean(seconds):.3f}, max {max(seconds):.3f}, total {sum(seconds):.3f}",
+        ]
+    )
+
+
+def run_batch(args):
+    """
+    Read, match and send emails for every roster of a batch config, with
+    arguments from `main`.  Rosters are read and paired at once, sharing one
+    Google client and one process pool, then emails are sent through one
+    mail handler; a roster that fails does not stop the others.
+
+    :param args: Parsed CLI arguments.
+    """
+    rosters = read_batch_config(args.config)
+    statuses = [{"roster": entry["roster"], "status": "pending"} for entry in rosters]
+    rounds = [None] * len(rosters)
+    outbox = get_outbox(args)
+    if outbox is not None:
+        check_outbox(outbox, args, [entry["roster"] for entry in rosters])
+
+    # Rosters that share history are read one after the other
+    groups = {}
+    for i, entry in enumerate(rosters):
+        key = get_roster_backend(entry["roster"]).history_key()
+        groups.setdefault(key, []).append(i)
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from multiprocessing import get_context
+
+    # Workers are started from reading threads, where forking is not safe
+    eprint(f"  💾 Loading and pairing emails of {len(rosters)} rosters...")
+    workers = args.workers or cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=get_context("spawn")
+    ) as pool:
+
+        def prepare(indexes):
+            for i in indexes:
+                rounds[i] = prepare_batch_roster(
+                    rosters[i], statuses[i], args, workers, pool
+                )
+
+        with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY) as threads:
+            list(threads.map(prepare, groups.values()))
+
+    ready = [i for i in range(len(rosters)) if rounds[i] is not None]
+    email_count = sum(statuses[i]["emails"] for i in ready)
+    pair_count = sum(statuses[i]["pairs"] for i in ready)
+
+    # No send
+    if args.no_send or not ready:
+        for i in ready:
+            statuses[i]["status"] = "not sent"
+        report_batch(statuses)
+        return
+
+    # Prompt user once for all rosters
+    if not args.send:
+        eprint(
+            f"  📧 Will send {email_count} emails in {pair_count} pairs for {len(ready)} rosters."
+        )
+        if args.verbose:
+            for i in ready:
+                eprint(f"     {rosters[i]['roster']}:")
+                journal, pairs = rounds[i]
+                if pairs is None:
+                    pairs = [journal.pairs[p] for p in journal.pending()]
+                for pair in pairs:
+                    eprint(f"     - {', '.join(pair)}")
+
+        email_confirmation = input("     Send emails? (y/n): ")
+        if re.match(r"(y|Y|yes|YES)", email_confirmation) is None:
+            for i in ready:
+                journal, pairs = rounds[i]
+                if pairs is not None:
+                    discard_cached_pairing(pairs, args.cache_dir)
+                statuses[i]["status"] = "not sent"
+            report_batch(statuses)
+            return
+
+    # Render to the outbox, to be delivered later
+    if outbox is not None:
+        for i in ready:
+            journal, pairs = rounds[i]
+            try:
+                queue_round(outbox, rosters[i]["roster"], pairs, None, None)
+                statuses[i]["status"] = "queued"
+            except Exception as error:
+                statuses[i].update(status="failed", error=str(error))
+        report_batch(statuses)
+        return
+
+    # Send emails of each roster in turn, through one mail handler
+    eprint(f"  📧 Sending {email_count} emails...")
+    get_mail_handler(
+        rate_per_minute=args.emails_per_minute,
+        burst=args.email_burst,
+        connections=args.mail_connections,
+    )
+    try:
+        for i in ready:
+            journal, pairs = rounds[i]
+            try:
+                if pairs is not None:
+                    journal.start(
+                        rosters[i]["roster"], datetime.now().isoformat(), pairs
+                    )
+
+                rejected = send_round(journal, None, None)
+                journal.finish()
+                compact_roster_history(rosters[i]["roster"])
+                statuses[i]["status"] = "sent"
+                if rejected:
+                    statuses[i]["error"] = f"{len(rejected)} emails rejected"
+            except Exception as error:
+                statuses[i].update(status="failed", error=str(error))
+    finally:
+        # Close mail handler
+        mail_handler = get_mail_handler()
+        if mail_handler is not None:
+            mail_handler.quit()
+
+    report_batch(statuses)
+
+
+def read_batch_config(filename):
+    """
+    Read the rosters of a batch config, a JSON file like:
+
+        {
+          "rosters": [
+            "gsheet://ID/0",
+            {"spreadsheet": "ID", "sheet": "1", "matcher": "anneal"},
+            {"roster": "file:///data/team.csv", "seed": 1}
+          ]
+        }
+
+    :param filename: Path to the config.
+    :returns: List of dicts with a `roster` URI and any of the other
+        BATCH_ROSTER_OPTIONS.
+    """
+    with open(filename, "r") as f:
+        try:
+            config = json.load(f)
+        except json.decoder.JSONDecodeError as error:
+            raise Exception(f"Batch config {filename} is not valid JSON: {error}")
+
+    rosters = []
+    for entry in config.get("rosters", []):
+        entry = {"roster": entry} if isinstance(entry, str) else dict(entry)
+
+        unknown = set(entry) - set(BATCH_ROSTER_OPTIONS)
+        if unknown:
+            raise Exception(
+                f"Unknown options {sorted(unknown)} in batch config {filename}; use any of {BATCH_ROSTER_OPTIONS}."
+            )
+
+        # A spreadsheet and sheet, like the CLI arguments
+        if "roster" not in entry:
+            if not entry.get("spreadsheet"):
+                raise Exception(
+                    f"Roster in batch config {filename} needs a roster or a spreadsheet."
+                )
+            entry[
+                "roster"
+            ] = f"gsheet://{entry['spreadsheet']}/{entry.get('sheet', '0')}"
+
+        get_roster_backend(entry["roster"])
+        rosters.append(entry)
+
+    if not rosters:
+        raise Exception(f"No rosters in batch config {filename}.")
+
+    return rosters
+
+
+def prepare_batch_roster(entry, status, args, workers, executor):
+    """
+    Read and pair a roster of a batch, or get its interrupted round with
+    --resume, filling in its status.
+
+    :param entry: Roster from `read_batch_config`.
+    :param status: Dict to fill in with the status of the roster.
+    :param args: Parsed CLI arguments, for defaults.
+    :param workers: Number of processes to split random samples across.
+    :param executor: Process pool shared by all rosters.
+    :returns: Tuple of `(journal, pairs)`, with pairs None if the round is
+        already in the journal, or None if there is nothing to send.
+    """
+    roster = entry["roster"]
+    try:
+        # A round that was interrupted must be finished first
+        journal = get_send_journal(roster, args.cache_dir)
+        if args.resume:
+            if journal.is_finished():
+                status["status"] = "nothing to resume"
+                return None
+
+            pairs = [journal.pairs[i] for i in journal.pending()]
+            status.update(
+                status="resuming",
+                emails=sum(len(pair) for pair in pairs),
+                pairs=len(pairs),
+            )
+            return (journal, None)
+        elif not journal.is_finished():
+            raise Exception(
+                f"The round of {journal.date} was interrupted with {len(journal.pending())} of {len(journal.pairs)} emails left to send; use --resume to finish it, or remove {journal.filename} to start over."
+            )
+
+        emails, history = read_roster(
+            roster, use_cache=not args.no_cache, cache_directory=args.cache_dir
+        )
+        exclusions = read_exclusions(
+            roster,
+            column=entry.get("exclusions_column")
+            or args.exclusions_column
+            or getenv("SYNAPSE_EXCLUSIONS_COLUMN"),
+            filename=entry.get("exclusions")
+            or args.exclusions
+            or getenv("SYNAPSE_EXCLUSIONS"),
+        )
+        time_budget, target_score = get_search_budget(args, entry)
+        score, pairs = pair_emails_cached(
+            emails,
+            history=history,
+            use_cache=not args.no_pairing_cache,
+            cache_directory=args.cache_dir,
+            matcher=entry.get("matcher")
+            or args.matcher
+            or getenv("SYNAPSE_MATCHER", "random"),
+            seed=entry.get("seed", args.seed),
+            workers=workers,
+            backend=entry.get("backend")
+            or args.backend
+            or getenv("SYNAPSE_BACKEND", "python"),
+            group_size=entry.get("group_size")
+            or args.group_size
+            or int(getenv("SYNAPSE_GROUP_SIZE", GROUP_SIZE)),
+            exclusions=exclusions,
+            time_budget=time_budget,
+            target_score=target_score,
+            executor=executor,
+        )
+        status.update(
+            status="paired", emails=len(emails), pairs=len(pairs), score=score
+        )
+        eprint(
+            f"     {roster}: {len(emails)} emails in {len(pairs)} pairs, score {score}"
+        )
+
+        return (journal, pairs) if pairs else None
+    except Exception as error:
+        status.update(status="failed", error=str(error))
+        return None
+
+
+def report_batch(statuses):
+    """
+    Print the status of each roster of a batch, even with --quiet, and raise
+    if any failed.
+
+    :param statuses: List of dicts from `run_batch`.
+    """
+    icons = {"sent": "✅", "queued": "📬", "failed": "❌"}
+
+    print("\n  📋 Rosters", file=sys.stderr)
+    for status in statuses:
+        get_metrics().count(f"rosters {status['status']}")
+
+        details = status.get("error")
+        if details is None and "pairs" in status:
+            details = f"{status['emails']} emails in {status['pairs']} pairs"
+            if "score" in status:
+                details += f", score {status['score']}"
+        print(
+            f"     {icons.get(status['status'], '➖')} {status['roster']}: {status['status']}"
+            + (f" ({details})" if details else ""),
+            file=sys.stderr,
+        )
+
+    failed = [status for status in statuses if status["status"] == "failed"]
+    if failed:
+        raise Exception(f"{len(failed)} of {len(statuses)} rosters failed.")
+
+
+def report_metrics(timings=False, metrics_json=None):
+    """
+    Print metrics of the run, and/or write them to a JSON file.
+
+    :param timings: Print a summary table to stderr, even with --quiet.
+    :param metrics_json: File to write metrics to.
+    """
+    metrics = get_metrics()
+
+    # Derived rates
+    send_seconds = metrics.seconds("send emails")
+    if send_seconds > 0:
+        metrics.counters["emails per second"] = (
+            metrics.counters.get("emails sent", 0) / send_seconds
+        )
 
-    # Get list of emails from spreadsheet
-    eprint("  💾 Loading emails...")
-    emails = collect_emails(spreadsheet, sheet)
+    if timings:
+        print("\n  ⏱️  Timings", file=sys.stderr)
+        for line in metrics.summary().split("\n"):
+            print(f"     {line}", file=sys.stderr)
 
-    # Reading history from spreadsheet
-    history = read_history()
+    if metrics_json:
+        with open(metrics_json, "w") as f:
+            json.dump(metrics.as_dict(), f, indent=2)
 
-    # Make pairs
-    eprint("  💾 Pairing emails...")
-    score, pairs = pair_emails(emails, history=history)
 
-    # No send
-    if args.no_send:
-        eprint(
-            f"\n  ⛔️ Not sending {len(emails)} emails in {len(pairs)} pairs with a repetition score of {score} (lower is better, 0 is no repetition)."
-        )
-        eprint("    Make sure to remove the --no-send flag to actually send emails.")
-        return
+def send_round(journal, spreadsheet, sheet):
+    """
+    Send the emails of a round that are not sent yet, marking each in the
+    journal once sent, and saving history every HISTORY_FLUSH_SIZE pairs.
+    Emails the mail server rejects for good are marked as failed, reported
+    and not sent again, so they don't hold up the rest.
+
+    :param journal: `SendJournal` with the round.
+    :param spreadsheet: ID of the spreadsheet, for the emails.
+    :param sheet: ID of the sheet, for the emails.
+    :returns: List of `(to, error)` tuples of the rejected emails.
+    """
+    pending = journal.pending()
+    pairs = [journal.pairs[i] for i in pending]
+    messages = render_emails(
+        pairs, spreadsheet, sheet, spreadsheet_url=roster_url(journal.roster)
+    )
+    rejected = []
 
-    # Prompt user for sending emails
-    if not args.send:
-        eprint(
-            f"  📧 Will send {len(emails)} emails in {len(pairs)} pairs with a repetition score of {score} (lower is better, 0 is no repetition)."
-        )
+    def on_failed(i, error):
+        journal.mark_failed(pending[i])
+        rejected.append((messages[i][1], error))
 
-        # Only show emails if verbose
-        if args.verbose:
-            for pair in pairs:
-                eprint(f"     - {', '.join(pair)}")
+    try:
+        # Save any pairs sent but not saved before an interruption
+        flush_round_history(journal)
+
+        for start in range(0, len(messages), HISTORY_FLUSH_SIZE):
+            with get_metrics().span("send emails"):
+                get_mail_handler().send_all(
+                    messages[start : start + HISTORY_FLUSH_SIZE],
+                    on_sent=lambda i, start=start: journal.mark_sent(
+                        pending[start + i]
+                    ),
+                    on_failed=lambda i, error, start=start: on_failed(start + i, error),
+                )
+            flush_round_history(journal)
+    finally:
+        # Don't lose what was sent if something went wrong
+        flush_round_history(journal)
+        report_rejected(rejected, "and are not sent again")
 
-        email_confirmation = input("     Send emails? (y/n): ")
-        if re.match(r"(y|Y|yes|YES)", email_confirmation) is None:
-            eprint("\nExiting.")
-            return
+    return rejected
 
-    # Send emails
-    eprint(f"  📧 Sending {len(pairs)} emails...")
-    send_emails(pairs, spreadsheet, sheet)
 
-    # Close mail handler
-    mail_handler = get_mail_handler()
-    if mail_handler is not None:
-        mail_handler.quit()
+def flush_round_history(journal):
+    """Save the pairs of a round that were sent but are not saved yet."""
+    unsaved = journal.unsaved()
+    if not unsaved:
+        return
 
-    # Save history
-    eprint("  💾 Saving history...")
-    save_history(pairs)
+    save_roster_history(
+        journal.roster, [journal.pairs[i] for i in unsaved], date=journal.date
+    )
+    journal.mark_saved(unsaved)
 
 
-def send_emails(pairs, spreadsheet, sheet):
+def send_emails(pairs, spreadsheet, sheet, spreadsheet_url=None):
     """
     Send all emails
 
     :param pairs: List of pairs to send emails for.
     :param spreadsheet: ID of the spreadsheet, defaults to env var SYNAPSE_SPREADSHEET.
     :param sheet: ID of the sheet, defaults to env var SYNAPSE_SHEET and 0 if neither
+    :param spreadsheet_url: Where emails can be managed, defaults to the URL
+        of the spreadsheet and sheet.
     """
 
-    # Templates
-    dirname = path.dirname(__file__)
-    email_template_html_filename = path.join(
-        dirname, "templates", "email_template.html"
-    )
-    with open(email_template_html_filename, "r") as email_template_html:
-        email_template_txt_filename = path.join(
-            dirname, "templates", "email_template.txt"
+    # Render everything before sending anything
+    messages = render_emails(pairs, spreadsheet, sheet, spreadsheet_url=spreadsheet_url)
+
+    # Send all at once, within the rate limit
+    get_mail_handler().send_all(messages)
+
+
+@timed("render emails")
+def render_emails(pairs, spreadsheet, sheet, from_=None, spreadsheet_url=None):
+    """
+    Render the emails for all pairs.
+
+    :param pairs: List of pairs to render emails for.
+    :param spreadsheet: ID of the spreadsheet.
+    :param sheet: ID of the sheet.
+    :param from_: Email address to send from, defaults to env var
+        SYNAPSE_GMAIL_USERNAME.
+    :param spreadsheet_url: Where emails can be managed, defaults to the URL
+        of the spreadsheet and sheet, or if there is no spreadsheet, like for a
+        local roster, to emailing the sender.
+    :returns: List of `(from_, to, message)` tuples, ready for `Mailer.send`.
+    """
+    from_ = from_ if from_ is not None else getenv("SYNAPSE_GMAIL_USERNAME")
+
+    # Templates, compiled once
+    email_template_txt = get_template("email_template.txt")
+    email_template_html = get_template("email_template.html")
+    subject_templates = [compile_template(subject) for subject in POTENTIAL_SUBJECTS]
+
+    # Spreadsheet URL
+    if not spreadsheet_url and spreadsheet:
+        spreadsheet_url = SheetBackend(spreadsheet, sheet).url()
+    elif not spreadsheet_url:
+        spreadsheet_url = f"mailto:{from_ or ''}"
+
+    # Go through each pair and render emails
+    messages = []
+    for pair in pairs:
+        emails = ",".join(pair)
+        names = [email.split(".")[0].capitalize() for email in pair]
+        html_names = [f"<strong>{name}</strong>" for name in names]
+        names_joined = join_names(names)
+        html_names_joined = join_names(html_names)
+
+        # Subject
+        subject = render_template(
+            random.choice(subject_templates), {"NAMES": names_joined}
         )
-        with open(email_template_txt_filename, "r") as email_template_txt:
-            # Read files
-            email_template_txt_contents = email_template_txt.read()
-            email_template_html_contents = email_template_html.read()
 
-            # Go through each pair and send emails
-            for pair in pairs:
-                emails = ",".join(pair)
-                names = [email.split(".")[0].capitalize() for email in pair]
-                html_names = [f"<strong>{name}</strong>" for name in names]
-                names_joined = join_names(names)
-                html_names_joined = join_names(html_names)
-
-                # Subject
-                subject = random.choice(POTENTIAL_SUBJECTS).replace(
-                    "[[[NAMES]]]", names_joined
-                )
+        # Schedule URL
+        schedule_query = urlencode(
+            {
+                "action": "TEMPLATE",
+                "text": f"1:1 - {', '.join(names)}",
+                "add": emails,
+                "details": f"This 1:1 was randomly paired by an automated system.  If you don't want to receive these pairings anymore, manage your email at this spreadsheet: {spreadsheet_url}",
+            }
+        )
+        schedule_url = f"https://calendar.google.com/calendar/render?{schedule_query}"
 
-                # Spreadsheet URL
-                spreadsheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet}/edit#gid={sheet}"
-
-                # Schedule URL
-                schedule_query = urlencode(
-                    {
-                        "action": "TEMPLATE",
-                        "text": f"1:1 - {', '.join(names)}",
-                        "add": emails,
-                        "details": f"This 1:1 was randomly paired by an automated system.  If you don't want to receive these pairings anymore, manage your email at this spreadsheet: {spreadsheet_url}",
-                    }
-                )
-                schedule_url = (
-                    f"https://calendar.google.com/calendar/render?{schedule_query}"
-                )
+        # Text template
+        body_text = render_template(
+            email_template_txt,
+            {
+                "NAMES": names_joined,
+                "SCHEDULE_URL": schedule_url,
+                "SPREADSHEET_URL": spreadsheet_url,
+            },
+        )
 
-                # Text template
-                body_text = (
-                    email_template_txt_contents.replace("[[[NAMES]]]", names_joined)
-                    .replace("[[[SCHEDULE_URL]]]", schedule_url)
-                    .replace("[[[SPREADSHEET_URL]]]", spreadsheet_url)
-                )
+        # Email template
+        body_html = render_template(
+            email_template_html,
+            {
+                "NAMES": html_names_joined,
+                "SCHEDULE_URL": schedule_url,
+                "SPREADSHEET_URL": spreadsheet_url,
+            },
+        )
 
-                # Email template
-                body_html = (
-                    email_template_html_contents.replace(
-                        "[[[NAMES]]]", html_names_joined
-                    )
-                    .replace("[[[SCHEDULE_URL]]]", schedule_url)
-                    .replace("[[[SPREADSHEET_URL]]]", spreadsheet_url)
-                )
+        messages.append(render_email(emails, from_, subject, body_html, body_text))
+
+    return messages
+
+
+def render_email(to, from_, subject, body_html, body_text):
+    """
+    Same as `build_email`, but fills in a message compiled once instead of
+    building a new one, when everything is plain ASCII (which is the case for
+    the templates and most names).
+    """
+    if not (
+        to.isascii()
+        and (from_ or "").isascii()
+        and body_html.isascii()
+        and body_text.isascii()
+    ):
+        return build_email(to, from_, subject, body_html, body_text)
+
+    message = render_template(
+        get_template(MESSAGE_TEMPLATE),
+        {
+            "SUBJECT": encode_header(subject),
+            "FROM": from_ or "",
+            "TO": to,
+            "BODY_HTML": body_html,
+            "BODY_TEXT": body_text,
+        },
+    )
 
-                # Send email
-                send_email(emails, None, subject, body_html, body_text)
+    return (from_, to.split(","), message)
 
 
 def send_email(to, from_, subject, body_html, body_text):
     """
-    Send a multipart email
+    Send a multipart email; see `build_email` for parameters.
+    """
+    get_mail_handler().send(*build_email(to, from_, subject, body_html, body_text))
+
+
+def build_email(to, from_, subject, body_html, body_text):
+    """
+    Build a multipart email
     Inspiration: https://stackoverflow.com/questions/882712/send-html-emails-with-python
 
     :param to: Email address to send to in the form of a string of emails separated by
@@ -229,7 +1432,12 @@ def send_email(to, from_, subject, body_html, body_text):
     :param subject: Subject of the email.
     :param body_html: HTML body of the email.
     :param body_text: Text body of the email.
+    :returns: Tuple of `(from_, to, message)`, with `to` as a list of emails and
+        `message` as a string, ready for `Mailer.send`.
     """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
     from_ = from_ if from_ is not None else getenv("SYNAPSE_GMAIL_USERNAME")
 
     # Create message container - the correct MIME type is multipart/alternative.
@@ -254,14 +1462,83 @@ def send_email(to, from_, subject, body_html, body_text):
     msg.attach(part1)
     msg.attach(part2)
 
-    # Send the message via local SMTP server.
-    mail_handler = get_mail_handler()
-    mail_handler.sendmail(from_, msg["To"].split(","), msg.as_string())
+    return (from_, msg["To"].split(","), msg.as_string())
+
+
+def get_template(name):
+    """
+    Get a compiled template from the templates folder; each template is read
+    and compiled only once.
+
+    :param name: Filename of the template, or MESSAGE_TEMPLATE for the
+        message that rendered templates are put into.
+    """
+    global global_templates
+
+    if name not in global_templates:
+        if name == MESSAGE_TEMPLATE:
+            # Build a message with slots, then compile what it turns into
+            contents = build_email(
+                "[[[TO]]]",
+                "[[[FROM]]]",
+                "[[[SUBJECT]]]",
+                "[[[BODY_HTML]]]",
+                "[[[BODY_TEXT]]]",
+            )[2]
+        else:
+            with open(path.join(path.dirname(__file__), "templates", name), "r") as f:
+                contents = f.read()
+
+        global_templates[name] = compile_template(contents)
+
+    return global_templates[name]
 
-    # Make sure we don't do too many too quickly
-    sleep(TIME_TO_WAIT_BETWEEN_EMAILS)
 
+def compile_template(contents):
+    """
+    Compile template contents into a list of parts, where every odd part is
+    the name of a slot to fill, for instance `NAMES` for `[[[NAMES]]]`.
+    """
+    return TEMPLATE_SLOT_PATTERN.split(contents)
+
+
+def render_template(template, values):
+    """
+    Render a compiled template.
+
+    :param template: Template from `compile_template`.
+    :param values: Dict of slot name to value.
+    """
+    parts = template.copy()
+    for i in range(1, len(parts), 2):
+        parts[i] = values[parts[i]]
+
+    return "".join(parts)
 
+
+def encode_header(value):
+    """
+    Encode a header value as RFC 2047 encoded words if it is not plain ASCII,
+    like the email package does but without the overhead.
+    """
+    if value.isascii():
+        return value
+
+    # Split into words of at most 45 bytes, which stay within the 75
+    # character limit once encoded, without splitting characters
+    chunks = [b""]
+    for character in value:
+        encoded = character.encode("utf-8")
+        if len(chunks[-1]) + len(encoded) > 45:
+            chunks.append(b"")
+        chunks[-1] += encoded
+
+    return "\n ".join(
+        f"=?utf-8?b?{b64encode(chunk).decode('ascii')}?=" for chunk in chunks
+    )
+
+
+@timed("collect emails")
 def collect_emails(spreadsheet, sheet):
     """
     Collect emails from spreadsheet.
@@ -283,15 +1560,7 @@ def collect_emails(spreadsheet, sheet):
             "Spreadsheet not provided via CLI argument or SYNAPSE_SPREADSHEET environment variable."
         )
 
-    # Connect to spreadsheet
-    gspread_client = get_gpread_client()
-    spreadsheet = gspread_client.open_by_key(spreadsheet)
-    sheet = spreadsheet.get_worksheet(int(sheet))
-
-    # Get all values from first column
-    column_values = sheet.col_values(1)
-
-    return filter_emails(column_values)
+    return read_spreadsheet(spreadsheet, sheet, history=False)[0]
 
 
 def filter_emails(emails, filter_regex=None):
@@ -323,89 +1592,539 @@ def filter_emails(emails, filter_regex=None):
     return emails
 
 
-def pair_emails(emails, history=None, sample_count=None):
+def pair_emails_cached(
+    emails, history=None, use_cache=True, cache_directory=None, max_age=None, **options
+):
     """
-    Randomly pair emails together
+    Same as `pair_emails`, but keeps the pairing on disk under a hash of the
+    emails, history and options, so that running again with the same ones,
+    like sending after a --no-send preview, gives the same pairs without
+    pairing again, until the pairing expires.
 
     :param emails: List of emails to pair.
-    :param history: List of previous pairings to avoid.
-    :param sample_count: Number of pair permutations to make to try to
-        find the most optimal; if not provided uses EMAIL_MATCH_PERMUTATIONS
-        constant.
+    :param history: `HistoryIndex` of previous pairings, or None.
+    :param use_cache: Whether to use and save cached pairings.
+    :param cache_directory: Where to keep pairings, defaults to env var
+        SYNAPSE_CACHE_DIR or HISTORY_CACHE_DIRECTORY.
+    :param max_age: Hours a pairing is kept, defaults to env var
+        SYNAPSE_PAIRING_CACHE_HOURS or PAIRING_CACHE_HOURS.
+    :param options: Other arguments for `pair_emails`.
     """
+    return pair_emails_alternatives_cached(
+        emails,
+        history=history,
+        use_cache=use_cache,
+        cache_directory=cache_directory,
+        max_age=max_age,
+        **options,
+    )[0]
+
+
+def pair_emails_alternatives_cached(
+    emails,
+    history=None,
+    use_cache=True,
+    cache_directory=None,
+    max_age=None,
+    alternatives=1,
+    **options,
+):
+    """
+    Same as `pair_emails_cached`, but keeping this many of the best distinct
+    pairings, see `pair_emails_alternatives`.
+
+    :returns: List of `(score, pairs)` tuples, best first.
+    """
+    if not use_cache:
+        return pair_emails_alternatives(
+            emails, history=history, alternatives=alternatives, **options
+        )
+
+    cache = get_pairing_cache(cache_directory, max_age)
+
+    # Everything the pairing depends on; the pool it runs in does not matter
+    import hashlib
+
+    key_options = {
+        name: value
+        for name, value in options.items()
+        if name not in ("executor", "exclusions")
+    }
+    if options.get("exclusions"):
+        key_options["exclusions"] = sorted(
+            sorted(pair) for pair in options["exclusions"].pairs()
+        )
+    if not key_options.get("time_budget"):
+        key_options["sample_count"] = (
+            key_options.get("sample_count") or EMAIL_MATCH_PERMUTATIONS
+        )
+    key_options["workers"] = key_options.get("workers") or 1
+    key_options["alternatives"] = alternatives
+    key = hashlib.sha256(
+        json.dumps(
+            [emails, build_history_index(history).fingerprint(), key_options],
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+
+    pairings = cache.get(key)
+    if pairings is not None:
+        get_metrics().count("pairing cache hits")
+        eprint(
+            "  💾 Using the pairing of an earlier run with the same emails and history."
+        )
+        return pairings
+
+    pairings = pair_emails_alternatives(
+        emails, history=history, alternatives=alternatives, **options
+    )
+    cache.set(key, pairings)
+
+    return pairings
 
-    # Don't do anything if only one or less emails
-    if len(emails) < 2:
-        return (0, [])
 
-    # Sample count
-    sample_count = (
-        sample_count if sample_count is not None else EMAIL_MATCH_PERMUTATIONS
+def get_pairing_cache(cache_directory=None, max_age=None):
+    """
+    Get the `PairingCache` of `pair_emails_cached`.
+
+    :param cache_directory: Where to keep pairings, defaults to env var
+        SYNAPSE_CACHE_DIR or HISTORY_CACHE_DIRECTORY.
+    :param max_age: Hours a pairing is kept, defaults to env var
+        SYNAPSE_PAIRING_CACHE_HOURS or PAIRING_CACHE_HOURS.
+    """
+    cache_directory = cache_directory or getenv(
+        "SYNAPSE_CACHE_DIR", HISTORY_CACHE_DIRECTORY
+    )
+    max_age = (
+        max_age
+        if max_age is not None
+        else float(getenv("SYNAPSE_PAIRING_CACHE_HOURS", PAIRING_CACHE_HOURS))
     )
 
-    # Make samples of pairs to try to avoid matching people up with
-    # the sample people recently
-    samples = []
-    for s in range(sample_count):
-        # Shuffle emails to be able to pair
-        shuffled = emails.copy()
-        shuffle(shuffled)
+    return PairingCache(path.join(cache_directory, "pairings"), max_age * 3600)
+
+
+def discard_cached_pairing(pairs, cache_directory=None):
+    """
+    Forget a pairing that was declined, so running again pairs again instead
+    of offering the same pairs.
 
-        # Place to store pairs
-        pairs = []
+    :param pairs: List of pairs that were declined.
+    :param cache_directory: Where pairings are kept, see `get_pairing_cache`.
+    """
+    get_pairing_cache(cache_directory).discard(pairs)
 
-        # Create pairs
-        while len(shuffled) > 0:
-            # Add two
-            pair = [shuffled.pop(), shuffled.pop()]
 
-            # If there is only one left, add it to the last pair
-            if len(shuffled) == 1:
-                pair.append(shuffled.pop())
+@timed("read roster")
+def read_roster(roster, use_cache=True, cache_directory=None):
+    """
+    Read emails and history from a roster.
+
+    :param roster: URI of the roster, see `synapse.backends.parse_backend_uri`.
+    :param use_cache: For Google Spreadsheets, keep a local copy of the
+        history sheet, see `read_spreadsheet`.
+    :param cache_directory: Where to keep the local copy.
+    :returns: Tuple of `(emails, history)`, with history as a `HistoryIndex`,
+        or None if there is no history yet.
+    """
+    backend = get_roster_backend(roster)
+
+    # Emails and history of a spreadsheet in one request, with a local copy
+    # of history so only new rows are fetched
+    if isinstance(backend, SheetBackend):
+        return read_spreadsheet(
+            backend.spreadsheet,
+            backend.sheet,
+            use_cache=use_cache,
+            cache_directory=cache_directory,
+        )
 
-            pairs.append(pair)
+    # Local files, read line by line
+    emails = filter_emails(backend.read_emails())
+    if not backend.has_history():
+        return (emails, None)
+
+    with get_metrics().span("parse history"):
+        # Compacted in memory only; the file is compacted once a round is
+        # sent, see `compact_roster_history`
+        snapshot = backend.read_snapshot()
+        snapshot, rows, expired = compact_history_rows(
+            list(backend.read_history()), snapshot
+        )
 
-        # Determine history score and add to sample
-        history_score = calculate_history_score(pairs, history)
-        samples.append((history_score, pairs))
+        return (emails, build_history(rows, snapshot))
 
-    # Find lowest score
-    samples.sort(key=lambda x: x[0])
 
-    return (samples[0][0], samples[0][1])
+@timed("compact history")
+def compact_roster_history(roster):
+    """
+    Fold rounds of a local history file that are older than the decay window
+    into its snapshot, keeping only newer rounds in full.  Done once a round
+    was sent, never when only reading a roster.  The history sheet of a
+    spreadsheet is left as is; its local copy is compacted when read.
 
+    :param roster: URI of the roster, see `synapse.backends.parse_backend_uri`.
+    """
+    backend = get_roster_backend(roster)
+    if not isinstance(backend, FileBackend) or not backend.has_history():
+        return
 
-def read_history():
-    """Read history from spreadsheet"""
+    snapshot, rows, expired = compact_history_rows(
+        list(backend.read_history()), backend.read_snapshot()
+    )
+    if expired:
+        backend.compact(snapshot.as_dict(), rows)
 
-    # Get history spreadsheet
-    gspread_client = get_gpread_client()
-    history_spreadsheet = gspread_client.open_by_key(getenv("SYNAPSE_SPREADSHEET"))
 
-    # Get history if sheet exists
-    history_sheet = None
-    try:
-        history_sheet = history_spreadsheet.worksheet(HISTORY_SHEET_NAME)
-    except gspread.exceptions.WorksheetNotFound:
+@timed("save history")
+def save_roster_history(roster, pairs, date=None):
+    """
+    Save pairing to the history of a roster.
+
+    :param roster: URI of the roster, see `synapse.backends.parse_backend_uri`.
+    :param pairs: List of pairs to save.
+    :param date: Date of the round, as an ISO string, defaults to now; pairs
+        of a round can be saved in several batches with the same date.
+    """
+    date = date or datetime.now().isoformat()
+    get_roster_backend(roster).append_history([(date, pairs)])
+
+
+def get_send_journal(roster, cache_directory=None):
+    """
+    Open the journal of the rounds of a roster.
+
+    :param roster: URI of the roster.
+    :param cache_directory: Where to keep it, defaults to env var
+        SYNAPSE_CACHE_DIR or HISTORY_CACHE_DIRECTORY.
+    """
+    cache_directory = cache_directory or getenv(
+        "SYNAPSE_CACHE_DIR", HISTORY_CACHE_DIRECTORY
+    )
+    import hashlib
+
+    name = hashlib.sha256(roster.encode("utf-8")).hexdigest()[:16]
+
+    return SendJournal(path.join(cache_directory, f"journal-{name}.jsonl"))
+
+
+@timed("read exclusions")
+def read_exclusions(roster, column=None, filename=None):
+    """
+    Read people who must never be grouped together, from a file, a column of
+    the roster next to each email, or both.
+
+    :param roster: URI of the roster, see `synapse.backends.parse_backend_uri`.
+    :param column: Letters of the roster column, like B, listing the people
+        each email must not be grouped with.
+    :param filename: Path to a CSV file, see
+        `synapse.exclusions.read_exclusion_file`.
+    :returns: `ExclusionIndex`, or None if neither was provided.
+    """
+    if not column and not filename:
         return None
 
-    # Get all values
-    values = history_sheet.get_all_records()
+    exclusions = read_exclusion_file(filename) if filename else ExclusionIndex()
+    if column:
+        rows = get_roster_backend(roster).read_column(column_index(column))
+        exclusions_from_rows(rows, exclusions)
 
-    # Transform
-    transformed = []
-    for v in values:
-        try:
-            transformed.append(
-                {
-                    "score": convert_date_to_score(v["Date"]),
-                    "pairs": json.loads(v["Email pairs"]),
-                }
+    return exclusions
+
+
+def roster_url(roster):
+    """
+    URL where people can manage their emails in a roster, or None for a local
+    file without a `url` option.
+    """
+    return get_roster_backend(roster).url()
+
+
+def get_roster_backend(roster):
+    """
+    Get the backend of a roster, see `synapse.backends.get_backend`.
+
+    :param roster: URI of the roster, see `synapse.backends.parse_backend_uri`.
+    """
+    return get_backend(roster, open_session=get_spreadsheet_session)
+
+
+def read_spreadsheet(
+    spreadsheet, sheet=None, history=True, use_cache=True, cache_directory=None
+):
+    """
+    Read emails and history from the spreadsheet, in one request.
+
+    :param spreadsheet: ID of the spreadsheet.
+    :param sheet: ID of the sheet with emails in the first column, or None to
+        not read emails.
+    :param history: Whether to read history.
+    :param use_cache: Keep a local copy of the history sheet, so only rows
+        added since the last run are fetched.
+    :param cache_directory: Where to keep the local copy, defaults to env var
+        SYNAPSE_CACHE_DIR or HISTORY_CACHE_DIRECTORY.
+    :returns: Tuple of `(emails, history)`, with emails as filtered by
+        `filter_emails` and history as a `HistoryIndex`; either is None if not
+        read, and history is None if there is no history sheet yet.
+    """
+    session = get_spreadsheet_session(spreadsheet)
+
+    # Emails from the first column
+    ranges = []
+    if sheet is not None:
+        ranges.append((session.sheet_by_index(int(sheet))["title"], "A:A"))
+
+    # History, if sheet exists, from the local copy if possible
+    history_sheet = session.sheet_by_title(HISTORY_SHEET_NAME) if history else None
+    store = None
+    if history_sheet is not None:
+        if use_cache:
+            store = get_history_store(spreadsheet, cache_directory)
+
+        # Rows start after the header, so the last seen row is row `seen + 1`
+        seen = len(store) if store is not None else 0
+        ranges.append((HISTORY_SHEET_NAME, f"A{seen + 1}:B"))
+
+        # A few of the rows seen before it, to notice rows edited since
+        checked = []
+        if seen > 1:
+            checked = sorted(
+                random.sample(range(seen - 1), min(seen - 1, HISTORY_CHECK_ROWS))
+            )
+        for row in checked:
+            ranges.append((HISTORY_SHEET_NAME, f"A{row + 2}:B{row + 2}"))
+
+    values = session.batch_get(ranges) if ranges else []
+
+    emails = None
+    if sheet is not None:
+        emails = filter_emails([row[0] for row in values.pop(0) if row])
+
+    if history_sheet is None:
+        return (emails, None)
+
+    with get_metrics().span("parse history"):
+        if store is not None:
+            sync_history_store(
+                store,
+                values[0],
+                lambda: session.batch_get([(HISTORY_SHEET_NAME, "A:B")])[0],
+                checked=dict(zip(checked, values[1:])),
             )
+            snapshot = compact_history_store(store)
+            history = build_history_from_store(store, snapshot)
+            store.close()
+        else:
+            rows = normalize_history_rows(values[0])[1:]
+            snapshot, rows, expired = compact_history_rows(rows)
+            history = build_history(rows, snapshot)
+
+        return (emails, history)
+
+
+@timed("read history")
+def read_history(use_cache=True, cache_directory=None, spreadsheet=None):
+    """
+    Read history from spreadsheet into a `HistoryIndex`.
+
+    :param use_cache: Keep a local copy of the history sheet, so only rows
+        added since the last run are fetched.
+    :param cache_directory: Where to keep the local copy, defaults to env var
+        SYNAPSE_CACHE_DIR or HISTORY_CACHE_DIRECTORY.
+    :param spreadsheet: ID of the spreadsheet, defaults to env var
+        SYNAPSE_SPREADSHEET.
+    """
+    return read_spreadsheet(
+        spreadsheet or getenv("SYNAPSE_SPREADSHEET"),
+        use_cache=use_cache,
+        cache_directory=cache_directory,
+    )[1]
+
+
+def sync_history_store(store, values, fetch_all, checked=None):
+    """
+    Bring the local copy of the history sheet up to date with the rows
+    fetched from the last synced row on.  If the last synced row (or the
+    header) no longer matches the sheet, rows were added, removed or edited
+    before it, and if a checked row no longer matches its digest, it was
+    edited; either way the whole copy is rebuilt.  Only a few rows are
+    checked each run, so what is fetched does not grow with history, and an
+    edit is noticed on a later run if it was not sampled.
+
+    :param store: `HistoryStore` for the spreadsheet.
+    :param values: Rows of the history sheet from row `len(store) + 1` on.
+    :param fetch_all: Function returning all rows of the history sheet, used
+        if the copy has to be rebuilt.
+    :param checked: Dict of synced row numbers, counting from 0, to the rows
+        of the history sheet fetched for them, to compare with the copy.
+    :returns: All history rows as `(date, pairs)` tuples.
+    """
+    from synapse.store import digest_row
+
+    values = normalize_history_rows(values)
+    expected = store.last_row() if len(store) > 0 else HISTORY_HEADERS
+    checked = checked or {}
+    digests = store.row_digests(checked)
+    unchanged = all(
+        digests.get(row) == digest_row(*(normalize_history_rows(rows) or [["", ""]])[0])
+        for row, rows in checked.items()
+    )
+
+    if values[:1] == [expected] and unchanged:
+        store.append(values[1:])
+    else:
+        store.replace(normalize_history_rows(fetch_all())[1:])
+
+    return store.rows()
+
+
+def compact_history_store(store):
+    """
+    Compact rounds of the local copy of history that are older than the
+    decay window into its snapshot.
+
+    :param store: `HistoryStore`.
+    :returns: `HistorySnapshot` of all compacted rounds.
+    """
+    snapshot = store.snapshot()
+    numbered_rows = store.numbered_rows()
+    snapshot, rows, expired = compact_history_rows(
+        [(date, pairs) for row, date, pairs in numbered_rows],
+        snapshot,
+    )
+
+    if expired:
+        store.compact(
+            [numbered_rows[i][0] for i in expired],
+            snapshot.as_dict(),
+        )
+
+    return snapshot
+
+
+def compact_history_rows(values, snapshot=None):
+    """
+    Fold history rows older than the decay window into a snapshot; they all
+    have a score of HISTORY_EXPIRED_SCORE, so the snapshot scores them the
+    same.  Rows with the same date are one round.
+
+    :param values: List of `(date, pairs)` rows, with pairs as JSON or
+        already decoded.
+    :param snapshot: Snapshot to add to, as from `HistorySnapshot.as_dict`.
+    :returns: Tuple of `(snapshot, rows, expired)`, with the new
+        `HistorySnapshot`, the rows that are left, and the positions of the
+        rows that were folded into the snapshot.
+    """
+    snapshot = HistorySnapshot.from_dict(snapshot) if snapshot else HistorySnapshot()
+
+    rows = []
+    expired = []
+    rounds = {}
+    for i, (date, pairs) in enumerate(values):
+        if not is_expired_date(date):
+            rows.append((date, pairs))
+            continue
+
+        expired.append(i)
+        try:
+            pairs = json.loads(pairs) if isinstance(pairs, str) else pairs
+            rounds.setdefault(date, []).extend(pairs)
+        except json.decoder.JSONDecodeError:
+            pass
+
+    for pairs in rounds.values():
+        snapshot.add_round(pairs)
+
+    return (snapshot, rows, expired)
+
+
+def build_history(values, snapshot=None):
+    """
+    Make a `HistoryIndex` from history rows and a snapshot of older rounds.
+
+    :param values: List of `(date, pairs)` rows.
+    :param snapshot: `HistorySnapshot`.
+    """
+    return HistoryIndex(
+        transform_history_rows(values),
+        snapshot=snapshot,
+        snapshot_score=HISTORY_EXPIRED_SCORE,
+    )
+
+
+def build_history_from_store(store, snapshot=None):
+    """
+    Same as `build_history`, but from the rows of a `HistoryStore` as they
+    are packed there, without parsing JSON.
+
+    :param store: `HistoryStore`.
+    :param snapshot: `HistorySnapshot`.
+    """
+    index = HistoryIndex(
+        snapshot=snapshot,
+        snapshot_score=HISTORY_EXPIRED_SCORE,
+        emails=store.emails(),
+    )
+
+    # Rows with the same date are one round
+    rounds = {}
+    for date, members, ends in store.packed_rows():
+        round = HistoryRound.unpack(0, members, ends)
+        if date in rounds:
+            rounds[date].extend(round)
+        else:
+            rounds[date] = round
+
+    for date, round in rounds.items():
+        round.score = convert_date_to_score(date)
+        index.add_packed_round(round)
+
+    return index
+
+
+def transform_history_rows(values):
+    """
+    Turn history rows into previous pairings with a score.  Rows with the
+    same date are one round saved in batches, and are merged.
+
+    :param values: List of `(date, pairs)` rows from the history sheet, with
+        pairs as JSON or already decoded.
+    """
+    rounds = {}
+    for date, pairs in values:
+        try:
+            pairs = json.loads(pairs) if isinstance(pairs, str) else pairs
+            if date not in rounds:
+                rounds[date] = {"score": convert_date_to_score(date), "pairs": []}
+            rounds[date]["pairs"].extend(pairs)
         except json.decoder.JSONDecodeError:
             pass
 
-    return transformed
+    return list(rounds.values())
+
+
+def get_history_store(spreadsheet, cache_directory=None):
+    """
+    Open the local copy of the history of a spreadsheet.
+
+    :param spreadsheet: ID of the spreadsheet.
+    :param cache_directory: Where to keep it, defaults to env var
+        SYNAPSE_CACHE_DIR or HISTORY_CACHE_DIRECTORY.
+    """
+    cache_directory = cache_directory or getenv(
+        "SYNAPSE_CACHE_DIR", HISTORY_CACHE_DIRECTORY
+    )
+
+    from synapse.store import HistoryStore
+
+    return HistoryStore(path.join(cache_directory, f"history-{spreadsheet}.sqlite3"))
+
+
+def is_expired_date(input):
+    """Whether an iso string is older than the decay window."""
+    return (datetime.now() - datetime.fromisoformat(input)).days > (
+        HISTORY_SCORE_MAXIMUM
+    )
 
 
 def convert_date_to_score(input):
@@ -420,72 +2139,55 @@ def convert_date_to_score(input):
     # If after maximum, set to 1 to help push pairing with
     # someone that is a 0, but ok to re-pair
     if score < 0:
-        score = 1
+        score = HISTORY_EXPIRED_SCORE
 
     return score
 
 
-def save_history(pairs):
-    """Save pairing to history spreadsheet."""
-
-    # Get history spreadsheet
-    gspread_client = get_gpread_client()
-    history_spreadsheet = gspread_client.open_by_key(getenv("SYNAPSE_SPREADSHEET"))
-
-    # Get history sheet, make one if not found
-    try:
-        history_sheet = history_spreadsheet.worksheet(HISTORY_SHEET_NAME)
-    except gspread.exceptions.WorksheetNotFound:
-        history_sheet = history_spreadsheet.add_worksheet(
-            title=HISTORY_SHEET_NAME,
-            rows=1000,
-            cols=3,
-        )
-
-        # Add headers
-        history_sheet.append_row(["Date", "Email pairs"])
+def save_history(pairs, spreadsheet=None, date=None):
+    """
+    Save pairing to history spreadsheet, in one request; the history sheet
+    is made, with a header, if not found.
 
-        # Some niceties: Format first row
-        history_sheet.format(
-            "A1:C1",
-            {
-                "backgroundColor": {"red": 50, "green": 50, "blue": 50},
-                "textFormat": {"bold": True},
-            },
-        )
-        history_sheet.freeze(rows=1)
+    :param pairs: List of pairs to save.
+    :param spreadsheet: ID of the spreadsheet, defaults to env var
+        SYNAPSE_SPREADSHEET.
+    :param date: Date of the round, as an ISO string, defaults to now.
+    """
+    backend = SheetBackend(
+        spreadsheet or getenv("SYNAPSE_SPREADSHEET"),
+        open_session=get_spreadsheet_session,
+    )
+    backend.append_history([(date or datetime.now().isoformat(), pairs)])
 
-    # Add new history
-    history_sheet.append_row([datetime.now().isoformat(), json.dumps(pairs)])
 
+def calculate_history_score(pairs, history, backend=None):
+    """
+    Calculate history score for pairs.  Score is based on number of days since last pair.
 
-def calculate_history_score(pairs, history):
-    """Calculate history score for pairs.  Score is based on number of days since last pair."""
+    :param pairs: List of pairs to score.
+    :param history: A `HistoryIndex`, or list of previous pairings; a list is
+        indexed on every call, so prefer passing an index when scoring many times.
+    :param backend: One of SCORING_BACKENDS, defaults to "python".
+    """
 
     if not history or len(history) == 0:
         return 0
 
-    # Go through each pair and determine if found in each history
-    # and assign score base on how long ago it was.
-    total_score = 0
-    for pair in pairs:
-        for sent in history:
-            if has_pair_in_pairs(pair, sent["pairs"]):
-                total_score += sent["score"]
+    if backend == "numpy":
+        return get_vectorized_backend().calculate_history_scores([pairs], history)[0]
 
-    return total_score
+    # Look up each pair in the index and add up the score of every round
+    # it was found in, based on how long ago it was.
+    return build_history_index(history).score(pairs)
 
 
 def has_pair_in_pairs(pair, pairs):
     """Find pair in pairs, where a pair could be a list of two or more emails."""
 
+    pair = set(pair)
     for p in pairs:
-        common_found = 0
-        for email in pair:
-            if email in p:
-                common_found += 1
-
-        if common_found >= 2:
+        if len(pair.intersection(p)) >= 2:
             return True
 
     return False
@@ -495,13 +2197,69 @@ def get_gpread_client():
     """Get Google Spreadsheet client."""
     global global_gpread_client
 
-    if global_gpread_client is None:
-        google_auth_token = get_google_auth_token()
-        global_gpread_client = gspread.service_account_from_dict(google_auth_token)
+    # Rosters can be read from several threads in batch mode; log in once
+    with global_gpread_client_lock:
+        if global_gpread_client is None:
+            import gspread
+
+            google_auth_token = get_google_auth_token()
+            global_gpread_client = gspread.service_account_from_dict(google_auth_token)
 
     return global_gpread_client
 
 
+def get_spreadsheet_session(spreadsheet):
+    """
+    Get a `SpreadsheetSession` for a spreadsheet, opening it only once per run.
+
+    :param spreadsheet: ID of the spreadsheet.
+    """
+    if not spreadsheet:
+        raise Exception(
+            "Spreadsheet not provided via CLI argument or SYNAPSE_SPREADSHEET environment variable."
+        )
+
+    # Rosters can be read from several threads in batch mode; a spreadsheet
+    # is only read from one thread, so it is opened outside the lock
+    with global_spreadsheet_sessions_lock:
+        session = global_spreadsheet_sessions.get(spreadsheet)
+
+    if session is None:
+        session = SpreadsheetSession(
+            get_gpread_client(), spreadsheet, scheduler=get_sheets_scheduler()
+        )
+        with global_spreadsheet_sessions_lock:
+            session = global_spreadsheet_sessions.setdefault(spreadsheet, session)
+
+    return session
+
+
+def get_sheets_scheduler(rate_per_minute=None):
+    """
+    Get the `SheetsScheduler` all Sheets API requests of the run go through,
+    making it the first time.
+
+    :param rate_per_minute: Quota of requests per minute, defaults to env var
+        SYNAPSE_SHEETS_CALLS_PER_MINUTE or SHEETS_CALLS_PER_MINUTE.
+    """
+    global global_sheets_scheduler
+
+    if global_sheets_scheduler is None:
+        global_sheets_scheduler = SheetsScheduler(
+            rate_per_minute=rate_per_minute
+            or float(
+                getenv("SYNAPSE_SHEETS_CALLS_PER_MINUTE", SHEETS_CALLS_PER_MINUTE)
+            ),
+            burst=SHEETS_BURST,
+            retries=SHEETS_RETRIES,
+            cache_seconds=float(
+                getenv("SYNAPSE_SHEETS_CACHE_SECONDS", SHEETS_CACHE_SECONDS)
+            ),
+        )
+
+    return global_sheets_scheduler
+
+
 def get_google_auth_token():
     global global_google_auth_token
 
@@ -523,21 +2281,50 @@ def get_google_auth_token():
     return global_google_auth_token
 
 
-def get_mail_handler():
-    """Create mail handler if needed"""
+def get_mail_handler(rate_per_minute=None, burst=None, connections=None):
+    """
+    Create mail handler if needed; a `Mailer` that sends over a pool of
+    SMTP connections within a rate limit.  Settings are only used when the
+    handler is created, and default to environment variables, then constants.
+
+    :param rate_per_minute: Maximum emails per minute, defaults to env var
+        SYNAPSE_EMAILS_PER_MINUTE or EMAILS_PER_MINUTE.
+    :param burst: Emails that can be sent back to back, defaults to env var
+        SYNAPSE_EMAIL_BURST or EMAIL_BURST.
+    :param connections: Number of SMTP connections, defaults to env var
+        SYNAPSE_MAIL_CONNECTIONS or MAIL_CONNECTIONS.
+    """
     global global_mail_handler
 
     if global_mail_handler is None:
-        global_mail_handler = smtplib.SMTP("smtp.gmail.com", 587)
-        global_mail_handler.ehlo()
-        global_mail_handler.starttls()
-        global_mail_handler.login(
-            getenv("SYNAPSE_GMAIL_USERNAME"), getenv("SYNAPSE_GMAIL_APP_PASSWORD")
+        global_mail_handler = Mailer(
+            connect_mail_server,
+            connections=connections
+            or int(getenv("SYNAPSE_MAIL_CONNECTIONS", MAIL_CONNECTIONS)),
+            rate_per_minute=rate_per_minute
+            or float(getenv("SYNAPSE_EMAILS_PER_MINUTE", EMAILS_PER_MINUTE)),
+            burst=burst or int(getenv("SYNAPSE_EMAIL_BURST", EMAIL_BURST)),
+            retries=MAIL_RETRIES,
         )
 
     return global_mail_handler
 
 
+def connect_mail_server():
+    """Open a new, logged in, SMTP connection."""
+
+    import smtplib
+
+    mail_server = smtplib.SMTP("smtp.gmail.com", 587)
+    mail_server.ehlo()
+    mail_server.starttls()
+    mail_server.login(
+        getenv("SYNAPSE_GMAIL_USERNAME"), getenv("SYNAPSE_GMAIL_APP_PASSWORD")
+    )
+
+    return mail_server
+
+
 def join_names(names):
     """Join names with commas and 'and'"""
 
@@ -0,0 +1,283 @@
+# Dependencies
+import random
+import threading
+from queue import Empty, Queue
+from time import monotonic, sleep
+
+from synapse.metrics import get_metrics
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: up to `burst` calls can go at once, then calls
+    are let through at `rate_per_minute`.  Safe to share between threads.
+    """
+
+    def __init__(self, rate_per_minute, burst=1, clock=monotonic, sleeper=sleep):
+        """
+        :param rate_per_minute: Sustained number of calls allowed per minute.
+        :param burst: Number of calls that can be made back to back.
+        :param clock: Function returning the current time in seconds.
+        :param sleeper: Function to wait a number of seconds.
+        """
+        if rate_per_minute <= 0:
+            raise Exception("Rate limit must be more than 0 per minute.")
+
+        self.rate = rate_per_minute / 60
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleeper = sleeper
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a call is allowed and take a token for it."""
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            self.sleeper(wait)
+
+
+class Mailer:
+    """
+    Sends messages over a small pool of SMTP connections, within a rate limit,
+    retrying transient errors with backoff and reconnecting dropped
+    connections.
+    """
+
+    def __init__(
+        self,
+        connect,
+        connections=1,
+        rate_per_minute=60,
+        burst=1,
+        retries=3,
+        backoff=2,
+        sleeper=sleep,
+    ):
+        """
+        :param connect: Function that returns a new, logged in `smtplib.SMTP`.
+        :param connections: Maximum number of connections to open.
+        :param rate_per_minute: Sustained number of messages per minute.
+        :param burst: Number of messages that can be sent back to back.
+        :param retries: Number of times to retry a transient error.
+        :param backoff: Seconds to wait before the first retry; doubles (with
+            some jitter) for each retry after that.
+        :param sleeper: Function to wait a number of seconds.
+        """
+        self.connect = connect
+        self.connections = max(connections, 1)
+        self.bucket = TokenBucket(rate_per_minute, burst, sleeper=sleeper)
+        self.retries = retries
+        self.backoff = backoff
+        self.sleeper = sleeper
+        self.pool = Queue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.retry_count = 0
+
+    def send(self, from_, to, message):
+        """
+        Send a message.
+
+        :param from_: Email address to send from.
+        :param to: List of email addresses to send to.
+        :param message: The full message, as a string.
+        """
+        attempt = 0
+        while True:
+            # Every attempt is a message sent as far as the server's rate
+            # limit is concerned, including retries
+            self.bucket.acquire()
+
+            connection = None
+            try:
+                connection = self.checkout()
+                refused = connection.sendmail(from_, to, message)
+            except Exception as error:
+                # A connection that had an error is not trusted again
+                if connection is not None:
+                    self.discard(connection)
+
+                if attempt >= self.retries or not is_transient_smtp_error(error):
+                    raise
+            else:
+                self.checkin(connection)
+
+                if not refused:
+                    get_metrics().count("emails sent")
+                    return
+
+                # Some recipients already have the message, so only retry the
+                # others, and only while their refusals are temporary
+                if attempt >= self.retries or not all(
+                    400 <= code < 500 for code, reply in refused.values()
+                ):
+                    raise partially_refused_error(refused)
+
+                to = list(refused)
+
+            with self.lock:
+                self.retry_count += 1
+            get_metrics().count("email retries")
+            self.sleeper(self.backoff * 2**attempt * random.uniform(1, 1.5))
+            attempt += 1
+
+    def send_all(self, messages, on_sent=None, on_failed=None):
+        """
+        Send messages concurrently, one thread per connection.
+
+        :param messages: List of `(from_, to, message)` tuples, as for `send`.
+        :param on_sent: Function called with the position of each message once
+            it is sent, from the thread that sent it.
+        :param on_failed: Function called with the position of a message and
+            the error when the server rejects it for good, see
+            `is_rejected_smtp_error`, instead of raising; other messages are
+            still sent.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def send(i, message):
+            try:
+                self.send(*message)
+            except Exception as error:
+                if on_failed is None or not is_rejected_smtp_error(error):
+                    raise
+
+                get_metrics().count("emails rejected")
+                on_failed(i, error)
+                return
+
+            if on_sent is not None:
+                on_sent(i)
+
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            futures = [
+                executor.submit(send, i, message) for i, message in enumerate(messages)
+            ]
+
+            # Raise the first error, if any, once everything is done
+            for future in futures:
+                future.result()
+
+    def checkout(self):
+        """Get an idle connection, opening a new one if the pool is not full."""
+        while True:
+            with self.lock:
+                try:
+                    return self.pool.get_nowait()
+                except Empty:
+                    pass
+
+                open_new = self.opened < self.connections
+                if open_new:
+                    self.opened += 1
+
+            if open_new:
+                try:
+                    get_metrics().count("smtp connections")
+                    return self.connect()
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+
+            # Wait for a connection to come back, checking again every so
+            # often in case one was closed instead
+            try:
+                return self.pool.get(timeout=1)
+            except Empty:
+                pass
+
+    def checkin(self, connection):
+        """Return a connection to the pool."""
+        self.pool.put(connection)
+
+    def discard(self, connection):
+        """Close a connection and free its place in the pool."""
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+        with self.lock:
+            self.opened -= 1
+
+    def quit(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                connection = self.pool.get_nowait()
+            except Empty:
+                break
+
+            try:
+                connection.quit()
+            except Exception:
+                pass
+
+            with self.lock:
+                self.opened -= 1
+
+
+def is_transient_smtp_error(error):
+    """Whether an error from sending an email is worth retrying."""
+    import smtplib
+
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+
+    # 4xx replies are temporary failures
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500 or error.smtp_code == -1
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, message in error.recipients.values())
+    if isinstance(error, smtplib.SMTPException):
+        return False
+
+    # Network errors
+    return isinstance(error, OSError)
+
+
+def partially_refused_error(refused):
+    """
+    Error for a message the server took for some of its recipients but
+    refused for the others, so it cannot be sent again as a whole.
+
+    :param refused: Dict of refused recipients, as returned by `sendmail`.
+    """
+    import smtplib
+
+    error = smtplib.SMTPRecipientsRefused(refused)
+    error.partial = True
+
+    return error
+
+
+def is_rejected_smtp_error(error):
+    """
+    Whether an error from sending an email means the server will never take
+    that message, like a refused recipient, rather than a problem with the
+    connection or the account that would fail every message.
+    """
+    import smtplib
+
+    # Part of the message was sent, so it must not be sent again either way
+    if getattr(error, "partial", False):
+        return True
+    if is_transient_smtp_error(error):
+        return False
+
+    return isinstance(error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError))
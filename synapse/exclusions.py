@@ -0,0 +1,180 @@
+# Dependencies
+import csv
+import re
+
+# Separators between emails in a cell
+EMAIL_SEPARATOR_PATTERN = re.compile(r"[\s,;]+")
+
+
+class ExclusionIndex:
+    """
+    Pairs of people who must never be grouped together, like a manager and
+    their report.  Each person has a bitset of the people they exclude, as a
+    Python integer with one bit per person id, so the people a whole group
+    excludes is the OR of its members' bitsets, and checking someone against
+    a group is a single bit test.
+    """
+
+    def __init__(self, pairs=None):
+        """
+        :param pairs: Iterable of `(email, email)` pairs to exclude.
+        """
+        self.ids = {}
+        self.masks = []
+        self.degrees = []
+        self.count = 0
+
+        for a, b in pairs or []:
+            self.add(a, b)
+
+    def __len__(self):
+        """Number of excluded pairs."""
+        return self.count
+
+    def intern(self, email):
+        email_id = self.ids.get(email)
+        if email_id is None:
+            email_id = len(self.masks)
+            self.ids[email] = email_id
+            self.masks.append(0)
+            self.degrees.append(0)
+
+        return email_id
+
+    def add(self, a, b):
+        """Exclude a pair; excluding someone from themselves does nothing."""
+        if a == b:
+            return
+
+        a = self.intern(a)
+        b = self.intern(b)
+        if not self.masks[a] >> b & 1:
+            self.masks[a] |= 1 << b
+            self.masks[b] |= 1 << a
+            self.degrees[a] += 1
+            self.degrees[b] += 1
+            self.count += 1
+
+    def mask(self, email):
+        """Bitset of the people an email excludes."""
+        email_id = self.ids.get(email)
+        return self.masks[email_id] if email_id is not None else 0
+
+    def degree(self, email):
+        """Number of people an email excludes."""
+        email_id = self.ids.get(email)
+        return self.degrees[email_id] if email_id is not None else 0
+
+    def blocks(self, mask, email):
+        """Whether a bitset, like the OR of a group's masks, excludes an email."""
+        email_id = self.ids.get(email)
+        return email_id is not None and mask >> email_id & 1 == 1
+
+    def allows(self, group):
+        """Whether no two members of a group exclude each other."""
+        mask = 0
+        for email in group:
+            if self.blocks(mask, email):
+                return False
+            mask |= self.mask(email)
+
+        return True
+
+    def pairs(self):
+        """Yield each excluded pair once, as emails."""
+        emails = list(self.ids)
+        for a, mask in enumerate(self.masks):
+            b = a + 1
+            mask >>= b
+            while mask:
+                if mask & 1:
+                    yield (emails[a], emails[b])
+                mask >>= 1
+                b += 1
+
+    def check(self, emails):
+        """
+        Raise if someone excludes everyone else in a roster, in which case no
+        grouping can be valid.
+
+        :param emails: List of emails in the roster.
+        """
+        roster = 0
+        for email in emails:
+            email_id = self.ids.get(email)
+            if email_id is not None:
+                roster |= 1 << email_id
+
+        for email in emails:
+            excluded = bin(self.mask(email) & roster).count("1")
+            if excluded and excluded >= len(emails) - 1:
+                raise Exception(
+                    f"No valid pairing exists: {email} excludes everyone else in the roster."
+                )
+
+
+def parse_exclusion_cell(value):
+    """Emails in a cell, separated by commas, semicolons or spaces."""
+    return [
+        email.lower()
+        for email in EMAIL_SEPARATOR_PATTERN.split(value or "")
+        if email.strip()
+    ]
+
+
+def read_exclusion_file(filename):
+    """
+    Read exclusions from a CSV file, where the first email of each row must
+    not be grouped with any of the others on it, like a manager and their
+    reports; the others can still be grouped with each other, the same as
+    with `exclusions_from_rows`.  Cells can hold several emails, and cells
+    without an `@` are ignored, like a header.
+
+    :returns: `ExclusionIndex`.
+    """
+    exclusions = ExclusionIndex()
+    with open(filename, "r", newline="") as f:
+        for row in csv.reader(f):
+            emails = [
+                email
+                for cell in row
+                for email in parse_exclusion_cell(cell)
+                if "@" in email
+            ]
+            for other in emails[1:]:
+                exclusions.add(emails[0], other)
+
+    return exclusions
+
+
+def exclusions_from_rows(rows, exclusions=None):
+    """
+    Add exclusions from roster rows, where a column next to each email lists
+    the people it must not be grouped with.
+
+    :param rows: Iterable of `(email, cell)` tuples.
+    :param exclusions: `ExclusionIndex` to add to, or None for a new one.
+    :returns: `ExclusionIndex`.
+    """
+    exclusions = exclusions if exclusions is not None else ExclusionIndex()
+    for email, cell in rows:
+        email = (email or "").strip().lower()
+        if "@" not in email:
+            continue
+
+        for other in parse_exclusion_cell(cell):
+            if "@" in other:
+                exclusions.add(email, other)
+
+    return exclusions
+
+
+def column_index(column):
+    """Position of a column from its letters, like 0 for A and 27 for AB."""
+    index = 0
+    for letter in column.strip().upper():
+        if not "A" <= letter <= "Z":
+            raise Exception(f"Column '{column}' should be letters, like B.")
+        index = index * 26 + ord(letter) - ord("A") + 1
+
+    return index - 1
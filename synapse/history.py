@@ -0,0 +1,467 @@
+# Dependencies
+from array import array
+from itertools import combinations
+
+
+class HistoryRound:
+    """
+    A round of pairings, packed as integer ids: everyone in the round, group
+    after group, and the position where each group ends.
+    """
+
+    __slots__ = ("score", "members", "ends")
+
+    def __init__(self, score, members=None, ends=None):
+        """
+        :param score: Score of the round.
+        :param members: `array("I")` of ids, group after group.
+        :param ends: `array("I")` of where each group ends in `members`.
+        """
+        self.score = score
+        self.members = members if members is not None else array("I")
+        self.ends = ends if ends is not None else array("I")
+
+    def add_group(self, ids):
+        """Add a group of ids."""
+        self.members.extend(ids)
+        self.ends.append(len(self.members))
+
+    def extend(self, other):
+        """Add the groups of another round, like one saved in batches."""
+        offset = len(self.members)
+        self.members.extend(other.members)
+        self.ends.extend(end + offset for end in other.ends)
+
+    def groups(self):
+        """Yield each group, as an array of ids."""
+        start = 0
+        for end in self.ends:
+            yield self.members[start:end]
+            start = end
+
+    def pack(self):
+        """The round as `(members, ends)` bytes, without its score."""
+        return (self.members.tobytes(), self.ends.tobytes())
+
+    @classmethod
+    def unpack(cls, score, members, ends):
+        """Make a round from `pack` output."""
+        round = cls(score)
+        round.members.frombytes(members)
+        round.ends.frombytes(ends)
+
+        return round
+
+
+class HistoryIndex:
+    """
+    Precomputed lookup of previous pairings, keyed by unordered email pair.
+
+    Building the index walks the history once; afterwards scoring a group is
+    a handful of dictionary lookups instead of a scan of every round.  Emails
+    are interned to integer ids, and pairs are keyed by a single integer, so
+    a long history takes few Python objects.
+    """
+
+    def __init__(self, history=None, snapshot=None, snapshot_score=1, emails=None):
+        """
+        :param history: List of previous pairings in the form of
+            `{"score": 100, "pairs": [["a@b.c", "d@e.f"], ...]}`.
+        :param snapshot: `HistorySnapshot` of older rounds, which all have the
+            same score.
+        :param snapshot_score: Score of each round in the snapshot.
+        :param emails: List of emails to intern first, so that their ids are
+            their positions, for adding rounds packed with those ids.
+        """
+        # Email <-> id
+        self.emails = []
+        self.email_ids = {}
+        for email in emails or []:
+            self.intern(email)
+
+        # Score of each round, by round index
+        self.round_scores = []
+
+        # Pair key -> round index the pair was grouped in, or an array of
+        # them if more than one
+        self.pair_rounds = {}
+
+        # Pair key -> accumulated score across those rounds, and the snapshot
+        self.pair_scores = {}
+
+        # Snapshot rounds, and its groups of more than two by member id
+        self.snapshot_rounds = 0
+        self.snapshot_pair_scores = {}
+        self.snapshot_groups = {}
+
+        # Round index -> pair keys, and rounds whose score can still change,
+        # only kept once rounds are aged
+        self.round_pairs = None
+        self.live_rounds = None
+
+        for sent in history or []:
+            self.add_round(sent["pairs"], sent["score"])
+
+        if snapshot is not None:
+            self.add_snapshot(snapshot, snapshot_score)
+
+    def __len__(self):
+        return len(self.round_scores) + self.snapshot_rounds
+
+    def intern(self, email):
+        """Id of an email, giving it one if new."""
+        email_id = self.email_ids.get(email)
+        if email_id is None:
+            email_id = len(self.emails)
+            self.email_ids[email] = email_id
+            self.emails.append(email)
+
+        return email_id
+
+    def pack_round(self, pairs, score):
+        """Make a `HistoryRound` from a list of pairs (or larger groups)."""
+        round = HistoryRound(score)
+        for group in pairs:
+            round.add_group(self.intern(email) for email in group)
+
+        return round
+
+    def add_round(self, pairs, score):
+        """
+        Add a round of pairings to the index.
+
+        :param pairs: List of pairs (or larger groups) from the round.
+        :param score: Score of the round.
+        """
+        self.add_packed_round(self.pack_round(pairs, score))
+
+    def add_packed_round(self, round):
+        """
+        Add a `HistoryRound` to the index; its ids must be from this index.
+        """
+        round_index = len(self.round_scores)
+        self.round_scores.append(round.score)
+        if self.round_pairs is not None:
+            self.round_pairs.append(array("Q"))
+            self.live_rounds.append(round_index)
+
+        for group in round.groups():
+            for a, b in combinations(set(group), 2):
+                key = id_pair_key(a, b)
+                rounds = self.pair_rounds.get(key)
+
+                # A pair only counts once per round, even if the round
+                # somehow has it in more than one group; rounds are added in
+                # order, so only the last one needs checking
+                if rounds is None:
+                    self.pair_rounds[key] = round_index
+                elif isinstance(rounds, int):
+                    if rounds == round_index:
+                        continue
+                    self.pair_rounds[key] = array("I", (rounds, round_index))
+                elif rounds[-1] == round_index:
+                    continue
+                else:
+                    rounds.append(round_index)
+
+                self.pair_scores[key] = self.pair_scores.get(key, 0) + round.score
+                if self.round_pairs is not None:
+                    self.round_pairs[round_index].append(key)
+
+    def add_snapshot(self, snapshot, score):
+        """
+        Add the rounds of a `HistorySnapshot` to the index.
+
+        :param snapshot: `HistorySnapshot` of rounds.
+        :param score: Score of each of its rounds.
+        """
+        self.snapshot_rounds += snapshot.rounds
+
+        for (a, b), count in snapshot.pair_counts.items():
+            key = id_pair_key(self.intern(a), self.intern(b))
+            self.pair_scores[key] = self.pair_scores.get(key, 0) + count * score
+            self.snapshot_pair_scores[key] = (
+                self.snapshot_pair_scores.get(key, 0) + count * score
+            )
+
+        for group, count in snapshot.group_counts.items():
+            ids = frozenset(self.intern(email) for email in group)
+            for email_id in ids:
+                self.snapshot_groups.setdefault(email_id, []).append(
+                    (ids, count * score)
+                )
+
+    def age(self, days, expired_score=1):
+        """
+        Age every round by some days.  Scores are the days left in the decay
+        window, so the score of each round goes down by `days`, and becomes
+        `expired_score` once it is below zero, like `convert_date_to_score`.
+
+        Pair scores are changed by how much the score of each of their rounds
+        changed, instead of building the index again, and expired rounds are
+        not visited again.  Snapshot rounds are already expired, and so are
+        rounds that already score `expired_score`, whose age is no longer
+        known, so aging by negative days does not bring them back.
+
+        :param days: Days to age by; can be negative, to score rounds as if
+            the decay window were longer.
+        :param expired_score: Score of rounds past the decay window.
+        """
+        if self.round_pairs is None:
+            self.round_pairs = [array("Q") for score in self.round_scores]
+            for key, rounds in self.pair_rounds.items():
+                for r in (rounds,) if isinstance(rounds, int) else rounds:
+                    self.round_pairs[r].append(key)
+            self.live_rounds = [
+                r for r, score in enumerate(self.round_scores) if score != expired_score
+            ]
+
+        live_rounds = []
+        for r in self.live_rounds:
+            score = self.round_scores[r] - days
+            if score < 0:
+                score = expired_score
+            else:
+                live_rounds.append(r)
+
+            change = score - self.round_scores[r]
+            if change:
+                self.round_scores[r] = score
+                for key in self.round_pairs[r]:
+                    self.pair_scores[key] += change
+
+        self.live_rounds = live_rounds
+
+    def fingerprint(self):
+        """
+        Hash of the rounds in the index, but not of their scores, which change
+        as the rounds age, so the same history has the same fingerprint on
+        any day.
+        """
+        import hashlib
+
+        digest = hashlib.sha256()
+        digest.update("\n".join(self.emails).encode("utf-8"))
+        digest.update(array("Q", (len(self.round_scores), self.snapshot_rounds)))
+
+        # Pairs, then the rounds of each, with a separator after each pair
+        digest.update(array("Q", self.pair_rounds))
+        rounds = array("I")
+        for value in self.pair_rounds.values():
+            if isinstance(value, int):
+                rounds.append(value)
+            else:
+                rounds.extend(value)
+            rounds.append(0xFFFFFFFF)
+        digest.update(rounds)
+
+        digest.update(array("Q", self.snapshot_pair_scores))
+        digest.update(array("Q", self.snapshot_pair_scores.values()))
+
+        # Groups of snapshot rounds, once each, with a separator after each
+        groups = array("Q")
+        for email_id in sorted(self.snapshot_groups):
+            for ids, score in self.snapshot_groups[email_id]:
+                if email_id == min(ids):
+                    groups.extend(sorted(ids))
+                    groups.extend((score, 0xFFFFFFFFFFFFFFFF))
+        digest.update(groups)
+
+        return digest.hexdigest()
+
+    def pair_score(self, a, b):
+        """Accumulated score for two emails having been grouped together."""
+        a = self.email_ids.get(a)
+        b = self.email_ids.get(b)
+        if a is None or b is None:
+            return 0
+
+        return self.pair_scores.get(id_pair_key(a, b), 0)
+
+    def last_round_score(self, a, b):
+        """
+        Score of the latest round two emails were grouped in, or None if they
+        never were, apart from in the snapshot.
+        """
+        a = self.email_ids.get(a)
+        b = self.email_ids.get(b)
+        if a is None or b is None:
+            return None
+
+        rounds = self.pair_rounds.get(id_pair_key(a, b))
+        if rounds is None:
+            return None
+
+        return self.round_scores[rounds if isinstance(rounds, int) else rounds[-1]]
+
+    def pair_score_items(self):
+        """Yield `(email, email, score)` for every pair with history."""
+        for key, score in self.pair_scores.items():
+            yield (self.emails[key >> 32], self.emails[key & 0xFFFFFFFF], score)
+
+    def group_score(self, group):
+        """
+        Score for a group, matching `has_pair_in_pairs`: a round counts once if
+        any two members of the group were grouped together in it.
+        """
+        if len(group) == 2:
+            return self.pair_score(group[0], group[1])
+
+        ids = [self.email_ids.get(email) for email in group]
+        ids = [email_id for email_id in ids if email_id is not None]
+
+        rounds = set()
+        snapshot_score = 0
+        for a, b in combinations(ids, 2):
+            key = id_pair_key(a, b)
+            snapshot_score += self.snapshot_pair_scores.get(key, 0)
+
+            pair_rounds = self.pair_rounds.get(key)
+            if isinstance(pair_rounds, int):
+                rounds.add(pair_rounds)
+            elif pair_rounds is not None:
+                rounds.update(pair_rounds)
+
+        # Snapshot rounds are only counted by pair, so a snapshot group with
+        # more than one pair of this group was counted once for each of them.
+        # That makes the score exact for groups of up to three, which is all
+        # the matchers make; a larger group could also have two separate pairs
+        # in the same snapshot round, and would count that round twice.
+        if snapshot_score:
+            members = set(ids)
+            overlapping = {
+                snapshot_group: score
+                for email_id in members
+                for snapshot_group, score in self.snapshot_groups.get(email_id, ())
+            }
+            for snapshot_group, score in overlapping.items():
+                shared = len(members & snapshot_group)
+                if shared > 2:
+                    snapshot_score -= score * (shared * (shared - 1) // 2 - 1)
+
+        return sum(self.round_scores[r] for r in rounds) + snapshot_score
+
+    def pairwise_score(self, group):
+        """
+        Score for a group as the sum of the scores of each pair in it.  Unlike
+        `group_score`, a round in which several pairs of the group were
+        grouped counts once for each of them, so larger groups are scored
+        with one lookup per pair, however long the history.
+        """
+        ids = [self.email_ids.get(email) for email in group]
+        ids = [email_id for email_id in ids if email_id is not None]
+        pair_scores = self.pair_scores
+
+        score = 0
+        for x in range(1, len(ids)):
+            b = ids[x]
+            for a in ids[:x]:
+                score += pair_scores.get(id_pair_key(a, b), 0)
+
+        return score
+
+    def member_score(self, email, others):
+        """Sum of the scores of an email with each of some others."""
+        a = self.email_ids.get(email)
+        if a is None:
+            return 0
+
+        score = 0
+        for other in others:
+            b = self.email_ids.get(other)
+            if b is not None and b != a:
+                score += self.pair_scores.get(id_pair_key(a, b), 0)
+
+        return score
+
+    def score(self, pairs, pairwise=False):
+        """
+        Total score for a list of pairs (or larger groups).
+
+        :param pairwise: Score each group as the sum of its pairs, see
+            `pairwise_score`, instead of with `group_score`.
+        """
+        if pairwise:
+            return sum(self.pairwise_score(group) for group in pairs)
+
+        return sum(self.group_score(group) for group in pairs)
+
+
+class HistorySnapshot:
+    """
+    Aggregate of rounds that all have the same score, like rounds older than
+    the decay window: how many rounds each pair was grouped in, and how many
+    rounds each group of more than two was together in.  That is all that is
+    needed to score them, so the rounds themselves can be dropped.
+    """
+
+    def __init__(self, rounds=0, pair_counts=None, group_counts=None):
+        """
+        :param rounds: Number of rounds in the snapshot.
+        :param pair_counts: Dict of unordered pair -> number of rounds.
+        :param group_counts: Dict of frozenset of emails -> number of rounds,
+            for groups of more than two.
+        """
+        self.rounds = rounds
+        self.pair_counts = pair_counts or {}
+        self.group_counts = group_counts or {}
+
+    def add_round(self, pairs):
+        """
+        Add a round of pairings.
+
+        :param pairs: List of pairs (or larger groups) from the round.
+        """
+        self.rounds += 1
+
+        # A pair only counts once per round, like in `HistoryIndex`
+        groups = set(frozenset(group) for group in pairs)
+        for key in set(
+            pair_key(a, b) for group in groups for a, b in combinations(group, 2)
+        ):
+            self.pair_counts[key] = self.pair_counts.get(key, 0) + 1
+
+        for group in groups:
+            if len(group) > 2:
+                self.group_counts[group] = self.group_counts.get(group, 0) + 1
+
+    def as_dict(self):
+        """The snapshot, as a dict that can be dumped as JSON."""
+        return {
+            "rounds": self.rounds,
+            "pairs": [[a, b, count] for (a, b), count in self.pair_counts.items()],
+            "groups": [
+                [sorted(group), count] for group, count in self.group_counts.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        """Make a snapshot from `as_dict` output."""
+        return cls(
+            rounds=values["rounds"],
+            pair_counts={(a, b): count for a, b, count in values["pairs"]},
+            group_counts={frozenset(group): count for group, count in values["groups"]},
+        )
+
+
+def build_history_index(history):
+    """
+    Get an index for history, building it if needed.
+
+    :param history: A `HistoryIndex`, or a list of previous pairings.
+    """
+    if isinstance(history, HistoryIndex):
+        return history
+
+    return HistoryIndex(history)
+
+
+def pair_key(a, b):
+    """Key for an unordered pair of emails."""
+    return (a, b) if a < b else (b, a)
+
+
+def id_pair_key(a, b):
+    """Key for an unordered pair of email ids, as a single integer."""
+    return (a << 32) | b if a < b else (b << 32) | a
@@ -0,0 +1,125 @@
+# Dependencies
+import json
+import threading
+from os import fsync, makedirs, path, remove
+
+
+class SendJournal:
+    """
+    Write-ahead journal of a round: the pairing is written before any email
+    is sent, then each pair is marked once its email is sent and once it is
+    saved to history.  Every entry is flushed to disk before going on, so an
+    interrupted round can be resumed without sending anything twice.  A pair
+    whose email the mail server rejected for good is marked as failed, and is
+    not sent again.
+
+    The journal is a JSON Lines file, one entry per line; a partly written
+    last line, from a crash while writing it, is ignored.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: Path to the journal; read if it exists.
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.roster = None
+        self.date = None
+        self.pairs = []
+        self.sent = set()
+        self.saved = set()
+        self.failed = set()
+
+        # A partly written last line is ended before writing after it
+        self.partial = False
+
+        if path.exists(filename):
+            with open(filename, "r") as f:
+                for line in f:
+                    self.partial = not line.endswith("\n")
+                    try:
+                        self.apply(json.loads(line))
+                    except json.decoder.JSONDecodeError:
+                        pass
+
+    def apply(self, entry):
+        if entry["type"] == "round":
+            self.roster = entry["roster"]
+            self.date = entry["date"]
+            self.pairs = entry["pairs"]
+            self.sent = set()
+            self.saved = set()
+            self.failed = set()
+        elif entry["type"] == "sent":
+            self.sent.add(entry["pair"])
+        elif entry["type"] == "failed":
+            self.failed.add(entry["pair"])
+        elif entry["type"] == "saved":
+            self.saved.update(entry["pairs"])
+
+    def write(self, entry):
+        with self.lock:
+            directory = path.dirname(self.filename)
+            if directory:
+                makedirs(directory, exist_ok=True)
+
+            with open(self.filename, "a") as f:
+                f.write(("\n" if self.partial else "") + json.dumps(entry) + "\n")
+                f.flush()
+                fsync(f.fileno())
+            self.partial = False
+
+            self.apply(entry)
+
+    def start(self, roster, date, pairs):
+        """
+        Record a new round, replacing any previous one.
+
+        :param roster: URI of the roster the round is for.
+        :param date: Date of the round, as an ISO string.
+        :param pairs: List of pairs to send emails to.
+        """
+        self.finish()
+        self.write({"type": "round", "roster": roster, "date": date, "pairs": pairs})
+
+    def mark_sent(self, index):
+        """Record that the email for pair `index` was sent."""
+        self.write({"type": "sent", "pair": index})
+
+    def mark_failed(self, index):
+        """Record that the email for pair `index` was rejected for good."""
+        self.write({"type": "failed", "pair": index})
+
+    def mark_saved(self, indexes):
+        """Record that pairs were saved to history."""
+        self.write({"type": "saved", "pairs": list(indexes)})
+
+    def pending(self):
+        """Indexes of pairs whose email is not sent yet, nor rejected."""
+        return [
+            i
+            for i in range(len(self.pairs))
+            if i not in self.sent and i not in self.failed
+        ]
+
+    def unsaved(self):
+        """Indexes of pairs whose email was sent but are not saved to history."""
+        return sorted(self.sent - self.saved)
+
+    def is_finished(self):
+        """Whether there is no round, or everything in it was sent and saved."""
+        return not self.pending() and not self.unsaved()
+
+    def finish(self):
+        """Remove the journal."""
+        with self.lock:
+            if path.exists(self.filename):
+                remove(self.filename)
+
+            self.roster = None
+            self.date = None
+            self.pairs = []
+            self.sent = set()
+            self.saved = set()
+            self.failed = set()
+            self.partial = False
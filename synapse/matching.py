@@ -0,0 +1,1081 @@
+# Dependencies
+import heapq
+from math import exp
+from random import Random
+from time import perf_counter
+
+from synapse.blossom import max_weight_matching
+from synapse.history import build_history_index
+from synapse.metrics import get_metrics, timed
+
+
+# Rosters up to this size are matched on the complete graph; larger rosters
+# start from a sparse random graph that is grown until the matching is
+# provably optimal on the complete graph.
+OPTIMAL_DENSE_LIMIT = 200
+OPTIMAL_SPARSE_NEIGHBOURS = 8
+
+# Default number of swaps tried by the local search
+LOCAL_SEARCH_ITERATIONS = 20000
+
+# Default size of groups; larger groups are scored as the sum of their pairs
+GROUP_SIZE = 2
+
+# Times the local search tries to build a starting pairing around exclusions
+EXCLUSION_ATTEMPTS = 1000
+
+# Default number of random pairings sampled by the random matcher
+EMAIL_MATCH_PERMUTATIONS = 20000
+
+# Most distinct pairings that can be kept, see `pair_emails_alternatives`
+ALTERNATIVES_MAXIMUM = 20
+
+EMAIL_MATCHERS = ["random", "optimal", "anneal"]
+SCORING_BACKENDS = ["python", "numpy"]
+
+
+class SearchBudget:
+    """
+    When a search stops: after a number of steps, once some time has passed,
+    or once its best score is as low as a target, whichever comes first.  A
+    search with no limit on steps or time runs until it reaches the target.
+    """
+
+    def __init__(self, steps=None, seconds=None, target_score=0):
+        """
+        :param steps: Number of steps, or None for no limit.
+        :param seconds: Seconds from now, or None for no limit.
+        :param target_score: Score that is good enough; a score of 0 can not
+            be improved on, so searches stop there anyway.
+        """
+        self.steps = steps
+        self.seconds = seconds
+        self.started = perf_counter()
+        self.target_score = target_score if target_score is not None else 0
+
+    @classmethod
+    def for_samples(cls, sample_count, seconds=None, target_score=0):
+        """
+        Budget for sampling: at least one sample, and no limit on samples
+        only when there is a limit on time.
+        """
+        if sample_count is not None or seconds is None:
+            sample_count = max(sample_count or 0, 1)
+
+        return cls(sample_count, seconds, target_score)
+
+    def is_done(self, steps, best_score):
+        """Whether to stop, after some steps with the best score so far."""
+        if best_score is not None and best_score <= self.target_score:
+            return True
+        if self.steps is not None and steps >= self.steps:
+            return True
+
+        return (
+            self.seconds is not None and perf_counter() - self.started >= self.seconds
+        )
+
+    def fraction(self, steps):
+        """How much of the budget is spent, from 0 to 1."""
+        spent = 0
+        if self.steps:
+            spent = steps / self.steps
+        if self.seconds:
+            spent = max(spent, (perf_counter() - self.started) / self.seconds)
+
+        return min(spent, 1)
+
+
+class TopPairings:
+    """
+    The best few distinct pairings of a search, kept in a heap with the worst
+    of them on top, so a pairing that is not good enough is turned away with
+    one comparison, and memory stays the same however many are tried.  Of
+    pairings with the same score, the first is kept, like a stable sort.
+    """
+
+    def __init__(self, size=1):
+        """
+        :param size: Number of pairings to keep.
+        """
+        self.size = max(size, 1)
+        self.heap = []
+        self.keys = set()
+        self.order = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def bound(self):
+        """Score a pairing must beat to be kept, or None if there is room."""
+        return -self.heap[0][0] if len(self.heap) >= self.size else None
+
+    def would_keep(self, score):
+        """Whether a pairing with a score would be kept, if distinct."""
+        bound = self.bound()
+        return bound is None or score < bound
+
+    def push(self, score, pairs):
+        """
+        Offer a pairing, keeping it if it is among the best; the same pairing
+        in another order is only kept once.
+
+        :returns: Whether it was kept.
+        """
+        self.order += 1
+        if not self.would_keep(score):
+            return False
+
+        key = None
+        if self.size > 1:
+            key = tuple(sorted(tuple(sorted(pair)) for pair in pairs))
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+
+        entry = (-score, -self.order, pairs, key)
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, entry)
+        else:
+            removed = heapq.heapreplace(self.heap, entry)
+            self.keys.discard(removed[3])
+
+        return True
+
+    def pairings(self):
+        """Pairings kept, as `(score, pairs)` tuples, best first."""
+        return [
+            (-score, pairs)
+            for score, order, pairs, key in sorted(self.heap, reverse=True)
+        ]
+
+
+def pair_emails(emails, **options):
+    """
+    Pair emails together with the best pairing found.
+
+    :param emails: List of emails to pair.
+    :param options: Other arguments for `pair_emails_alternatives`.
+    :returns: Tuple of `(score, pairs)`.
+    """
+    return pair_emails_alternatives(emails, **options)[0]
+
+
+@timed("pair emails")
+def pair_emails_alternatives(
+    emails,
+    history=None,
+    sample_count=None,
+    matcher=None,
+    seed=None,
+    workers=None,
+    backend=None,
+    executor=None,
+    group_size=None,
+    exclusions=None,
+    time_budget=None,
+    target_score=None,
+    alternatives=1,
+):
+    """
+    Pair emails together, keeping this many of the best distinct pairings;
+    only random sampling finds more than one.
+
+    :param emails: List of emails to pair.
+    :param history: `HistoryIndex` or list of previous pairings to avoid.
+    :param sample_count: Number of pair permutations to make to try to
+        find the most optimal; if not provided uses EMAIL_MATCH_PERMUTATIONS
+        constant.
+    :param matcher: One of EMAIL_MATCHERS; "random" (default) keeps the best of
+        `sample_count` random pairings, "optimal" finds the pairing with the
+        lowest possible score, and "anneal" improves a random pairing by
+        trying `sample_count` swaps.
+    :param seed: Seed for the random number generator, to reproduce a pairing.
+    :param workers: Number of processes to split random samples across; each
+        uses its own generator seeded from `seed`, so the same seed and number
+        of workers give the same pairing.
+    :param backend: One of SCORING_BACKENDS; "numpy" generates and scores
+        random pairings in batches, and gives the same scores as "python"
+        (default).
+    :param executor: Process pool to split random samples across, shared
+        between pairings; see `match_random_parallel`.
+    :param group_size: Make groups of this many emails instead of pairs, with
+        leftover emails added one each to groups; groups of more than two are
+        scored as the sum of the history scores of their pairs.  Defaults to
+        GROUP_SIZE.
+    :param exclusions: `ExclusionIndex` of people who must never be grouped
+        together; pairings are built around them instead of being filtered
+        afterwards.  The numpy backend samples with the python backend when
+        there are any.
+    :param time_budget: Seconds to search for, instead of a fixed number of
+        samples or swaps unless `sample_count` is also given, returning the
+        best pairing found when they are up; the optimal matcher ignores it.
+        With workers, each worker searches for this long.
+    :param target_score: Stop searching once a pairing scores this or less;
+        searches always stop at 0, as nothing scores lower.
+    :param alternatives: Number of the best distinct pairings to keep, up to
+        ALTERNATIVES_MAXIMUM.
+    :returns: List of `(score, pairs)` tuples, best first.
+    """
+
+    # Don't do anything if only one or less emails
+    if len(emails) < 2:
+        return [(0, [])]
+
+    if not 1 <= alternatives <= ALTERNATIVES_MAXIMUM:
+        raise Exception(
+            f"Alternatives should be between 1 and {ALTERNATIVES_MAXIMUM}, not {alternatives}."
+        )
+
+    group_size = group_size or GROUP_SIZE
+    if group_size < 2:
+        raise Exception(f"Groups need at least 2 people, not {group_size}.")
+
+    # Fail early if someone can not be grouped with anyone
+    if exclusions:
+        exclusions.check(emails)
+    else:
+        exclusions = None
+
+    # Other matchers
+    if matcher == "optimal":
+        if group_size != 2:
+            raise Exception(
+                "The optimal matcher only makes pairs; use the random or anneal matcher for larger groups."
+            )
+        return [
+            match_optimal(emails, history=history, seed=seed, exclusions=exclusions)
+        ]
+    elif matcher == "anneal":
+        pairing = match_local_search(
+            emails,
+            history=history,
+            iterations=sample_count,
+            seed=seed,
+            group_size=group_size,
+            exclusions=exclusions,
+            time_budget=time_budget,
+            target_score=target_score,
+        )
+        return [pairing]
+    elif matcher not in (None, "random"):
+        raise Exception(f"Unknown matcher '{matcher}'; use one of {EMAIL_MATCHERS}.")
+
+    # Sample count, unlimited when searching for a time instead
+    if sample_count is None and time_budget is None:
+        sample_count = EMAIL_MATCH_PERMUTATIONS
+
+    # Random samples, scored one by one or in batches
+    sampler = match_random_alternatives
+    if backend == "numpy":
+        sampler = get_vectorized_backend().match_random_numpy_alternatives
+    elif backend not in (None, "python"):
+        raise Exception(f"Unknown backend '{backend}'; use one of {SCORING_BACKENDS}.")
+
+    # Split samples across processes
+    if workers is not None and workers > 1:
+        return match_random_parallel_alternatives(
+            emails,
+            history=history,
+            sample_count=sample_count,
+            seed=seed,
+            workers=workers,
+            sampler=sampler,
+            executor=executor,
+            group_size=group_size,
+            exclusions=exclusions,
+            time_budget=time_budget,
+            target_score=target_score,
+            alternatives=alternatives,
+        )
+
+    return sampler(
+        emails,
+        history=history,
+        sample_count=sample_count,
+        seed=seed,
+        group_size=group_size,
+        exclusions=exclusions,
+        time_budget=time_budget,
+        target_score=target_score,
+        alternatives=alternatives,
+    )
+
+
+def get_vectorized_backend():
+    """Get the NumPy backend module, which is only imported when used."""
+
+    try:
+        from synapse import vectorized
+    except ImportError:
+        raise Exception(
+            "The numpy backend needs NumPy. Please install it, for instance with `poetry install --extras numpy`."
+        )
+
+    return vectorized
+
+
+def match_random(
+    emails,
+    history=None,
+    sample_count=1,
+    seed=None,
+    group_size=None,
+    exclusions=None,
+    time_budget=None,
+    target_score=0,
+):
+    """
+    Pair emails by making random pairings and keeping the one with the lowest
+    score.
+
+    :param emails: List of emails to pair.
+    :param history: `HistoryIndex` or list of previous pairings to avoid.
+    :param sample_count: Number of random pairings to make, or None for no
+        limit with a time budget.
+    :param seed: Seed for the random number generator.
+    :param group_size: Make groups of this size instead of pairs, see
+        `split_groups`; they are scored as the sum of their pairs.
+    :param exclusions: `ExclusionIndex` of pairs that must not be grouped;
+        pairings are built around them, see `build_groups`, and samples that
+        can not be completed are skipped.
+    :param time_budget: Seconds to keep sampling for, at most; the best
+        pairing so far is returned when they are up.
+    :param target_score: Stop sampling once a pairing scores this or less.
+    :returns: Tuple of `(score, pairs)`.
+    """
+    return match_random_alternatives(
+        emails,
+        history,
+        sample_count,
+        seed,
+        group_size,
+        exclusions,
+        time_budget,
+        target_score,
+    )[0]
+
+
+def match_random_alternatives(
+    emails,
+    history=None,
+    sample_count=1,
+    seed=None,
+    group_size=None,
+    exclusions=None,
+    time_budget=None,
+    target_score=0,
+    alternatives=1,
+):
+    """
+    Same as `match_random`, but keeping this many of the best distinct
+    pairings; sampling then stops once they all score the target or less.
+
+    :param alternatives: Number of the best distinct pairings to keep.
+    :returns: List of `(score, pairs)` tuples, best first.
+    """
+
+    if len(emails) < 2:
+        return [(0, [])]
+
+    group_size = group_size or GROUP_SIZE
+    budget = SearchBudget.for_samples(sample_count, time_budget, target_score)
+    top = TopPairings(alternatives)
+    if exclusions:
+        match_random_excluding(
+            emails, history, seed, group_size, exclusions, budget, top
+        )
+        return top.pairings()
+
+    # Index history once so each sample is cheap to score
+    index = build_history_index(history)
+
+    # Make samples of pairs to try to avoid matching people up with
+    # the sample people recently
+    rng = Random(seed)
+    metrics = get_metrics()
+    samples = 0
+    best_score = None
+    while not budget.is_done(samples, top.bound()):
+        samples += 1
+
+        # Shuffle emails to be able to pair
+        shuffled = emails.copy()
+        rng.shuffle(shuffled)
+
+        # Larger groups
+        if group_size != 2:
+            pairs = split_groups(shuffled, group_size)
+            score = index.score(pairs, pairwise=True)
+            top.push(score, pairs)
+            if best_score is None or score < best_score:
+                best_score = score
+                metrics.record("best score", score)
+            continue
+
+        # Place to store pairs
+        pairs = []
+
+        # Create pairs
+        while len(shuffled) > 0:
+            # Add two
+            pair = [shuffled.pop(), shuffled.pop()]
+
+            # If there is only one left, add it to the last pair
+            if len(shuffled) == 1:
+                pair.append(shuffled.pop())
+
+            pairs.append(pair)
+
+        # Determine history score, and keep it if among the best
+        score = index.score(pairs)
+        top.push(score, pairs)
+        if best_score is None or score < best_score:
+            best_score = score
+            metrics.record("best score", score)
+
+    metrics.count("samples evaluated", samples)
+
+    return top.pairings()
+
+
+def match_random_excluding(emails, history, seed, group_size, exclusions, budget, top):
+    """
+    Same as `match_random`, with groups built around exclusions, keeping the
+    best pairings in `top`.
+    """
+    index = build_history_index(history)
+    rng = Random(seed)
+    metrics = get_metrics()
+    pairwise = group_size != 2
+
+    best = None
+    invalid = 0
+    samples = 0
+    while not budget.is_done(samples, top.bound()):
+        samples += 1
+        shuffled = emails.copy()
+        rng.shuffle(shuffled)
+
+        groups = build_groups(shuffled, group_size, exclusions)
+        if groups is None:
+            invalid += 1
+            continue
+
+        score = index.score(groups, pairwise=pairwise)
+        top.push(score, groups)
+        if best is None or score < best[0]:
+            best = (score, groups)
+            metrics.record("best score", score)
+
+    metrics.count("samples evaluated", samples)
+    metrics.count("samples without a valid pairing", invalid)
+
+    if best is None:
+        raise Exception(
+            f"No pairing without excluded pairs was found in {invalid} samples; there may be none.  The optimal matcher can tell for pairs, or try the anneal matcher or more samples."
+        )
+
+
+def match_random_parallel(
+    emails,
+    history=None,
+    sample_count=1,
+    seed=None,
+    workers=2,
+    sampler=None,
+    executor=None,
+    group_size=None,
+    exclusions=None,
+    time_budget=None,
+    target_score=0,
+):
+    """
+    Same as `match_random`, but with the samples split across processes.
+
+    Each worker gets its own generator, seeded from `seed`, and only sends
+    back its best pairing; ties go to the lowest numbered worker.  So the same
+    seed and number of workers always give the same pairing.
+
+    :param emails: List of emails to pair.
+    :param history: `HistoryIndex` or list of previous pairings to avoid.
+    :param sample_count: Total number of random pairings to make, or None
+        for no limit with a time budget.
+    :param seed: Seed for the random number generator.
+    :param workers: Number of processes.
+    :param sampler: Function each worker samples with, with the same arguments
+        and results as `match_random_alternatives`; defaults to it.
+    :param executor: Process pool to run workers in, so it can be shared
+        between pairings; a new one is started and stopped if not provided.
+    :param group_size: Size of groups, see `match_random`.
+    :param exclusions: `ExclusionIndex`, see `match_random`; a worker that
+        finds no valid pairing does not count, unless none do.
+    :param time_budget: Seconds each worker samples for, at most, counted
+        from when the workers are given their samples.
+    :param target_score: Score at which a worker stops; the others go on
+        until their own budget is spent.
+    :returns: Tuple of `(score, pairs)`.
+    """
+    return match_random_parallel_alternatives(
+        emails,
+        history=history,
+        sample_count=sample_count,
+        seed=seed,
+        workers=workers,
+        sampler=sampler,
+        executor=executor,
+        group_size=group_size,
+        exclusions=exclusions,
+        time_budget=time_budget,
+        target_score=target_score,
+    )[0]
+
+
+def match_random_parallel_alternatives(
+    emails,
+    history=None,
+    sample_count=1,
+    seed=None,
+    workers=2,
+    sampler=None,
+    executor=None,
+    group_size=None,
+    exclusions=None,
+    time_budget=None,
+    target_score=0,
+    alternatives=1,
+):
+    """
+    Same as `match_random_parallel`, but keeping this many of the best
+    distinct pairings, see `match_random_alternatives`; each worker sends back
+    that many.
+
+    :param alternatives: Number of the best distinct pairings to keep.
+    :returns: List of `(score, pairs)` tuples, best first.
+    """
+
+    if len(emails) < 2:
+        return [(0, [])]
+
+    index = build_history_index(history)
+    sampler = sampler if sampler is not None else match_random_alternatives
+
+    # Spread samples evenly and give each worker its own seed
+    rng = Random(seed)
+    worker_seeds = [rng.randrange(2**64) for w in range(workers)]
+    if sample_count is not None:
+        worker_samples = [
+            sample_count // workers + (1 if w < sample_count % workers else 0)
+            for w in range(workers)
+        ]
+    else:
+        worker_samples = [None] * workers
+    worker_count = max(
+        sum(1 for count in worker_samples if count is None or count > 0), 1
+    )
+
+    arguments = (
+        [emails] * worker_count,
+        [index] * worker_count,
+        worker_samples[:worker_count],
+        worker_seeds[:worker_count],
+        [group_size] * worker_count,
+        [exclusions] * worker_count,
+        [time_budget] * worker_count,
+        [target_score] * worker_count,
+        [alternatives] * worker_count,
+    )
+    if executor is not None:
+        futures = [executor.submit(sampler, *values) for values in zip(*arguments)]
+        results = collect_worker_results(futures)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            futures = [executor.submit(sampler, *values) for values in zip(*arguments)]
+            results = collect_worker_results(futures)
+
+    # Workers keep their own metrics, so count them here
+    if sample_count is not None:
+        get_metrics().count("samples evaluated", sample_count)
+
+    # Best of every worker's best, in worker order for ties
+    top = TopPairings(alternatives)
+    for pairings in results:
+        for score, pairs in pairings:
+            top.push(score, pairs)
+    get_metrics().record("best score", top.pairings()[0][0])
+
+    return top.pairings()
+
+
+def collect_worker_results(futures):
+    """
+    Results of sampling workers, in order, leaving out workers that found no
+    valid pairing; raises the first error if every worker failed.
+    """
+    results = []
+    errors = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as error:
+            errors.append(error)
+
+    if not results:
+        raise errors[0]
+
+    return results
+
+
+def match_optimal(emails, history=None, seed=None, exclusions=None):
+    """
+    Pair emails with the minimum possible repetition score, by solving a
+    minimum-weight perfect matching where history scores are the edge weights.
+
+    With an odd number of emails, the leftover email is added to the pair
+    it has the least history with, as the random matcher does with its last
+    pair.
+
+    :param emails: List of emails to pair.
+    :param history: `HistoryIndex` or list of previous pairings to avoid.
+    :param seed: Seed used to break ties between equally good pairings.
+    :param exclusions: `ExclusionIndex` of pairs that must not be grouped.
+        They cost more than every other pair put together, so they are only
+        matched if there is no other way, which is then reported.
+    :returns: Tuple of `(score, pairs)`.
+    """
+
+    if len(emails) < 2:
+        return (0, [])
+
+    index = build_history_index(history)
+    rng = Random(seed)
+
+    # Shuffle so ties are not always broken the same way
+    emails = emails.copy()
+    rng.shuffle(emails)
+
+    # An odd roster gets a dummy vertex; whoever is matched to it is the
+    # leftover email
+    vertex_count = len(emails) + len(emails) % 2
+
+    # Only pairs that have history cost anything; everything else is 0
+    costs = history_costs(emails, index)
+    if exclusions:
+        excluded_cost = sum(costs.values()) + 1
+        positions = {email: i for i, email in enumerate(emails)}
+        for a, b in exclusions.pairs():
+            i = positions.get(a)
+            j = positions.get(b)
+            if i is not None and j is not None:
+                costs[(i, j) if i < j else (j, i)] = excluded_cost
+    big = max(costs.values(), default=0) + 1
+
+    def weight(i, j):
+        return big - costs.get((i, j) if i < j else (j, i), 0)
+
+    # Start from the complete graph for small rosters, otherwise from a
+    # random sparse graph
+    if vertex_count <= OPTIMAL_DENSE_LIMIT:
+        edge_keys = {
+            (i, j) for i in range(vertex_count) for j in range(i + 1, vertex_count)
+        }
+    else:
+        edge_keys = set()
+        for i in range(vertex_count):
+            for j in rng.sample(range(vertex_count), OPTIMAL_SPARSE_NEIGHBOURS + 1):
+                if i != j:
+                    edge_keys.add((i, j) if i < j else (j, i))
+
+    # Greedily pair up as many as possible without any history; those pairs
+    # are tight from the start, so the matching only has to repair the rest
+    mate = greedy_mate(vertex_count, costs)
+    edge_keys.update((i, j) for i, j in enumerate(mate) if i < j)
+
+    while True:
+        edges = [(i, j, weight(i, j)) for (i, j) in sorted(edge_keys)]
+        mate, dual = max_weight_matching(vertex_count, edges, mate=mate)
+
+        # Any edge outside the graph that violates the dual constraints
+        # could improve the matching; add them and solve again.
+        missing = violated_edges(vertex_count, dual, costs, big, edge_keys)
+        if not missing:
+            break
+        edge_keys.update(missing)
+
+    # Build pairs
+    pairs = []
+    leftover = None
+    for i in range(len(emails)):
+        j = mate[i]
+        if j >= len(emails):
+            leftover = emails[i]
+        elif i < j:
+            pairs.append([emails[i], emails[j]])
+
+    if exclusions and not all(exclusions.allows(pair) for pair in pairs):
+        raise Exception(
+            "No valid pairing exists: everyone can not be paired without an excluded pair."
+        )
+
+    # Add leftover to the pair where it adds the least
+    if leftover is not None:
+        allowed = [
+            p
+            for p in range(len(pairs))
+            if not exclusions or exclusions.allows(pairs[p] + [leftover])
+        ]
+        if not allowed:
+            raise Exception(
+                f"No valid pairing exists for this pairing's leftover {leftover}, who excludes someone in every pair."
+            )
+        best = min(
+            allowed,
+            key=lambda p: index.group_score(pairs[p] + [leftover])
+            - index.group_score(pairs[p]),
+        )
+        pairs[best].append(leftover)
+
+    return (index.score(pairs), pairs)
+
+
+def history_costs(emails, index):
+    """
+    Get history scores between emails, keyed by position in `emails`.
+
+    :param emails: List of emails.
+    :param index: `HistoryIndex` of previous pairings.
+    :returns: Dict of `(i, j) -> score`, with `i < j`, for pairs with history.
+    """
+    positions = {email: i for i, email in enumerate(emails)}
+
+    costs = {}
+    for a, b, score in index.pair_score_items():
+        i = positions.get(a)
+        j = positions.get(b)
+        if i is not None and j is not None and score > 0:
+            costs[(i, j) if i < j else (j, i)] = score
+
+    return costs
+
+
+def greedy_mate(vertex_count, costs):
+    """
+    Greedily pair vertices that have no history together.
+
+    :param vertex_count: Number of vertices.
+    :param costs: Dict of `(i, j) -> score` for pairs with history.
+    :returns: List of partners by vertex, or -1 if left unpaired.
+    """
+    mate = [-1] * vertex_count
+    free = list(range(vertex_count))
+
+    while len(free) > 1:
+        i = free.pop()
+
+        # Look for a partner from the end, where most will be found at once
+        for x in range(len(free) - 1, -1, -1):
+            j = free[x]
+            if ((i, j) if i < j else (j, i)) not in costs:
+                mate[i] = j
+                mate[j] = i
+                free[x] = free[-1]
+                free.pop()
+                break
+
+    return mate
+
+
+def violated_edges(vertex_count, dual, costs, big, edge_keys):
+    """
+    Find edges of the complete graph that are not in the matched graph and
+    whose dual constraint `dual[i] + dual[j] >= 2 * weight` does not hold.
+
+    If there are none, the matching is optimal on the complete graph as well.
+    """
+    missing = []
+
+    # Edges with history are few; check them directly
+    for (i, j), cost in costs.items():
+        if (i, j) not in edge_keys and dual[i] + dual[j] < 2 * (big - cost):
+            missing.append((i, j))
+
+    # Every other edge has the maximum weight, so only pairs of vertices
+    # whose duals add up to less than that can be violated.  Walk the
+    # vertices by dual so only those pairs are looked at.
+    order = sorted(range(vertex_count), key=lambda v: dual[v])
+    for x, i in enumerate(order):
+        if dual[i] >= big:
+            break
+        for j in order[x + 1 :]:
+            if dual[i] + dual[j] >= 2 * big:
+                break
+            key = (i, j) if i < j else (j, i)
+            if key not in edge_keys and key not in costs:
+                missing.append(key)
+
+    return missing
+
+
+def match_local_search(
+    emails,
+    history=None,
+    iterations=None,
+    seed=None,
+    group_size=None,
+    exclusions=None,
+    time_budget=None,
+    target_score=0,
+):
+    """
+    Pair emails by simulated annealing: start from a random pairing and swap
+    members between groups, keeping swaps that lower the score (and, early on,
+    some that do not, to get out of local minimums).
+
+    Only the two groups touched by a swap are rescored, so each step costs a
+    few index lookups no matter the size of the roster.
+
+    :param emails: List of emails to pair.
+    :param history: `HistoryIndex` or list of previous pairings to avoid.
+    :param iterations: Number of swaps to try; if not provided uses
+        LOCAL_SEARCH_ITERATIONS constant, or no limit with a time budget.
+    :param seed: Seed for the random number generator.
+    :param group_size: Make groups of this size instead of pairs, see
+        `split_groups`; they are scored as the sum of their pairs, so a swap
+        is rescored with one lookup per member of the two groups.
+    :param exclusions: `ExclusionIndex` of pairs that must not be grouped;
+        the starting pairing is built around them, see `build_groups`, and
+        swaps that would group an excluded pair are not tried.
+    :param time_budget: Seconds to keep swapping for, at most; the
+        temperature cools over whichever of the iterations or the time
+        budget runs out first.
+    :param target_score: Stop once a pairing scores this or less.
+    :returns: Tuple of `(score, pairs)`.
+    """
+
+    if len(emails) < 2:
+        return (0, [])
+
+    index = build_history_index(history)
+    rng = Random(seed)
+    if iterations is None and time_budget is None:
+        iterations = LOCAL_SEARCH_ITERATIONS
+    pairwise = (group_size or GROUP_SIZE) != 2
+
+    # Random starting pairing, with a leftover email added to the last pair
+    shuffled = emails.copy()
+    rng.shuffle(shuffled)
+    if exclusions:
+        groups = None
+        for attempt in range(EXCLUSION_ATTEMPTS):
+            groups = build_groups(shuffled, group_size or GROUP_SIZE, exclusions)
+            if groups is not None:
+                break
+            rng.shuffle(shuffled)
+
+        if groups is None:
+            raise Exception(
+                f"No pairing without excluded pairs was found in {EXCLUSION_ATTEMPTS} attempts; there may be none.  The optimal matcher can tell for pairs."
+            )
+    else:
+        groups = split_groups(shuffled, group_size or GROUP_SIZE)
+
+    if len(groups) < 2:
+        return (index.score(groups, pairwise=pairwise), groups)
+
+    group_score = index.pairwise_score if pairwise else index.group_score
+    group_scores = [group_score(group) for group in groups]
+    score = sum(group_scores)
+    best_score = score
+    best_groups = [group.copy() for group in groups]
+
+    # Groups with a score above zero, kept in a list with positions so that
+    # one can be picked at random and they can be added and removed quickly
+    conflicts = []
+    conflict_positions = {}
+
+    def set_conflict(g):
+        if group_scores[g] > 0 and g not in conflict_positions:
+            conflict_positions[g] = len(conflicts)
+            conflicts.append(g)
+        elif group_scores[g] == 0 and g in conflict_positions:
+            position = conflict_positions.pop(g)
+            last = conflicts.pop()
+            if last != g:
+                conflicts[position] = last
+                conflict_positions[last] = position
+
+    for g in range(len(groups)):
+        set_conflict(g)
+
+    # Start at a temperature where an average repeat is often accepted
+    temperature_start = max(score / max(len(conflicts), 1), 1)
+    metrics = get_metrics()
+    metrics.record("best score", best_score)
+
+    budget = SearchBudget(iterations, time_budget, target_score)
+    steps = 0
+    while conflicts and not budget.is_done(steps, best_score):
+        step = steps
+        steps += 1
+
+        # Swap someone from a group with repetition with anyone else
+        g1 = conflicts[rng.randrange(len(conflicts))]
+        g2 = rng.randrange(len(groups) - 1)
+        if g2 >= g1:
+            g2 += 1
+        m1 = rng.randrange(len(groups[g1]))
+        m2 = rng.randrange(len(groups[g2]))
+
+        group1 = groups[g1].copy()
+        group2 = groups[g2].copy()
+        group1[m1], group2[m2] = group2[m2], group1[m1]
+        if exclusions and not (exclusions.allows(group1) and exclusions.allows(group2)):
+            continue
+
+        if pairwise:
+            # Only the pairs of the two members that moved change
+            others1 = group1[:m1] + group1[m1 + 1 :]
+            others2 = group2[:m2] + group2[m2 + 1 :]
+            score1 = (
+                group_scores[g1]
+                + index.member_score(group1[m1], others1)
+                - index.member_score(group2[m2], others1)
+            )
+            score2 = (
+                group_scores[g2]
+                + index.member_score(group2[m2], others2)
+                - index.member_score(group1[m1], others2)
+            )
+        else:
+            score1 = index.group_score(group1)
+            score2 = index.group_score(group2)
+        delta = score1 + score2 - group_scores[g1] - group_scores[g2]
+
+        # Accept improvements, and worse swaps with a chance that shrinks
+        # as the temperature cools
+        if delta > 0:
+            temperature = temperature_start * (1 - budget.fraction(step))
+            if temperature <= 0 or rng.random() >= exp(-delta / temperature):
+                continue
+
+        groups[g1] = group1
+        groups[g2] = group2
+        group_scores[g1] = score1
+        group_scores[g2] = score2
+        set_conflict(g1)
+        set_conflict(g2)
+        score += delta
+
+        if score < best_score:
+            best_score = score
+            best_groups = [group.copy() for group in groups]
+            metrics.record("best score", best_score)
+
+    metrics.count("swaps tried", steps)
+
+    return (best_score, best_groups)
+
+
+def group_layout(member_count, group_size):
+    """
+    Number and base size of the groups members are split into, so that group
+    sizes differ by at most one: members left over after groups of
+    `group_size` are added one each to the last groups, like a leftover email
+    is added to the last pair, unless there are more of them than groups, in
+    which case there is one group more, of one less, like 5 and 4 for 9
+    people in groups of 5.
+
+    :param member_count: Number of members.
+    :param group_size: Size of groups, at least 2.
+    :returns: Tuple of `(count, size)`; the members left over after `count`
+        groups of `size` are fewer than `count`, or as many.
+    """
+    count = max(member_count // group_size, 1)
+    if member_count - count * group_size <= count:
+        return (count, group_size)
+
+    count = -(-member_count // group_size)
+    return (count, member_count // count)
+
+
+def split_groups(members, group_size):
+    """
+    Split members into groups of `group_size`, in order; members left over
+    are added one each to the last groups, so group sizes differ by at most
+    one, see `group_layout`.
+
+    :param members: List of members.
+    :param group_size: Size of groups, at least 2.
+    :returns: List of groups, as lists.
+    """
+    count, size = group_layout(len(members), group_size)
+    groups = [members[g * size : (g + 1) * size] for g in range(count)]
+    for x, member in enumerate(members[count * size :]):
+        groups[-1 - x % count].append(member)
+
+    return groups
+
+
+def build_groups(shuffled, group_size, exclusions):
+    """
+    Split shuffled members into groups like `split_groups`, but only putting
+    people together that no exclusion keeps apart: each group takes the next
+    people in order that none of its members exclude, so excluded pairs are
+    never made, instead of being thrown away afterwards.  People with the
+    most exclusions are placed first, while there is still room for them;
+    people with as many keep their shuffled order.
+
+    People left over join the groups one each from the last, like in
+    `split_groups`, skipping groups that exclude them; one that every group
+    not joined yet excludes joins a group that was, rather than the pairing
+    being given up on.
+
+    :param shuffled: List of members, in random order.
+    :param group_size: Size of groups, at least 2.
+    :param exclusions: `ExclusionIndex`.
+    :returns: List of groups, or None if people were left that no group
+        could take.
+    """
+    count, group_size = group_layout(len(shuffled), group_size)
+    remaining = sorted(shuffled, key=exclusions.degree)
+
+    groups = []
+    masks = []
+    for g in range(count):
+        group = [remaining.pop()]
+        mask = exclusions.mask(group[0])
+
+        # Take from the end, where nobody was passed over yet
+        x = len(remaining) - 1
+        while len(group) < group_size and x >= 0:
+            if not exclusions.blocks(mask, remaining[x]):
+                group.append(remaining[x])
+                mask |= exclusions.mask(remaining[x])
+                del remaining[x]
+            x -= 1
+
+        if len(group) < group_size:
+            return None
+
+        groups.append(group)
+        masks.append(mask)
+
+    # Leftovers join groups from the last, one each, where allowed
+    extended = set()
+    for member in remaining:
+        allowed = [
+            g
+            for g in range(len(groups) - 1, -1, -1)
+            if not exclusions.blocks(masks[g], member)
+        ]
+        if not allowed:
+            return None
+
+        g = next((g for g in allowed if g not in extended), allowed[0])
+        groups[g].append(member)
+        masks[g] |= exclusions.mask(member)
+        extended.add(g)
+
+    return groups
@@ -0,0 +1,144 @@
+# Dependencies
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+
+class Metrics:
+    """
+    Timings and counters for a run: how long each stage took, counts like
+    samples evaluated or API calls made, and values recorded over time like
+    the best score found so far.  Safe to share between threads.
+    """
+
+    def __init__(self, clock=perf_counter):
+        """
+        :param clock: Function returning the current time in seconds.
+        """
+        self.clock = clock
+        self.started = clock()
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+        self.series = {}
+        self.subscribers = {}
+
+    @contextmanager
+    def span(self, name):
+        """
+        Time a block of code; a span with the same name can be timed more
+        than once, and adds up.
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - start
+            with self.lock:
+                count, seconds = self.spans.get(name, (0, 0.0))
+                self.spans[name] = (count + 1, seconds + elapsed)
+
+    def count(self, name, amount=1):
+        """Add to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, value):
+        """Record a value, with the time since the start of the run."""
+        seconds = self.clock() - self.started
+        with self.lock:
+            self.series.setdefault(name, []).append((seconds, value))
+            subscribers = list(self.subscribers.get(name, []))
+
+        for subscriber in subscribers:
+            subscriber(seconds, value)
+
+    def subscribe(self, name, subscriber):
+        """
+        Call a function with the seconds since the start of the run and the
+        value whenever a value is recorded under a name, like to show the
+        best score as it improves.  Values recorded in other processes are
+        not seen.
+        """
+        with self.lock:
+            self.subscribers.setdefault(name, []).append(subscriber)
+
+    def unsubscribe(self, name, subscriber):
+        """Stop calling a function given to `subscribe`."""
+        with self.lock:
+            self.subscribers.get(name, []).remove(subscriber)
+
+    def seconds(self, name):
+        """Total seconds spent in a span, or 0 if never timed."""
+        return self.spans.get(name, (0, 0.0))[1]
+
+    def as_dict(self):
+        """All metrics, as a dict that can be dumped as JSON."""
+        with self.lock:
+            return {
+                "seconds": self.clock() - self.started,
+                "spans": {
+                    name: {"count": count, "seconds": seconds}
+                    for name, (count, seconds) in self.spans.items()
+                },
+                "counters": dict(self.counters),
+                "series": {
+                    name: [{"seconds": t, "value": v} for t, v in values]
+                    for name, values in self.series.items()
+                },
+            }
+
+    def summary(self):
+        """All metrics, as a table to print."""
+        metrics = self.as_dict()
+        width = max(
+            [len(name) for name in list(metrics["spans"]) + list(metrics["counters"])]
+            + [len(name) for name in metrics["series"]]
+            + [5]
+        )
+
+        lines = [f"{'Total':<{width}}  {metrics['seconds']:10.3f}s"]
+        for name, span in metrics["spans"].items():
+            lines.append(
+                f"{name:<{width}}  {span['seconds']:10.3f}s  ({span['count']}×)"
+            )
+        for name, value in metrics["counters"].items():
+            value = f"{value:.1f}" if isinstance(value, float) else f"{value}"
+            lines.append(f"{name:<{width}}  {value:>11}")
+        for name, values in metrics["series"].items():
+            changes = " → ".join(
+                f"{point['value']} ({point['seconds']:.2f}s)" for point in values[-5:]
+            )
+            more = "… → " if len(values) > 5 else ""
+            lines.append(f"{name:<{width}}  {more}{changes}")
+
+        return "\n".join(lines)
+
+
+# Metrics of the current run
+global_metrics = None
+
+
+def get_metrics():
+    """Get the metrics of the current run, starting them if needed."""
+    global global_metrics
+
+    if global_metrics is None:
+        global_metrics = Metrics()
+
+    return global_metrics
+
+
+def timed(name):
+    """Decorator that times every call of a function as a span."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with get_metrics().span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
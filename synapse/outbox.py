@@ -0,0 +1,186 @@
+# Dependencies
+import json
+import socket
+from os import fsync, getpid, listdir, makedirs, path, rename, replace
+from time import time
+
+# Headers of each message in the outbox, before the message itself, that
+# say how to deliver it and what to save to history once delivered
+OUTBOX_HEADER_PREFIX = "X-Synapse-"
+
+# Maildir flags: sent, passed on to history, and flagged as rejected
+FLAG_SENT = "S"
+FLAG_SAVED = "P"
+FLAG_FAILED = "F"
+
+
+class Outbox:
+    """
+    Rendered emails waiting to be delivered, in a Maildir: each message is
+    written whole to `tmp` then moved to `new`, so a reader never sees half a
+    message.  Once delivered it is moved to `cur` with the `S` flag, and
+    once its pair is saved to history the `P` flag is added, so delivery can
+    be stopped and started again at any point without sending anything twice
+    or losing history, apart from a message that was being sent at the time.
+    A message the mail server rejects for good is moved to `cur` with the `F`
+    flag instead, so it does not hold up the ones after it.
+
+    Each file is the message as sent, after a few `X-Synapse-` headers with
+    the envelope, the roster and date of the round, and the pair.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: Path to the Maildir; created when first written.
+        """
+        self.directory = directory
+        self.host = socket.gethostname().replace("/", "_").replace(":", "_")
+
+    def folder(self, name):
+        return path.join(self.directory, name)
+
+    def names(self, folder):
+        """Names of the messages in a folder, in the order they were added."""
+        if not path.isdir(self.folder(folder)):
+            return []
+
+        return sorted(name for name in listdir(self.folder(folder)) if name[0] != ".")
+
+    def add_all(self, roster, date, pairs, messages, writers=1):
+        """
+        Add the rendered emails of a round.
+
+        :param roster: URI of the roster the round is for.
+        :param date: Date of the round, as an ISO string.
+        :param pairs: List of pairs, one per message.
+        :param messages: List of `(from_, to, message)` tuples, from
+            `synapse.cli.render_emails`.
+        :param writers: Number of files to write at once.
+        :returns: List of the names of the messages.
+        """
+        for folder in ["tmp", "new", "cur"]:
+            makedirs(self.folder(folder), exist_ok=True)
+
+        # Names sort in the order messages were added, across runs
+        now = time()
+        prefix = f"{int(now)}.M{int(now % 1 * 1000000):06d}P{getpid()}"
+        names = [f"{prefix}Q{i:06d}.{self.host}" for i in range(len(messages))]
+
+        def write(i):
+            self.add(names[i], roster, date, pairs[i], *messages[i])
+
+        if writers > 1 and len(messages) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=writers) as executor:
+                list(executor.map(write, range(len(messages))))
+        else:
+            for i in range(len(messages)):
+                write(i)
+
+        return names
+
+    def add(self, name, roster, date, pair, from_, to, message):
+        """Write a message to `tmp`, then move it to `new`."""
+        headers = {
+            "Roster": roster,
+            "Date": date,
+            "Pair": json.dumps(pair),
+            "Envelope-From": from_ or "",
+            "Envelope-To": json.dumps(to),
+        }
+        temporary = path.join(self.folder("tmp"), name)
+        with open(temporary, "w", newline="") as f:
+            for header, value in headers.items():
+                f.write(f"{OUTBOX_HEADER_PREFIX}{header}: {value}\n")
+            f.write(message)
+            f.flush()
+            fsync(f.fileno())
+
+        replace(temporary, path.join(self.folder("new"), name))
+
+    def read(self, folder, name):
+        """
+        Read a message.
+
+        :returns: Dict with `roster`, `date`, `pair`, `from_`, `to` and
+            `message`.
+        """
+        with open(path.join(self.folder(folder), name), "r", newline="") as f:
+            headers = {}
+            line = f.readline()
+            while line.startswith(OUTBOX_HEADER_PREFIX):
+                header, value = line[len(OUTBOX_HEADER_PREFIX) :].split(": ", 1)
+                headers[header] = value.rstrip("\n")
+                line = f.readline()
+
+            message = line + f.read()
+
+        return {
+            "roster": headers["Roster"],
+            "date": headers["Date"],
+            "pair": json.loads(headers["Pair"]),
+            "from_": headers["Envelope-From"] or None,
+            "to": json.loads(headers["Envelope-To"]),
+            "message": message,
+        }
+
+    def pending(self):
+        """Names of messages not delivered yet, oldest first."""
+        return self.names("new")
+
+    def unsaved(self):
+        """Names, in `cur`, of messages delivered but not saved to history."""
+        return [
+            name
+            for name in self.names("cur")
+            if FLAG_SENT in flags(name) and FLAG_SAVED not in flags(name)
+        ]
+
+    def mark_sent(self, name):
+        """Move a delivered message from `new` to `cur`."""
+        rename(
+            path.join(self.folder("new"), name),
+            path.join(self.folder("cur"), f"{name}:2,{FLAG_SENT}"),
+        )
+
+    def failed(self):
+        """Names, in `cur`, of messages the mail server rejected."""
+        return [name for name in self.names("cur") if FLAG_FAILED in flags(name)]
+
+    def mark_failed(self, name):
+        """Move a rejected message from `new` to `cur`, flagged."""
+        rename(
+            path.join(self.folder("new"), name),
+            path.join(self.folder("cur"), f"{name}:2,{FLAG_FAILED}"),
+        )
+
+    def mark_saved(self, names):
+        """Flag delivered messages, by their names in `cur`, as saved."""
+        for name in names:
+            base, current = name.split(":2,", 1)
+            rename(
+                path.join(self.folder("cur"), name),
+                path.join(
+                    self.folder("cur"),
+                    f"{base}:2,{''.join(sorted(current + FLAG_SAVED))}",
+                ),
+            )
+
+    def rosters(self):
+        """
+        Number of messages not delivered, or not saved to history, of each
+        roster, as a dict.
+        """
+        counts = {}
+        for folder, names in [("new", self.pending()), ("cur", self.unsaved())]:
+            for name in names:
+                roster = self.read(folder, name)["roster"]
+                counts[roster] = counts.get(roster, 0) + 1
+
+        return counts
+
+
+def flags(name):
+    """Maildir flags of a message in `cur`."""
+    return name.split(":2,", 1)[1] if ":2," in name else ""
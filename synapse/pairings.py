@@ -0,0 +1,106 @@
+# Dependencies
+import json
+from os import listdir, makedirs, path, remove, replace
+from time import time
+
+
+class PairingCache:
+    """
+    Pairings kept on disk under a key of everything they depend on, so that
+    running again with the same roster, history and options, like sending
+    after a `--no-send` preview, gives the same pairs without pairing again.
+
+    Each pairing is a small JSON file named by its key; it expires some time
+    after it was saved, and expired files are removed whenever a new pairing
+    is saved.
+    """
+
+    def __init__(self, directory, max_age):
+        """
+        :param directory: Where to keep pairings; created when first saving.
+        :param max_age: Seconds a pairing is kept.
+        """
+        self.directory = directory
+        self.max_age = max_age
+
+    def filename(self, key):
+        return path.join(self.directory, f"{key}.json")
+
+    def is_expired(self, filename, now=None):
+        now = now if now is not None else time()
+        return path.getmtime(filename) + self.max_age <= now
+
+    def get(self, key):
+        """
+        Get pairings, or None if there are none or they expired.
+
+        :returns: List of `(score, pairs)` tuples, best first, like
+            `pair_emails_alternatives`.
+        """
+        filename = self.filename(key)
+        if not path.exists(filename) or self.is_expired(filename):
+            return None
+
+        with open(filename, "r") as f:
+            try:
+                pairing = json.load(f)
+            except json.decoder.JSONDecodeError:
+                return None
+
+        # Saved by an older version
+        if "pairings" not in pairing:
+            return None
+
+        return [(score, pairs) for score, pairs in pairing["pairings"]]
+
+    def set(self, key, pairings):
+        """
+        Save pairings, and remove expired ones.
+
+        :param pairings: List of `(score, pairs)` tuples, best first.
+        """
+        makedirs(self.directory, exist_ok=True)
+        self.prune()
+
+        # Written whole then moved in place, so a reader never sees half
+        temporary = f"{self.filename(key)}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"pairings": pairings}, f)
+        replace(temporary, self.filename(key))
+
+    def discard(self, pairs):
+        """
+        Remove the pairings with these pairs, including as an alternative,
+        like when they were declined, so they are not offered again.
+        """
+        if not path.isdir(self.directory):
+            return
+
+        for name in listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+
+            filename = path.join(self.directory, name)
+            try:
+                with open(filename, "r") as f:
+                    pairing = json.load(f)
+                if any(other == pairs for score, other in pairing.get("pairings", [])):
+                    remove(filename)
+            except (FileNotFoundError, json.decoder.JSONDecodeError):
+                # Removed or being replaced by another run at the same time
+                pass
+
+    def prune(self):
+        """Remove expired pairings."""
+        if not path.isdir(self.directory):
+            return
+
+        now = time()
+        for name in listdir(self.directory):
+            filename = path.join(self.directory, name)
+            try:
+                if name.endswith(".json") and self.is_expired(filename, now):
+                    remove(filename)
+            except FileNotFoundError:
+                # Removed by another run at the same time
+                pass
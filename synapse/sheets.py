@@ -0,0 +1,344 @@
+# Dependencies
+import random
+import threading
+from time import monotonic, sleep
+
+from synapse.delivery import TokenBucket
+from synapse.metrics import get_metrics
+
+
+class SheetsScheduler:
+    """
+    Makes Sheets API requests within a quota of calls per minute, shared by
+    every spreadsheet and thread of a run: requests wait their turn instead of
+    being refused, requests refused anyway (429) or failing on Google's side
+    (5xx) are retried with backoff, and values read recently are served from
+    a short-lived cache instead of being read again.  Writes that would be
+    made twice by retrying them are only retried when they were refused, or
+    found not to have been made.
+    """
+
+    def __init__(
+        self,
+        rate_per_minute=60,
+        burst=1,
+        retries=5,
+        backoff=2,
+        cache_seconds=30,
+        clock=monotonic,
+        sleeper=sleep,
+    ):
+        """
+        :param rate_per_minute: Sustained number of requests per minute, or
+            None for no limit.
+        :param burst: Number of requests that can be made back to back.
+        :param retries: Number of times to retry a transient error.
+        :param backoff: Seconds to wait before the first retry; doubles (with
+            some jitter) for each retry after that, unless the API says how
+            long to wait.
+        :param cache_seconds: Seconds values that were read are kept.
+        :param clock: Function returning the current time in seconds.
+        :param sleeper: Function to wait a number of seconds.
+        """
+        self.bucket = None
+        if rate_per_minute is not None:
+            self.bucket = TokenBucket(
+                rate_per_minute, burst, clock=clock, sleeper=sleeper
+            )
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_seconds = cache_seconds
+        self.clock = clock
+        self.sleeper = sleeper
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        """Make a request, when the quota allows, retrying transient errors."""
+        return self.request(function, args, kwargs)
+
+    def write(self, function, *args, applied=None, **kwargs):
+        """
+        Same as `call`, but for writes that are not safe to repeat, like
+        appending rows: only refused requests (429) are retried as they are.
+        Other transient errors, like 5xx and dropped connections, may come
+        after the write was made, so it is only retried if `applied` says it
+        was not.
+
+        :param applied: Function telling whether the write was made after
+            all, or None to not retry those errors.
+        :returns: Result of the write, or None if it was made despite an
+            error.
+        """
+        return self.request(function, args, kwargs, repeatable=False, applied=applied)
+
+    def request(self, function, args, kwargs, repeatable=True, applied=None):
+        """Make a request for `call` or `write`."""
+        metrics = get_metrics()
+
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            metrics.count("sheets api calls")
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                if attempt >= self.retries or not is_transient_sheets_error(error):
+                    raise
+
+                # The write may have been made before the error
+                if not repeatable and not is_refused_sheets_error(error):
+                    if applied is None:
+                        raise
+                    if applied():
+                        metrics.count("sheets writes made despite an error")
+                        return None
+
+                metrics.count("sheets api retries")
+                wait = retry_after(error)
+                if wait is None:
+                    wait = self.backoff * 2**attempt * random.uniform(1, 1.5)
+                self.sleeper(wait)
+                attempt += 1
+
+    def read(self, key, function, *args, **kwargs):
+        """
+        Same as `call`, but for reads: the result is kept under a key for
+        `cache_seconds`, and returned again for the same key until then.
+        """
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached is not None and self.clock() - cached[0] < self.cache_seconds:
+            get_metrics().count("sheets cache hits")
+            return cached[1]
+
+        result = self.call(function, *args, **kwargs)
+        with self.lock:
+            self.cache[key] = (self.clock(), result)
+
+        return result
+
+    def invalidate(self, spreadsheet):
+        """Forget cached reads of a spreadsheet, like after changing it."""
+        with self.lock:
+            for key in [key for key in self.cache if key[0] == spreadsheet]:
+                del self.cache[key]
+
+
+def is_transient_sheets_error(error):
+    """Whether an error from the Sheets API is worth retrying."""
+    status = sheets_error_status(error)
+    if status is not None:
+        return status == 429 or 500 <= status < 600
+
+    # Network errors
+    return isinstance(error, OSError)
+
+
+def is_refused_sheets_error(error):
+    """
+    Whether an error from the Sheets API means the request was turned away
+    before being made, so it is safe to make again whatever it does.
+    """
+    return sheets_error_status(error) == 429
+
+
+def sheets_error_status(error):
+    """HTTP status of an error from the Sheets API, or None."""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)
+
+    return status if isinstance(status, int) else None
+
+
+def retry_after(error):
+    """Seconds the Sheets API asked to wait before retrying, or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class SpreadsheetSession:
+    """
+    A spreadsheet opened once for a run.  The list of sheets is fetched when
+    opened, so finding a sheet does not need a request, and reads and writes
+    are batched into one request each.  Requests go through a
+    `SheetsScheduler`.
+    """
+
+    def __init__(self, client, key, scheduler=None):
+        """
+        :param client: gspread client.
+        :param key: ID of the spreadsheet.
+        :param scheduler: `SheetsScheduler` shared by the run, or None for one
+            of its own, with no quota.
+        """
+        self.key = key
+        self.scheduler = scheduler if scheduler is not None else SheetsScheduler(None)
+
+        # Opening fetches the spreadsheet's properties and its sheets at once
+        self.spreadsheet, metadata = self.scheduler.call(
+            open_spreadsheet,
+            client,
+            key,
+            "properties,sheets.properties(sheetId,title,index)",
+        )
+        self.sheets = [sheet["properties"] for sheet in metadata.get("sheets", [])]
+
+    def sheet_by_index(self, index):
+        """Properties of the sheet at a position, like `get_worksheet`."""
+        for sheet in self.sheets:
+            if sheet.get("index", 0) == index:
+                return sheet
+
+        raise Exception(f"Sheet {index} not found in spreadsheet {self.key}.")
+
+    def sheet_by_title(self, title):
+        """Properties of the sheet with a title, or None if there is none."""
+        for sheet in self.sheets:
+            if sheet["title"] == title:
+                return sheet
+
+        return None
+
+    def batch_get(self, ranges):
+        """
+        Get the values of several ranges in one request, or from the cache if
+        they were read a moment ago.
+
+        :param ranges: List of `(sheet title, A1 range)` tuples.
+        :returns: List of rows of values, one per range.
+        """
+        from gspread.utils import absolute_range_name
+
+        names = [absolute_range_name(title, range_name) for title, range_name in ranges]
+        response = self.scheduler.read(
+            (self.key, tuple(names)), self.spreadsheet.values_batch_get, names
+        )
+
+        # Copies, so callers can change them without changing the cache
+        return [
+            [list(row) for row in value_range.get("values", [])]
+            for value_range in response["valueRanges"]
+        ]
+
+    def batch_update(self, requests, applied=None):
+        """
+        Make several changes in one request.  It is only retried if refused,
+        or if `applied` says it was not made, see `SheetsScheduler.write`.
+
+        :param requests: List of Sheets API `batchUpdate` requests.
+        :param applied: Function telling whether the changes were made after
+            all, which can read the spreadsheet afresh.
+        """
+
+        def check():
+            # Values read before the changes are out of date
+            self.scheduler.invalidate(self.key)
+            return applied()
+
+        try:
+            result = self.scheduler.write(
+                self.spreadsheet.batch_update,
+                {"requests": requests},
+                applied=check if applied is not None else None,
+            )
+        finally:
+            self.scheduler.invalidate(self.key)
+
+        # Sheets that were added only exist once the changes were made
+        for request in requests:
+            if "addSheet" in request:
+                self.sheets.append(request["addSheet"]["properties"])
+
+        return result
+
+    def add_sheet_request(self, title, rows, columns, frozen_rows=0):
+        """
+        Make an `addSheet` request, with a sheet ID chosen up front so that
+        other requests in the same batch can refer to the new sheet.  The
+        sheet is found by `sheet_by_title` once `batch_update` made it.
+
+        :returns: Tuple of `(sheet ID, request)`.
+        """
+        sheet_id = max([sheet.get("sheetId", 0) for sheet in self.sheets] + [0]) + 1
+        properties = {
+            "sheetId": sheet_id,
+            "title": title,
+            "index": len(self.sheets),
+            "gridProperties": {
+                "rowCount": rows,
+                "columnCount": columns,
+                "frozenRowCount": frozen_rows,
+            },
+        }
+
+        return (sheet_id, {"addSheet": {"properties": properties}})
+
+
+def open_spreadsheet(client, key, fields):
+    """
+    Open a spreadsheet with a single request for its metadata, unlike
+    `open_by_key`, whose spreadsheet fetches its properties when made and
+    needs another request for anything else.
+
+    :param client: gspread client.
+    :param key: ID of the spreadsheet.
+    :param fields: Fields of the metadata to get, which should include
+        `properties`.
+    :returns: Tuple of `(gspread Spreadsheet, metadata)`.
+    """
+    from gspread import Spreadsheet
+    from gspread.urls import SPREADSHEET_URL
+
+    metadata = client.request(
+        "get",
+        SPREADSHEET_URL % key,
+        params={"includeGridData": "false", "fields": fields},
+    ).json()
+
+    # Made without its constructor, which would fetch the properties again
+    spreadsheet = Spreadsheet.__new__(Spreadsheet)
+    spreadsheet.client = client
+    spreadsheet._properties = dict(metadata.get("properties", {}), id=key)
+
+    return (spreadsheet, metadata)
+
+
+def append_cells_request(sheet_id, rows):
+    """
+    Make an `appendCells` request, which adds rows of strings after the last
+    row with data, like `append_row` does.
+    """
+    return {
+        "appendCells": {
+            "sheetId": sheet_id,
+            "rows": [
+                {"values": [{"userEnteredValue": {"stringValue": v}} for v in row]}
+                for row in rows
+            ],
+            "fields": "userEnteredValue",
+        }
+    }
+
+
+def format_row_request(sheet_id, row, columns, cell_format):
+    """Make a `repeatCell` request, formatting cells of a row like `format`."""
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": row,
+                "endRowIndex": row + 1,
+                "startColumnIndex": 0,
+                "endColumnIndex": columns,
+            },
+            "cell": {"userEnteredFormat": cell_format},
+            "fields": f"userEnteredFormat({','.join(cell_format.keys())})",
+        }
+    }
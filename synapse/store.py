@@ -0,0 +1,257 @@
+# Dependencies
+import hashlib
+import json
+import sqlite3
+from os import makedirs, path
+
+from synapse.history import HistoryRound
+
+# Version of the tables; a copy made by an older version is dropped, and
+# synced again from the sheet
+HISTORY_STORE_VERSION = 3
+
+
+class HistoryStore:
+    """
+    Local copy of the rows of the history sheet, in SQLite, so that each run
+    only has to fetch the rows added since the last one.
+
+    Rows are kept as they are in the sheet, as `(date, email pairs)` strings,
+    numbered by their row in the sheet, and also packed as integer ids (see
+    `HistoryRound`) so they can be loaded without parsing JSON.  Old rows can
+    be compacted into a snapshot, see `compact`; they still count as synced.
+    A digest of each synced row is kept too, compacted ones included, see
+    `row_digests`, so that rows sampled from the sheet can be checked for
+    edits without reading the whole sheet again.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: Path to the SQLite file; created if needed.
+        """
+        directory = path.dirname(filename)
+        if directory:
+            makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(filename)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != HISTORY_STORE_VERSION:
+            with self.connection:
+                for table in [
+                    "history_rows",
+                    "history_meta",
+                    "history_emails",
+                    "history_digests",
+                ]:
+                    self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self.connection.execute(f"PRAGMA user_version = {HISTORY_STORE_VERSION}")
+
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS history_rows (row INTEGER PRIMARY KEY, date TEXT NOT NULL, pairs TEXT NOT NULL, members BLOB, ends BLOB)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS history_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS history_emails (id INTEGER PRIMARY KEY, email TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS history_digests (row INTEGER PRIMARY KEY, digest TEXT NOT NULL)"
+        )
+        self.connection.commit()
+
+        # Email -> id, loaded when first needed
+        self.email_ids = None
+
+    def __len__(self):
+        """Number of rows synced, including compacted ones."""
+        row = self.connection.execute("SELECT MAX(row) FROM history_rows").fetchone()
+        stored = row[0] + 1 if row[0] is not None else 0
+
+        return max(stored, self.get_meta("compacted_rows", 0))
+
+    def last_row(self):
+        """Last synced row as a `[date, pairs]` list, or None if empty."""
+        row = self.connection.execute(
+            "SELECT row, date, pairs FROM history_rows ORDER BY row DESC LIMIT 1"
+        ).fetchone()
+
+        # The last row may have been compacted
+        if row is not None and row[0] + 1 == len(self):
+            return [row[1], row[2]]
+
+        return self.get_meta("last_row")
+
+    def rows(self):
+        """Stored rows, not compacted, as `(date, pairs)` tuples, in sheet order."""
+        return self.connection.execute(
+            "SELECT date, pairs FROM history_rows ORDER BY row"
+        ).fetchall()
+
+    def packed_rows(self):
+        """
+        Stored rows, not compacted, as `(date, members, ends)` tuples, in sheet
+        order, for `HistoryRound.unpack`; rows that are not valid JSON are
+        left out.
+        """
+        return self.connection.execute(
+            "SELECT date, members, ends FROM history_rows WHERE members IS NOT NULL ORDER BY row"
+        ).fetchall()
+
+    def emails(self):
+        """List of emails, by the id they are packed with."""
+        return [
+            email
+            for (email,) in self.connection.execute(
+                "SELECT email FROM history_emails ORDER BY id"
+            )
+        ]
+
+    def numbered_rows(self):
+        """Stored rows, not compacted, as `(row, date, pairs)` tuples."""
+        return self.connection.execute(
+            "SELECT row, date, pairs FROM history_rows ORDER BY row"
+        ).fetchall()
+
+    def row_digests(self, rows):
+        """
+        Digests of synced rows, compacted ones included, as from `digest_row`.
+
+        :param rows: Numbers of the rows, counting synced rows from 0.
+        :returns: Dict of row number to digest, leaving out rows not synced.
+        """
+        digests = {}
+        for row in rows:
+            found = self.connection.execute(
+                "SELECT digest FROM history_digests WHERE row = ?", (row,)
+            ).fetchone()
+            if found is not None:
+                digests[row] = found[0]
+
+        return digests
+
+    def snapshot(self):
+        """Snapshot of compacted rows, as saved by `compact`, or None."""
+        return self.get_meta("snapshot")
+
+    def compact(self, rows, snapshot):
+        """
+        Replace rows with a snapshot that includes them.
+
+        :param rows: Numbers of the rows to remove, from `numbered_rows`.
+        :param snapshot: Snapshot of all compacted rows so far, anything that
+            can be dumped as JSON.
+        """
+        last_row = self.last_row()
+        synced = len(self)
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM history_rows WHERE row = ?", [(row,) for row in rows]
+            )
+            self.set_meta("snapshot", snapshot)
+            self.set_meta("compacted_rows", synced)
+            self.set_meta("last_row", last_row)
+
+    def get_meta(self, key, default=None):
+        row = self.connection.execute(
+            "SELECT value FROM history_meta WHERE key = ?", (key,)
+        ).fetchone()
+
+        return json.loads(row[0]) if row is not None else default
+
+    def set_meta(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO history_meta (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)),
+        )
+
+    def append(self, rows):
+        """
+        Add rows after the ones already stored.
+
+        :param rows: List of `[date, pairs]` lists.
+        """
+        with self.connection:
+            self.insert(rows)
+
+    def insert(self, rows):
+        """Add rows after the ones already stored, without committing."""
+        start = len(self)
+        if self.email_ids is None:
+            self.email_ids = {email: i for i, email in enumerate(self.emails())}
+        known = len(self.email_ids)
+
+        packed = [
+            (start + i, date, pairs) + self.pack(pairs)
+            for i, (date, pairs) in enumerate(rows)
+        ]
+        self.connection.executemany(
+            "INSERT INTO history_rows (row, date, pairs, members, ends) VALUES (?, ?, ?, ?, ?)",
+            packed,
+        )
+        self.connection.executemany(
+            "INSERT INTO history_emails (id, email) VALUES (?, ?)",
+            [
+                (email_id, email)
+                for email, email_id in self.email_ids.items()
+                if email_id >= known
+            ],
+        )
+        self.connection.executemany(
+            "INSERT INTO history_digests (row, digest) VALUES (?, ?)",
+            [
+                (start + i, digest_row(date, pairs))
+                for i, (date, pairs) in enumerate(rows)
+            ],
+        )
+
+    def pack(self, pairs):
+        """
+        Pack a row's pairs as `(members, ends)` bytes, interning emails, or
+        `(None, None)` if they are not valid JSON.
+        """
+        try:
+            pairs = json.loads(pairs)
+        except json.decoder.JSONDecodeError:
+            return (None, None)
+
+        round = HistoryRound(0)
+        for group in pairs:
+            ids = []
+            for email in group:
+                email_id = self.email_ids.get(email)
+                if email_id is None:
+                    email_id = self.email_ids[email] = len(self.email_ids)
+                ids.append(email_id)
+            round.add_group(ids)
+
+        return round.pack()
+
+    def replace(self, rows):
+        """
+        Replace all stored rows, at once, so a crash leaves either the old or
+        the new rows.
+
+        :param rows: List of `[date, pairs]` lists.
+        """
+        self.email_ids = None
+        try:
+            with self.connection:
+                self.connection.execute("DELETE FROM history_rows")
+                self.connection.execute("DELETE FROM history_meta")
+                self.connection.execute("DELETE FROM history_emails")
+                self.connection.execute("DELETE FROM history_digests")
+                self.insert(rows)
+        except Exception:
+            # Ids interned for rows that were rolled back
+            self.email_ids = None
+            raise
+
+    def close(self):
+        self.connection.close()
+
+
+def digest_row(date, pairs):
+    """Digest of a history row, to tell whether it changed in the sheet."""
+    return hashlib.sha256(json.dumps([date, pairs]).encode("utf-8")).hexdigest()
@@ -0,0 +1,334 @@
+"""
+NumPy backend for generating and scoring random pairings in batches.
+
+NumPy is an optional dependency; this module is only imported when the numpy
+backend is asked for.
+"""
+
+# Dependencies
+import numpy as np
+
+from synapse.history import build_history_index
+from synapse.matching import (
+    GROUP_SIZE,
+    SearchBudget,
+    TopPairings,
+    match_random_alternatives,
+    split_groups,
+)
+from synapse.metrics import get_metrics
+
+
+# Number of pairings generated and scored at once; memory use is about
+# `NUMPY_BATCH_SIZE * len(emails)` integers
+NUMPY_BATCH_SIZE = 1024
+
+# Rosters up to this size keep history scores in a dense matrix, of at most
+# 512 KB; larger ones use sorted arrays of the pair keys in history, so memory
+# grows with history and the batch size rather than the roster squared
+NUMPY_DENSE_LIMIT = 256
+
+
+class PairScores:
+    """History scores between emails of a roster, looked up by integer id."""
+
+    def __init__(self, emails, index):
+        """
+        :param emails: List of emails; an email's id is its position.
+        :param index: `HistoryIndex` of previous pairings.
+        """
+        self.size = len(emails)
+        positions = {email: i for i, email in enumerate(emails)}
+
+        keys = []
+        scores = []
+        for a, b, score in index.pair_score_items():
+            i = positions.get(a)
+            j = positions.get(b)
+            if i is not None and j is not None and score != 0:
+                keys.append(min(i, j) * self.size + max(i, j))
+                scores.append(score)
+
+        if self.size <= NUMPY_DENSE_LIMIT:
+            self.matrix = np.zeros((self.size, self.size), dtype=np.int64)
+            if keys:
+                keys = np.array(keys, dtype=np.int64)
+                self.matrix[keys // self.size, keys % self.size] = scores
+                self.matrix[keys % self.size, keys // self.size] = scores
+        else:
+            self.matrix = None
+            order = np.argsort(np.array(keys, dtype=np.int64))
+            self.keys = np.array(keys, dtype=np.int64)[order]
+            self.scores = np.array(scores, dtype=np.int64)[order]
+
+    def lookup(self, a, b):
+        """
+        Scores for arrays of ids.
+
+        :param a: Array of ids.
+        :param b: Array of ids, same shape as `a`.
+        :returns: Array of scores, same shape as `a`.
+        """
+        if self.matrix is not None:
+            return self.matrix[a, b]
+
+        keys = np.minimum(a, b) * self.size + np.maximum(a, b)
+        if len(self.keys) == 0:
+            return np.zeros(keys.shape, dtype=np.int64)
+
+        positions = np.searchsorted(self.keys, keys)
+        positions = np.minimum(positions, len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        return np.where(found, self.scores[positions], 0)
+
+
+def score_permutations(permutations, emails, index, pair_scores):
+    """
+    Score a batch of pairings given as permutations of email ids.
+
+    Consecutive ids make a pair; with an odd number of ids the last id is
+    added to the last pair, like the random matcher does.
+
+    :param permutations: 2D array with one permutation of ids per row.
+    :param emails: List of emails the ids refer to.
+    :param index: `HistoryIndex` of previous pairings.
+    :param pair_scores: `PairScores` for `emails`.
+    :returns: Array of scores, one per row.
+    """
+    width = permutations.shape[1]
+    pair_count = width // 2
+    firsts = permutations[:, 0 : 2 * pair_count : 2]
+    seconds = permutations[:, 1 : 2 * pair_count : 2]
+    scores = pair_scores.lookup(firsts, seconds)
+    totals = scores.sum(axis=1)
+
+    if width % 2:
+        # The triple counts each round once, which is only different from
+        # the sum of its pairs when more than one of its pairs has history
+        a = firsts[:, -1]
+        b = seconds[:, -1]
+        c = permutations[:, -1]
+        a_c = pair_scores.lookup(a, c)
+        b_c = pair_scores.lookup(b, c)
+        extra = a_c + b_c
+        totals += extra
+
+        overlapping = (
+            (scores[:, -1] != 0).astype(np.int8) + (a_c != 0) + (b_c != 0)
+        ) >= 2
+        for row in np.nonzero(overlapping)[0]:
+            group = [emails[a[row]], emails[b[row]], emails[c[row]]]
+            totals[row] += index.group_score(group) - scores[row, -1] - extra[row]
+
+    return totals
+
+
+def score_group_permutations(permutations, layout, pair_scores):
+    """
+    Score a batch of groupings given as permutations of email ids, with each
+    group scored as the sum of its pairs.
+
+    :param permutations: 2D array with one permutation of ids per row.
+    :param layout: Groups of positions in a permutation, from `split_groups`.
+    :param pair_scores: `PairScores` for the emails.
+    :returns: Array of scores, one per row.
+    """
+    firsts = []
+    seconds = []
+    for group in layout:
+        for x in range(1, len(group)):
+            firsts.extend(group[:x])
+            seconds.extend([group[x]] * x)
+
+    firsts = np.array(firsts, dtype=np.int64)
+    seconds = np.array(seconds, dtype=np.int64)
+    return pair_scores.lookup(permutations[:, firsts], permutations[:, seconds]).sum(
+        axis=1
+    )
+
+
+def permutation_pairs(permutation, emails):
+    """Turn a permutation of ids into a list of pairs of emails."""
+    pairs = [
+        [emails[permutation[i]], emails[permutation[i + 1]]]
+        for i in range(0, len(emails) - 1, 2)
+    ]
+    if len(emails) % 2:
+        pairs[-1].append(emails[permutation[-1]])
+
+    return pairs
+
+
+def match_random_numpy(
+    emails,
+    history=None,
+    sample_count=1,
+    seed=None,
+    group_size=None,
+    exclusions=None,
+    time_budget=None,
+    target_score=0,
+):
+    """
+    Same as `synapse.matching.match_random`, but generating and scoring
+    pairings in batches of NUMPY_BATCH_SIZE with NumPy.
+
+    :param emails: List of emails to pair.
+    :param history: `HistoryIndex` or list of previous pairings to avoid.
+    :param sample_count: Number of random pairings to make.
+    :param seed: Seed for the random number generator.
+    :param group_size: Make groups of this size instead of pairs, see
+        `synapse.matching.match_random`.
+    :param exclusions: `ExclusionIndex` of pairs that must not be grouped;
+        permutations can not be built around them in batches, so this uses
+        `synapse.matching.match_random` instead.
+    :param time_budget: Seconds to keep sampling for, at most, checked
+        between batches.
+    :param target_score: Stop sampling once a pairing scores this or less.
+    :returns: Tuple of `(score, pairs)`.
+    """
+    return match_random_numpy_alternatives(
+        emails,
+        history,
+        sample_count,
+        seed,
+        group_size,
+        exclusions,
+        time_budget,
+        target_score,
+    )[0]
+
+
+def match_random_numpy_alternatives(
+    emails,
+    history=None,
+    sample_count=1,
+    seed=None,
+    group_size=None,
+    exclusions=None,
+    time_budget=None,
+    target_score=0,
+    alternatives=1,
+):
+    """
+    Same as `match_random_numpy`, but keeping this many of the best distinct
+    pairings, see `synapse.matching.match_random_alternatives`.
+
+    :param alternatives: Number of the best distinct pairings to keep.
+    :returns: List of `(score, pairs)` tuples, best first.
+    """
+
+    if len(emails) < 2:
+        return [(0, [])]
+
+    if exclusions:
+        return match_random_alternatives(
+            emails,
+            history=history,
+            sample_count=sample_count,
+            seed=seed,
+            group_size=group_size,
+            exclusions=exclusions,
+            time_budget=time_budget,
+            target_score=target_score,
+            alternatives=alternatives,
+        )
+
+    # Groups are laid out the same in every permutation
+    group_size = group_size or GROUP_SIZE
+    layout = None
+    if group_size != 2:
+        layout = split_groups(list(range(len(emails))), group_size)
+
+    index = build_history_index(history)
+    pair_scores = PairScores(emails, index)
+    rng = np.random.default_rng(seed)
+    metrics = get_metrics()
+
+    def pairing(permutation):
+        if layout is not None:
+            return [[emails[permutation[x]] for x in group] for group in layout]
+        return permutation_pairs(permutation, emails)
+
+    best_score = None
+    top = TopPairings(alternatives)
+    budget = SearchBudget.for_samples(sample_count, time_budget, target_score)
+    samples = 0
+    while not budget.is_done(samples, top.bound()):
+        batch_size = NUMPY_BATCH_SIZE
+        if sample_count is not None:
+            batch_size = min(budget.steps - samples, NUMPY_BATCH_SIZE)
+        samples += batch_size
+
+        permutations = rng.permuted(
+            np.tile(np.arange(len(emails), dtype=np.int64), (batch_size, 1)), axis=1
+        )
+        if layout is not None:
+            scores = score_group_permutations(permutations, layout, pair_scores)
+        else:
+            scores = score_permutations(permutations, emails, index, pair_scores)
+        metrics.count("samples evaluated", batch_size)
+
+        # Only the best of a batch can be kept, in sample order for ties
+        kept = min(top.size, batch_size)
+        best = np.argpartition(scores, kept - 1)[:kept]
+        for b in sorted(best, key=lambda b: (scores[b], b)):
+            if not top.would_keep(int(scores[b])):
+                break
+            top.push(int(scores[b]), pairing(permutations[b]))
+
+        if best_score is None or scores[best].min() < best_score:
+            best_score = int(scores[best].min())
+            metrics.record("best score", best_score)
+
+    return top.pairings()
+
+
+def calculate_history_scores(pairings, history):
+    """
+    Score many pairings at once; each score is the same as
+    `synapse.cli.calculate_history_score` would give.
+
+    :param pairings: List of pairings, each a list of pairs of emails, with
+        an optional triple as the last group.
+    :param history: `HistoryIndex` or list of previous pairings.
+    :returns: List of scores.
+    """
+
+    if not pairings:
+        return []
+
+    index = build_history_index(history)
+
+    # Intern emails to ids, and group pairings by shape so each shape can be
+    # scored as one array
+    emails = sorted({email for pairs in pairings for pair in pairs for email in pair})
+    ids = {email: i for i, email in enumerate(emails)}
+    pair_scores = PairScores(emails, index)
+
+    results = [0] * len(pairings)
+    shapes = {}
+    for p, pairs in enumerate(pairings):
+        shape = tuple(len(pair) for pair in pairs)
+        shapes.setdefault(shape, []).append(p)
+
+    for shape, positions in shapes.items():
+        # Only pairs with an optional last triple are laid out as permutations
+        if (
+            not shape
+            or any(size != 2 for size in shape[:-1])
+            or shape[-1] not in (2, 3)
+        ):
+            for p in positions:
+                results[p] = index.score(pairings[p])
+            continue
+
+        permutations = np.array(
+            [[ids[email] for pair in pairings[p] for email in pair] for p in positions],
+            dtype=np.int64,
+        )
+        scores = score_permutations(permutations, emails, index, pair_scores)
+        for p, score in zip(positions, scores):
+            results[p] = int(score)
+
+    return results
@@ -0,0 +1,74 @@
+# Deps for testing
+import pytest
+
+# Deps to test
+from synapse.backends import (
+    FileBackend,
+    SheetBackend,
+    column_letters,
+    get_backend,
+    parse_backend_uri,
+)
+
+
+def test_parse_backend_uri():
+    assert parse_backend_uri("gsheet://abc123/2") == ("gsheet", ("abc123", "2"), {})
+    assert parse_backend_uri("gsheet://abc123") == ("gsheet", ("abc123", "0"), {})
+    assert parse_backend_uri("file:///data/roster%201.csv?history=/tmp/h.jsonl") == (
+        "file",
+        "/data/roster 1.csv",
+        {"history": "/tmp/h.jsonl"},
+    )
+    assert parse_backend_uri("roster.csv") == ("file", "roster.csv", {})
+
+    with pytest.raises(Exception):
+        parse_backend_uri("ftp://example.com/roster.csv")
+
+
+def test_file_backend(tmp_path):
+    roster = tmp_path / "roster.csv"
+    roster.write_text("Email,Name\nex1@a.bc,Ex 1\n\n ex2@a.bc \n")
+
+    backend = FileBackend(str(roster))
+    assert backend.history == str(tmp_path / "roster-history.jsonl")
+    assert list(backend.read_emails()) == ["Email", "ex1@a.bc", "ex2@a.bc"]
+    assert not backend.has_history()
+    assert list(backend.read_history()) == []
+
+    backend.append_history([("2022-01-01T00:00:00", [["ex1@a.bc", "ex2@a.bc"]])])
+    backend.append_history([("2022-01-08T00:00:00", [])])
+    with open(backend.history, "a") as f:
+        f.write("not json\n")
+
+    assert backend.has_history()
+    assert list(backend.read_history()) == [
+        ("2022-01-01T00:00:00", [["ex1@a.bc", "ex2@a.bc"]]),
+        ("2022-01-08T00:00:00", []),
+    ]
+
+
+def test_get_backend(tmp_path):
+    backend = get_backend(f"file://{tmp_path / 'roster.csv'}?url=https://a.bc/")
+    assert isinstance(backend, FileBackend)
+    assert backend.url() == "https://a.bc/"
+    assert backend.history_key() == ("file", str(tmp_path / "roster-history.jsonl"))
+
+    # A local path is never linked to
+    assert get_backend(str(tmp_path / "roster.csv")).url() is None
+
+    backend = get_backend("gsheet://abc123/2")
+    assert isinstance(backend, SheetBackend)
+    assert backend.url() == "https://docs.google.com/spreadsheets/d/abc123/edit#gid=2"
+    assert backend.history_key() == ("gsheet", "abc123")
+
+
+def test_column_letters():
+    assert [column_letters(i) for i in [0, 1, 25, 26, 27, 701, 702]] == [
+        "A",
+        "B",
+        "Z",
+        "AA",
+        "AB",
+        "ZZ",
+        "AAA",
+    ]
@@ -0,0 +1,51 @@
+# Deps for testing
+import pytest
+
+# Deps to test
+from synapse.blossom import max_weight_matching
+
+
+def matching_weight(edges, mate):
+    weights = {(i, j): wt for (i, j, wt) in edges}
+    return sum(weights.get((v, w), 0) for v, w in enumerate(mate) if w > v)
+
+
+def test_max_weight_matching():
+    # Nothing to match
+    assert max_weight_matching(2, []) == ([-1, -1], [0, 0])
+
+    # Single edge
+    mate, dual = max_weight_matching(2, [(0, 1, 1)])
+    assert mate == [1, 0]
+
+    # Path where the middle edge is heaviest but the outside edges are better
+    edges = [(0, 1, 5), (1, 2, 6), (2, 3, 5)]
+    mate, dual = max_weight_matching(4, edges)
+    assert mate == [1, 0, 3, 2]
+
+    # Odd cycle that needs a blossom
+    edges = [(0, 1, 8), (0, 2, 9), (1, 2, 10), (2, 3, 7)]
+    mate, dual = max_weight_matching(4, edges)
+    assert matching_weight(edges, mate) == 15
+
+    # Nested blossoms
+    edges = [
+        (0, 1, 9),
+        (0, 2, 9),
+        (1, 2, 10),
+        (1, 3, 8),
+        (2, 4, 8),
+        (3, 4, 10),
+        (4, 5, 6),
+    ]
+    mate, dual = max_weight_matching(6, edges)
+    assert mate == [2, 3, 0, 1, 5, 4]
+
+    # Starting matching is kept if it is already optimal
+    edges = [(0, 1, 2), (1, 2, 2), (2, 3, 2)]
+    mate, dual = max_weight_matching(4, edges, mate=[1, 0, 3, 2])
+    assert mate == [1, 0, 3, 2]
+
+    # Starting matching is improved on
+    mate, dual = max_weight_matching(4, edges, mate=[-1, 2, 1, -1])
+    assert mate == [1, 0, 3, 2]
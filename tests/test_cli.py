@@ -1,55 +1,50 @@
 # Deps for testing
+import json
+import subprocess
+import sys
+from email import message_from_string
+from email.header import decode_header as email_decode_header, make_header
+
 import pytest
 from freezegun import freeze_time
 
 # Deps to test
+from synapse import cli
+from synapse import metrics as metrics_module
+from synapse import sheets
 from synapse.cli import (
-    pair_emails,
+    HISTORY_HEADERS,
+    HISTORY_SHEET_NAME,
     calculate_history_score,
     has_pair_in_pairs,
     filter_emails,
     convert_date_to_score,
+    build_history,
+    build_history_from_store,
+    compact_history_rows,
+    compact_roster_history,
+    compile_template,
+    render_template,
+    render_emails,
+    report_metrics,
+    encode_header,
+    read_exclusions,
+    read_history,
+    read_roster,
+    read_spreadsheet,
+    roster_url,
+    save_roster_history,
+    send_round,
+    save_history,
+    sync_history_store,
+    transform_history_rows,
 )
-
-
-def test_pair_emails():
-    test_emails = [
-        "ex1@a.bc",
-        "ex2@a.bc",
-        "ex3@a.bc",
-        "ex4@a.bc",
-        "ex5@a.bc",
-        "ex6@a.bc",
-        "ex7@a.bc",
-        "ex8@a.bc",
-        "ex9@a.bc",
-    ]
-
-    # Test basic example
-    test_score, test_pairs = pair_emails(test_emails)
-    assert test_score == 0
-    assert len(test_pairs) == 4
-    assert len(test_pairs[0]) == 2
-    assert len(test_pairs[1]) == 2
-    assert len(test_pairs[2]) == 2
-    assert len(test_pairs[3]) == 3
-
-    # Test not enough
-    assert pair_emails([]) == (0, [])
-    assert pair_emails(["a@b.com"]) == (0, [])
-
-    # Test with history
-    test_history = [
-        {
-            "score": 100,
-            "pairs": [
-                ["ex1@a.bc", "ex2@a.bc"],
-                ["ex3@a.bc", "ex4@a.bc"],
-            ],
-        },
-    ]
-    test_score, test_pairs_with_history = pair_emails(test_emails, history=test_history)
-    assert len(test_pairs_with_history) == 4
+from synapse.exclusions import ExclusionIndex
+from synapse.history import HistoryIndex
+from synapse.journal import SendJournal
+from synapse.matching import pair_emails
+from synapse.sheets import SheetsScheduler
+from synapse.store import HistoryStore
 
 
 def test_calculate_history_score():
@@ -159,3 +154,841 @@ def test_convert_date_to_score():
     assert convert_date_to_score("2021-12-01T01:01:01") == 300 - 31
     assert convert_date_to_score("2022-01-01T01:01:01") == 300 - 0
     assert convert_date_to_score("2019-12-01T01:01:01") == 1
+
+
+def test_compile_template():
+    test_template = compile_template("Hi [[[NAMES]]], see [[[URL]]].")
+    assert test_template == ["Hi ", "NAMES", ", see ", "URL", "."]
+    assert compile_template("No slots") == ["No slots"]
+
+    assert (
+        render_template(test_template, {"NAMES": "A and B", "URL": "x"})
+        == "Hi A and B, see x."
+    )
+    with pytest.raises(KeyError):
+        render_template(test_template, {"NAMES": "A and B"})
+
+
+def test_encode_header():
+    assert encode_header("Plain subject") == "Plain subject"
+
+    test_encoded = encode_header("1:1 time for Ex1 and Ex2! ☕️ " * 3)
+    assert decode_header(test_encoded) == "1:1 time for Ex1 and Ex2! ☕️ " * 3
+    assert all(len(word) <= 75 for word in test_encoded.split("\n "))
+
+
+def test_render_emails():
+    test_pairs = [
+        ["ex1.a@a.bc", "ex2.b@a.bc"],
+        ["ex3.c@a.bc", "ex4.d@a.bc", "éx5.e@a.bc"],
+    ]
+    test_messages = render_emails(test_pairs, "SPREADSHEET", "0", from_="me@a.bc")
+    assert len(test_messages) == 2
+
+    for (from_, to, message), pair in zip(test_messages, test_pairs):
+        assert from_ == "me@a.bc"
+        assert to == pair
+
+        parsed = message_from_string(message)
+        assert decode_header(parsed["From"]) == "me@a.bc"
+        assert decode_header(parsed["To"]) == ",".join(pair)
+
+        text, html = [
+            part.get_payload(decode=True).decode() for part in parsed.get_payload()
+        ]
+        assert "[[[" not in text and "[[[" not in html
+        assert "SPREADSHEET" in text and "SPREADSHEET" in html
+
+    test_text, test_html = message_from_string(test_messages[0][2]).get_payload()
+    assert "Hi Ex1 and Ex2," in test_text.get_payload()
+    assert "<strong>Ex1</strong> and <strong>Ex2</strong>" in test_html.get_payload()
+
+    # Without a spreadsheet or URL, like a local roster, people email the sender
+    message = render_emails(test_pairs[:1], None, None, from_="me@a.bc")[0][2]
+    text = message_from_string(message).get_payload()[0].get_payload(decode=True)
+    assert "mailto:me@a.bc" in text.decode()
+    assert "file://" not in message
+
+
+class FakeSpreadsheet:
+    """Spreadsheet with the parts of the gspread API that are used."""
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.requests = []
+
+    def open(self, key, fields):
+        self.requests.append("open")
+        return (
+            self,
+            {
+                "sheets": [
+                    {"properties": {"sheetId": i, "title": title, "index": i}}
+                    for i, title in enumerate(self.sheets)
+                ]
+            },
+        )
+
+    def values_batch_get(self, ranges):
+        self.requests.append(("get", ranges))
+        value_ranges = []
+        for range_name in ranges:
+            title, cells = range_name.rsplit("!", 1)
+            rows = self.sheets[title[1:-1]]
+            first, last = cells.split(":")
+            start = int(first[1:] or 1)
+            end = int(last[1:]) if last[1:] else len(rows)
+            width = 1 if last[0] == "A" else 2
+            value_ranges.append(
+                {"values": [row[:width] for row in rows[start - 1 : end]]}
+            )
+
+        return {"valueRanges": value_ranges}
+
+    def batch_update(self, body):
+        self.requests.append(("update", [list(r.keys())[0] for r in body["requests"]]))
+        titles = list(self.sheets)
+        for request in body["requests"]:
+            if "addSheet" in request:
+                self.sheets[request["addSheet"]["properties"]["title"]] = []
+                titles = list(self.sheets)
+            elif "appendCells" in request:
+                sheet = self.sheets[titles[request["appendCells"]["sheetId"]]]
+                for row in request["appendCells"]["rows"]:
+                    sheet.append(
+                        [v["userEnteredValue"]["stringValue"] for v in row["values"]]
+                    )
+
+
+@pytest.fixture
+def fake_spreadsheet(monkeypatch):
+    spreadsheet = FakeSpreadsheet(
+        {"Emails": [["Email"], ["ex1@a.bc"], ["nope@x.yz"], ["EX2@a.bc"]]}
+    )
+    monkeypatch.setattr(cli, "global_gpread_client", spreadsheet)
+    monkeypatch.setattr(
+        sheets, "open_spreadsheet", lambda client, key, fields: client.open(key, fields)
+    )
+    monkeypatch.setattr(cli, "global_spreadsheet_sessions", {})
+    monkeypatch.setattr(cli, "global_sheets_scheduler", None)
+    monkeypatch.setenv("SYNAPSE_VALID_EMAIL_REGEX", "@a\\.bc$")
+
+    return spreadsheet
+
+
+def test_read_spreadsheet(fake_spreadsheet, monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, "global_sheets_scheduler", SheetsScheduler(None))
+
+    # No history yet
+    assert read_spreadsheet("id", "0", cache_directory=str(tmp_path)) == (
+        ["ex1@a.bc", "ex2@a.bc"],
+        None,
+    )
+
+    # First save makes the sheet, with its header, in one request
+    save_history([["ex1@a.bc", "ex2@a.bc"]], "id")
+    assert fake_spreadsheet.requests[-1] == (
+        "update",
+        ["addSheet", "repeatCell", "appendCells"],
+    )
+    assert fake_spreadsheet.sheets[HISTORY_SHEET_NAME][0] == HISTORY_HEADERS
+
+    # Later saves only append
+    save_history([["ex1@a.bc", "ex3@a.bc"]], "id")
+    assert fake_spreadsheet.requests[-1] == ("update", ["appendCells"])
+
+    # Emails and history in one request, and the spreadsheet is opened once
+    emails, history = read_spreadsheet("id", "0", cache_directory=str(tmp_path))
+    assert emails == ["ex1@a.bc", "ex2@a.bc"]
+    assert len(history) == 2
+    assert history.pair_score("ex1@a.bc", "ex3@a.bc") == 300
+    assert fake_spreadsheet.requests.count("open") == 1
+    assert fake_spreadsheet.requests[-1] == (
+        "get",
+        ["'Emails'!A:A", f"'{HISTORY_SHEET_NAME}'!A1:B"],
+    )
+
+    # Only new rows after that
+    save_history([["ex2@a.bc", "ex3@a.bc"]], "id")
+    assert len(read_history(cache_directory=str(tmp_path), spreadsheet="id")) == 3
+    assert fake_spreadsheet.requests[-1] == (
+        "get",
+        [f"'{HISTORY_SHEET_NAME}'!A3:B", f"'{HISTORY_SHEET_NAME}'!A2:B2"],
+    )
+
+    # A row edited before the last one is noticed when checked
+    fake_spreadsheet.sheets[HISTORY_SHEET_NAME][1][0] = "2021-01-01T00:00:00"
+    history = read_history(cache_directory=str(tmp_path), spreadsheet="id")
+    assert history.pair_score("ex1@a.bc", "ex2@a.bc") == 1
+    assert fake_spreadsheet.requests[-1] == (
+        "get",
+        [f"'{HISTORY_SHEET_NAME}'!A:B"],
+    )
+
+    # So are its pairs, and only a few rows are checked however many there are
+    fake_spreadsheet.sheets[HISTORY_SHEET_NAME][1][1] = '[["ex1@a.bc", "ex4@a.bc"]]'
+    cli.get_sheets_scheduler().invalidate("id")
+    history = read_history(cache_directory=str(tmp_path), spreadsheet="id")
+    assert history.pair_score("ex1@a.bc", "ex4@a.bc") == 1
+
+    # Without the local copy
+    assert len(read_history(use_cache=False, spreadsheet="id")) == 3
+    assert fake_spreadsheet.requests[-1] == (
+        "get",
+        [f"'{HISTORY_SHEET_NAME}'!A1:B"],
+    )
+
+    # Only a few rows are checked, however many there are
+    fake_spreadsheet.sheets[HISTORY_SHEET_NAME] += [["2022-01-01T00:00:00", "[]"]] * 20
+    cli.get_sheets_scheduler().invalidate("id")
+    read_history(cache_directory=str(tmp_path), spreadsheet="id")
+    read_history(cache_directory=str(tmp_path), spreadsheet="id")
+    ranges = fake_spreadsheet.requests[-1][1]
+    assert ranges[0] == f"'{HISTORY_SHEET_NAME}'!A24:B"
+    assert len(ranges) == 1 + cli.HISTORY_CHECK_ROWS
+
+
+class FakeServerError(Exception):
+    code = 503
+
+
+def test_save_history_retries(fake_spreadsheet, monkeypatch):
+    monkeypatch.setattr(
+        cli, "global_sheets_scheduler", SheetsScheduler(None, sleeper=lambda s: None)
+    )
+    batch_update = fake_spreadsheet.batch_update
+
+    # A history sheet that failed to be made is not thought to be there
+    def failing_update(body):
+        raise Exception("Invalid request")
+
+    monkeypatch.setattr(fake_spreadsheet, "batch_update", failing_update)
+    with pytest.raises(Exception, match="Invalid request"):
+        save_history([["ex1@a.bc", "ex2@a.bc"]], "id")
+    assert cli.get_spreadsheet_session("id").sheet_by_title(HISTORY_SHEET_NAME) is None
+
+    monkeypatch.setattr(fake_spreadsheet, "batch_update", batch_update)
+    save_history([["ex1@a.bc", "ex2@a.bc"]], "id")
+    assert fake_spreadsheet.requests[-1] == (
+        "update",
+        ["addSheet", "repeatCell", "appendCells"],
+    )
+    assert cli.get_spreadsheet_session("id").sheet_by_title(HISTORY_SHEET_NAME)
+    failures = []
+
+    def flaky_update(body):
+        # Fail before or after making the changes
+        failure = failures.pop(0) if failures else None
+        if failure == "before":
+            raise FakeServerError()
+        batch_update(body)
+        if failure == "after":
+            raise FakeServerError()
+
+    monkeypatch.setattr(fake_spreadsheet, "batch_update", flaky_update)
+
+    # Made despite the error, so the round is not appended twice
+    failures.append("after")
+    save_history([["ex1@a.bc", "ex3@a.bc"]], "id")
+    assert len(fake_spreadsheet.sheets[HISTORY_SHEET_NAME]) == 3
+    assert fake_spreadsheet.requests[-1] == ("get", [f"'{HISTORY_SHEET_NAME}'!A:B"])
+
+    # Not made, so it is made again
+    failures.append("before")
+    save_history([["ex2@a.bc", "ex3@a.bc"]], "id")
+    assert len(fake_spreadsheet.sheets[HISTORY_SHEET_NAME]) == 4
+    assert fake_spreadsheet.requests[-1] == ("update", ["appendCells"])
+
+
+def test_read_roster(fake_spreadsheet, tmp_path):
+    # Local files
+    roster_file = tmp_path / "roster.csv"
+    roster_file.write_text("Email\nex1@a.bc\nnope@x.yz\nEX2@a.bc\nex3@a.bc\n")
+    roster = f"file://{roster_file}"
+
+    assert read_roster(roster) == (["ex1@a.bc", "ex2@a.bc", "ex3@a.bc"], None)
+    save_roster_history(roster, [["ex1@a.bc", "ex2@a.bc"]])
+    emails, history = read_roster(roster)
+    assert history.pair_score("ex1@a.bc", "ex2@a.bc") == 300
+    assert (tmp_path / "roster-history.jsonl").exists()
+    assert roster_url(roster) is None
+    assert roster_url(f"{roster}?url=https://a.bc/") == "https://a.bc/"
+
+    # Google Spreadsheets
+    roster = "gsheet://id/0"
+    assert read_roster(roster, cache_directory=str(tmp_path)) == (
+        ["ex1@a.bc", "ex2@a.bc"],
+        None,
+    )
+    save_roster_history(roster, [["ex1@a.bc", "ex2@a.bc"]])
+    assert len(read_roster(roster, cache_directory=str(tmp_path))[1]) == 1
+    assert roster_url(roster).endswith("/d/id/edit#gid=0")
+
+
+def test_read_exclusions(fake_spreadsheet, tmp_path):
+    assert read_exclusions("gsheet://id/0") is None
+
+    # A column of the roster, and a file
+    roster_file = tmp_path / "roster.csv"
+    roster_file.write_text("Email,Avoid\nex1@a.bc,ex2@a.bc\nex2@a.bc\nex3@a.bc,\n")
+    exclusions_file = tmp_path / "exclusions.csv"
+    exclusions_file.write_text("ex3@a.bc,ex4@a.bc\n")
+    exclusions = read_exclusions(
+        f"file://{roster_file}", column="B", filename=str(exclusions_file)
+    )
+    assert sorted(sorted(pair) for pair in exclusions.pairs()) == [
+        ["ex1@a.bc", "ex2@a.bc"],
+        ["ex3@a.bc", "ex4@a.bc"],
+    ]
+
+    # Google Spreadsheets
+    fake_spreadsheet.sheets["Emails"][1].append("EX2@a.bc, ex3@a.bc")
+    exclusions = read_exclusions("gsheet://id/0", column="B")
+    assert sorted(sorted(pair) for pair in exclusions.pairs()) == [
+        ["ex1@a.bc", "ex2@a.bc"],
+        ["ex1@a.bc", "ex3@a.bc"],
+    ]
+
+
+class FakeMailer:
+    def __init__(self, fail_after=None, reject=()):
+        self.sent = []
+        self.fail_after = fail_after
+        self.reject = set(reject)
+
+    def send_all(self, messages, on_sent=None, on_failed=None):
+        for i, (from_, to, message) in enumerate(messages):
+            if self.fail_after is not None and len(self.sent) >= self.fail_after:
+                raise Exception("Interrupted")
+            if self.reject & set(to):
+                on_failed(i, Exception("550 No such user"))
+                continue
+
+            self.sent.append(to)
+            on_sent(i)
+
+    def quit(self):
+        pass
+
+
+@freeze_time("2022-01-01T12:00:00")
+def test_send_round(monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, "HISTORY_FLUSH_SIZE", 2)
+    monkeypatch.setenv("SYNAPSE_VALID_EMAIL_REGEX", "@a\\.bc$")
+    roster_file = tmp_path / "roster.csv"
+    roster_file.write_text("ex1@a.bc\n")
+    roster = f"file://{roster_file}"
+    pairs = [[f"ex{i}@a.bc", f"ex{i + 1}@a.bc"] for i in range(0, 10, 2)]
+
+    journal = SendJournal(str(tmp_path / "journal.jsonl"))
+    journal.start(roster, "2022-01-01T00:00:00", pairs)
+
+    # Interrupted after 3 emails; what was sent is saved
+    monkeypatch.setattr(cli, "global_mail_handler", FakeMailer(fail_after=3))
+    with pytest.raises(Exception):
+        send_round(journal, "id", "0")
+    assert journal.pending() == [3, 4]
+    assert journal.unsaved() == []
+    assert len(read_roster(roster)[1]) == 1
+    assert read_roster(roster)[1].pair_score("ex4@a.bc", "ex5@a.bc") == 300
+
+    # Resuming only sends the rest
+    mailer = FakeMailer()
+    monkeypatch.setattr(cli, "global_mail_handler", mailer)
+    send_round(SendJournal(journal.filename), "id", "0")
+    assert mailer.sent == [["ex6@a.bc", "ex7@a.bc"], ["ex8@a.bc", "ex9@a.bc"]]
+
+    # Saved in batches, but still one round
+    history = read_roster(roster)[1]
+    assert len(history) == 1
+    assert sum(1 for line in open(tmp_path / "roster-history.jsonl")) == 3
+    assert history.pair_score("ex8@a.bc", "ex9@a.bc") == 300
+
+    # A rejected email is put aside, and not sent again when resuming
+    journal.start(roster, "2022-01-02T00:00:00", pairs)
+    mailer = FakeMailer(fail_after=3, reject=["ex2@a.bc"])
+    monkeypatch.setattr(cli, "global_mail_handler", mailer)
+    with pytest.raises(Exception, match="Interrupted"):
+        send_round(journal, "id", "0")
+    assert journal.failed == {1}
+    assert journal.pending() == [4]
+
+    mailer = FakeMailer(reject=["ex2@a.bc"])
+    monkeypatch.setattr(cli, "global_mail_handler", mailer)
+    assert send_round(SendJournal(journal.filename), "id", "0") == []
+    assert mailer.sent == [["ex8@a.bc", "ex9@a.bc"]]
+    assert SendJournal(journal.filename).is_finished()
+    saved = [
+        pair
+        for line in open(tmp_path / "roster-history.jsonl")
+        if json.loads(line)["date"] == "2022-01-02T00:00:00"
+        for pair in json.loads(line)["pairs"]
+    ]
+    assert ["ex2@a.bc", "ex3@a.bc"] not in saved
+    assert len(saved) == 4
+
+
+def test_outbox_delivery(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(cli, "HISTORY_FLUSH_SIZE", 2)
+    monkeypatch.setenv("SYNAPSE_VALID_EMAIL_REGEX", "@a\\.bc$")
+    roster_file = tmp_path / "roster.csv"
+    roster_file.write_text("".join(f"ex{i}@a.bc\n" for i in range(10)))
+    roster = f"file://{roster_file}"
+    outbox = str(tmp_path / "outbox")
+    arguments = ["synapse", "--outbox", outbox, "--cache-dir", str(tmp_path / "c")]
+
+    # Pairing writes to the outbox instead of sending
+    mailer = FakeMailer(fail_after=3)
+    monkeypatch.setattr(cli, "global_mail_handler", mailer)
+    monkeypatch.setattr(sys, "argv", arguments + ["--roster", roster, "--send"])
+    cli.main()
+    assert mailer.sent == []
+    assert len(cli.Outbox(outbox).pending()) == 5
+    assert "Wrote 5 emails" in capsys.readouterr().err
+
+    # Not paired again until delivered
+    with pytest.raises(Exception, match="run the deliver subcommand first"):
+        cli.main()
+
+    # Interrupted after 3 emails; what was sent is saved
+    monkeypatch.setattr(sys, "argv", arguments + ["deliver"])
+    with pytest.raises(Exception, match="Interrupted"):
+        cli.main()
+    assert len(cli.Outbox(outbox).pending()) == 2
+    assert cli.Outbox(outbox).unsaved() == []
+    assert read_roster(roster)[1].pair_score(*mailer.sent[2]) == 300
+
+    # Delivering again only sends the rest, in the same round
+    mailer = FakeMailer()
+    monkeypatch.setattr(cli, "global_mail_handler", mailer)
+    cli.main()
+    assert len(mailer.sent) == 2
+    assert cli.Outbox(outbox).rosters() == {}
+    history = read_roster(roster)[1]
+    assert len(history) == 1
+    assert history.pair_score(*mailer.sent[1]) == 300
+
+    cli.main()
+    assert "Nothing to deliver" in capsys.readouterr().err
+
+    # A rejected email is flagged and reported, and the rest are delivered
+    monkeypatch.setattr(sys, "argv", arguments + ["--roster", roster, "--send"])
+    cli.main()
+    mailer = FakeMailer(reject=[mailer.sent[0][0]])
+    monkeypatch.setattr(cli, "global_mail_handler", mailer)
+    monkeypatch.setattr(sys, "argv", arguments + ["deliver"])
+    cli.main()
+    assert "1 emails were rejected" in capsys.readouterr().err
+    assert len(mailer.sent) == 4
+    assert len(cli.Outbox(outbox).failed()) == 1
+    assert cli.Outbox(outbox).rosters() == {}
+    assert len(read_roster(roster)[1]) == 2
+
+
+def test_run_batch(fake_spreadsheet, monkeypatch, tmp_path, capsys):
+    (tmp_path / "a.csv").write_text("ex1@a.bc\nex2@a.bc\nex3@a.bc\nex4@a.bc\n")
+    (tmp_path / "b.csv").write_text("ex5@a.bc\nex6@a.bc\nex7@a.bc\n")
+    config = tmp_path / "batch.json"
+    config.write_text(
+        json.dumps(
+            {
+                "rosters": [
+                    f"file://{tmp_path / 'a.csv'}",
+                    {"roster": f"file://{tmp_path / 'b.csv'}", "seed": 1},
+                    {"spreadsheet": "id", "matcher": "anneal"},
+                    f"file://{tmp_path / 'missing.csv'}",
+                ]
+            }
+        )
+    )
+    mailer = FakeMailer()
+    monkeypatch.setattr(cli, "global_mail_handler", mailer)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "synapse",
+            "--config",
+            str(config),
+            "--send",
+            "--workers",
+            "2",
+            "--cache-dir",
+            str(tmp_path / "cache"),
+        ],
+    )
+
+    # A roster that fails does not stop the others
+    with pytest.raises(Exception, match="1 of 4 rosters failed"):
+        cli.main()
+    assert len(mailer.sent) == 4
+    assert len(read_roster(f"file://{tmp_path / 'a.csv'}")[1]) == 1
+    assert len(read_roster(f"file://{tmp_path / 'b.csv'}")[1]) == 1
+    assert HISTORY_SHEET_NAME in fake_spreadsheet.sheets
+    assert fake_spreadsheet.requests.count("open") == 1
+
+    output = capsys.readouterr().err
+    assert "a.csv: sent (4 emails in 2 pairs, score 0)" in output
+    assert "gsheet://id/0: sent (2 emails in 1 pairs, score 0)" in output
+    assert "missing.csv: failed" in output
+
+    # Options are checked
+    config.write_text(json.dumps({"rosters": [{"roster": "x.csv", "size": 3}]}))
+    with pytest.raises(Exception, match="Unknown options"):
+        cli.read_batch_config(str(config))
+
+
+def test_pair_emails_cached(monkeypatch, tmp_path):
+    emails = [f"ex{i}@a.bc" for i in range(10)]
+    history = HistoryIndex([{"score": 300, "pairs": [emails[0:2]]}])
+    calls = []
+
+    def pair_emails_alternatives(emails, history=None, alternatives=1, **options):
+        calls.append(options)
+        return [
+            (x, [emails[i : i + 2] for i in range(x, len(emails) - 1, 2)])
+            for x in range(alternatives)
+        ]
+
+    monkeypatch.setattr(cli, "pair_emails_alternatives", pair_emails_alternatives)
+
+    def pair(**options):
+        return cli.pair_emails_cached(
+            emails, history=history, cache_directory=str(tmp_path), **options
+        )
+
+    # A preview and then a send get the same pairs, paired once
+    assert pair(sample_count=10) == pair(sample_count=10)
+    assert len(calls) == 1
+
+    # Other options, or a new round in history, pair again
+    pair(sample_count=20)
+    assert len(calls) == 2
+    history.add_round([emails[2:4]], 300)
+    pair(sample_count=10)
+    assert len(calls) == 3
+
+    # Exclusions are part of the key
+    pair(sample_count=10, exclusions=ExclusionIndex([(emails[0], emails[1])]))
+    assert len(calls) == 4
+    assert "exclusions" in calls[-1]
+
+    # Unless turned off or expired
+    pair(sample_count=10, use_cache=False)
+    pair(sample_count=10, max_age=0)
+    assert len(calls) == 6
+
+    # A declined pairing is not offered again
+    score, pairs = pair(sample_count=30)
+    cli.discard_cached_pairing(pairs, str(tmp_path))
+    pair(sample_count=30)
+    assert len(calls) == 8
+
+    # Alternatives are kept together, and are part of the key
+    pairings = cli.pair_emails_alternatives_cached(
+        emails, history=history, cache_directory=str(tmp_path), alternatives=2
+    )
+    assert len(pairings) == 2
+    assert (
+        cli.pair_emails_alternatives_cached(
+            emails, history=history, cache_directory=str(tmp_path), alternatives=2
+        )
+        == pairings
+    )
+    assert len(calls) == 9
+    cli.discard_cached_pairing(pairings[1][1], str(tmp_path))
+    cli.pair_emails_alternatives_cached(
+        emails, history=history, cache_directory=str(tmp_path), alternatives=2
+    )
+    assert len(calls) == 10
+
+
+def test_simulate_rounds():
+    emails = [f"ex{i}@a.bc" for i in range(6)]
+    history = HistoryIndex([{"score": 300, "pairs": [emails[0:2], emails[2:4]]}])
+    results = list(
+        cli.simulate_rounds(
+            emails, history=history, rounds=8, interval=7, sample_count=50, seed=1
+        )
+    )
+
+    # Each round is added to history, which ages in between
+    assert [result["day"] for result in results] == [0, 7, 14, 21, 28, 35, 42, 49]
+    assert len(history) == 9
+    assert history.round_scores == [251, 251, 258, 265, 272, 279, 286, 293, 300]
+    assert all(result["pairs"] == 3 for result in results)
+
+    # Six people can only meet five others, so some meet again
+    assert results[0]["repeats"] == 0
+    assert sum(result["repeats"] for result in results) > 0
+    assert "Repeat rate" in cli.summarize_simulation(results)
+
+    # The same seed gives the same rounds
+    again = cli.simulate_rounds(
+        emails,
+        history=HistoryIndex([{"score": 300, "pairs": [emails[0:2], emails[2:4]]}]),
+        rounds=8,
+        sample_count=50,
+        seed=1,
+    )
+    assert [result["score"] for result in again] == [
+        result["score"] for result in results
+    ]
+
+
+def test_run_simulation(monkeypatch, capsys):
+    monkeypatch.delenv("SYNAPSE_MATCHER", raising=False)
+    pair_emails = cli.pair_emails
+    matchers = []
+
+    def spy(emails, history=None, **options):
+        matchers.append((options["matcher"], options["sample_count"]))
+        return pair_emails(emails, history=history, **options)
+
+    monkeypatch.setattr(cli, "pair_emails", spy)
+
+    # The anneal matcher, with its own number of swaps, unless asked otherwise
+    monkeypatch.setattr(
+        sys, "argv", ["synapse", "simulate", "--people", "6", "--rounds", "2"]
+    )
+    cli.main()
+    assert matchers == [("anneal", None)] * 2
+    assert "Repeat rate" in capsys.readouterr().out
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "synapse",
+            "--matcher",
+            "random",
+            "simulate",
+            "--people",
+            "6",
+            "--rounds",
+            "1",
+        ],
+    )
+    cli.main()
+    assert matchers[-1] == ("random", None)
+
+
+def test_simulate_rounds_window():
+    emails = [f"ex{i}@a.bc" for i in range(4)]
+    history = HistoryIndex(
+        [
+            {"score": 1, "pairs": [emails[0:2]]},
+            {"score": 250, "pairs": [emails[2:4]]},
+        ]
+    )
+
+    # A longer window scores live rounds again, but not expired ones
+    results = cli.simulate_rounds(emails, history=history, rounds=0, window=400)
+    assert list(results) == []
+    assert history.round_scores[:2] == [1, 350]
+    assert history.pair_score(*emails[0:2]) == 1
+    assert history.pair_score(*emails[2:4]) == 350
+
+
+def test_report_metrics(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(metrics_module, "global_metrics", None)
+    # Everyone met before, so sampling does not stop early at a score of 0
+    emails = [f"ex{i}@a.bc" for i in range(10)]
+    history = [{"score": 10, "pairs": [emails]}]
+    pair_emails(emails, history=history, sample_count=10)
+
+    report_metrics(timings=True, metrics_json=str(tmp_path / "metrics.json"))
+    assert "pair emails" in capsys.readouterr().err
+
+    with open(tmp_path / "metrics.json") as f:
+        metrics = json.load(f)
+    assert metrics["spans"]["pair emails"]["count"] == 1
+    assert metrics["counters"]["samples evaluated"] == 10
+
+
+@freeze_time("2022-01-01T12:00:00")
+def test_compact_history_rows():
+    rows = [
+        ("2020-06-01T00:00:00", '[["ex1@a.bc", "ex2@a.bc"]]'),
+        ("2020-06-01T00:00:00", [["ex3@a.bc", "ex4@a.bc"]]),
+        ("2021-12-01T00:00:00", '[["ex1@a.bc", "ex2@a.bc"]]'),
+        ("2020-06-08T00:00:00", "not json"),
+    ]
+    snapshot, kept, expired = compact_history_rows(rows)
+    assert expired == [0, 1, 3]
+    assert kept == [rows[2]]
+    assert snapshot.rounds == 1
+    assert snapshot.pair_counts == {
+        ("ex1@a.bc", "ex2@a.bc"): 1,
+        ("ex3@a.bc", "ex4@a.bc"): 1,
+    }
+
+    # Added to an existing snapshot
+    snapshot, kept, expired = compact_history_rows(rows[:1], snapshot.as_dict())
+    assert snapshot.pair_counts[("ex1@a.bc", "ex2@a.bc")] == 2
+
+    # Exactly at the maximum is not expired yet
+    assert compact_history_rows([("2021-03-07T00:00:00", "[]")])[2] == []
+    assert compact_history_rows([("2021-03-06T00:00:00", "[]")])[2] == [0]
+
+
+def test_read_roster_compacts_history(fake_spreadsheet, tmp_path):
+    rows = [
+        ["2020-06-01T00:00:00", '[["ex1@a.bc", "ex2@a.bc"]]'],
+        ["2021-12-01T00:00:00", '[["ex1@a.bc", "ex2@a.bc"]]'],
+    ]
+
+    # Local files are left as they are when read
+    roster_file = tmp_path / "roster.csv"
+    roster_file.write_text("ex1@a.bc\nex2@a.bc\n")
+    history_file = tmp_path / "roster-history.jsonl"
+    original = "".join(
+        json.dumps({"date": d, "pairs": json.loads(p)}) + "\n" for d, p in rows
+    )
+    history_file.write_text(original)
+
+    with freeze_time("2022-01-01T12:00:00"):
+        history = read_roster(f"file://{roster_file}")[1]
+        assert history.pair_score("ex1@a.bc", "ex2@a.bc") == 1 + 269
+        assert history_file.read_text() == original
+
+        # And rewritten with a snapshot once a round was sent
+        compact_roster_history(f"file://{roster_file}")
+        lines = history_file.read_text().splitlines()
+        assert len(lines) == 2 and "snapshot" in json.loads(lines[0])
+        assert read_roster(f"file://{roster_file}")[1].pair_score(
+            "ex1@a.bc", "ex2@a.bc"
+        ) == (1 + 269)
+
+    # The local copy of a sheet is compacted, the sheet is not
+    fake_spreadsheet.sheets[HISTORY_SHEET_NAME] = [HISTORY_HEADERS] + rows
+    with freeze_time("2022-01-01T12:00:00"):
+        history = read_roster("gsheet://id/0", cache_directory=str(tmp_path))[1]
+        assert history.pair_score("ex1@a.bc", "ex2@a.bc") == 1 + 269
+        assert len(fake_spreadsheet.sheets[HISTORY_SHEET_NAME]) == 3
+
+    with freeze_time("2022-12-01T12:00:00"):
+        history = read_roster("gsheet://id/0", cache_directory=str(tmp_path))[1]
+        assert history.pair_score("ex1@a.bc", "ex2@a.bc") == 2
+        assert fake_spreadsheet.requests[-1] == (
+            "get",
+            [
+                "'Emails'!A:A",
+                f"'{HISTORY_SHEET_NAME}'!A3:B",
+                f"'{HISTORY_SHEET_NAME}'!A2:B2",
+            ],
+        )
+
+        store = cli.get_history_store("id", str(tmp_path))
+        assert store.rows() == []
+        assert store.snapshot()["rounds"] == 2
+
+
+@freeze_time("2022-01-01T12:00:00")
+def test_build_history_from_store(tmp_path):
+    rows = [
+        ("2021-12-01T00:00:00", '[["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc"]]'),
+        ("2021-12-08T00:00:00", '[["ex1@a.bc", "ex3@a.bc", "ex4@a.bc"]]'),
+        ("2021-12-08T00:00:00", '[["ex2@a.bc", "ex5@a.bc"]]'),
+        ("2021-12-15T00:00:00", "not json"),
+    ]
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    store.append(rows)
+
+    expected = build_history(rows)
+    history = build_history_from_store(store)
+    assert len(history) == len(expected) == 2
+    for group in [
+        ["ex1@a.bc", "ex2@a.bc"],
+        ["ex1@a.bc", "ex3@a.bc", "ex4@a.bc"],
+        ["ex2@a.bc", "ex5@a.bc", "ex3@a.bc"],
+    ]:
+        assert history.group_score(group) == expected.group_score(group)
+
+
+def test_sync_history_store(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    rows = [
+        ["Date", "Email pairs"],
+        ["2022-01-01T00:00:00", '[["ex1@a.bc", "ex2@a.bc"]]'],
+    ]
+    fetched = []
+
+    def sync():
+        return sync_history_store(
+            store,
+            rows[len(store) :],
+            lambda: fetched.append("all") or rows,
+            checked={row: rows[row + 1 : row + 2] for row in range(len(store) - 1)},
+        )
+
+    # First sync reads from the header
+    assert sync() == [("2022-01-01T00:00:00", '[["ex1@a.bc", "ex2@a.bc"]]')]
+
+    # New rows are added after the last seen row
+    rows.append(["2022-01-08T00:00:00", '[["ex1@a.bc", "ex3@a.bc"]]'])
+    assert len(sync()) == 2
+    assert sync()[-1] == ("2022-01-08T00:00:00", '[["ex1@a.bc", "ex3@a.bc"]]')
+    assert fetched == []
+
+    # Edited sheet is read again in full
+    rows[2] = ["2022-01-09T00:00:00", "[]"]
+    assert sync()[-1] == ("2022-01-09T00:00:00", "[]")
+    assert fetched == ["all"]
+
+    # Deleted rows too
+    del rows[2]
+    assert len(sync()) == 1
+    assert fetched == ["all", "all"]
+
+    # Rows edited or deleted before the last synced one, with rows added since
+    rows += [["2022-01-15T00:00:00", "[]"], ["2022-01-22T00:00:00", "[]"]]
+    assert len(sync()) == 3
+    rows[1][0] = "2022-01-02T00:00:00"
+    rows.append(["2022-01-29T00:00:00", "[]"])
+    assert sync()[0][0] == "2022-01-02T00:00:00"
+    assert fetched == ["all"] * 3
+
+    # Pairs edited before the last synced one
+    rows[1][1] = '[["ex1@a.bc", "ex4@a.bc"]]'
+    assert sync()[0][1] == '[["ex1@a.bc", "ex4@a.bc"]]'
+    assert fetched == ["all"] * 4
+
+    del rows[2]
+    rows.append(["2022-02-05T00:00:00", "[]"])
+    assert [date for date, pairs in sync()][-2:] == [
+        "2022-01-29T00:00:00",
+        "2022-02-05T00:00:00",
+    ]
+    assert len(store) == 4
+    assert fetched == ["all"] * 5
+
+
+@freeze_time("2022-01-01T12:00:00")
+def test_transform_history_rows():
+    assert transform_history_rows(
+        [
+            ("2021-12-01T01:01:01", '[["ex1@a.bc", "ex2@a.bc"]]'),
+            ("2021-12-08T01:01:01", "not json"),
+            ("2021-12-01T01:01:01", [["ex3@a.bc", "ex4@a.bc"]]),
+        ]
+    ) == [
+        {
+            "score": 300 - 31,
+            "pairs": [["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc"]],
+        }
+    ]
+
+
+def decode_header(value):
+    return str(make_header(email_decode_header(value)))
+
+
+def test_lazy_imports():
+    # In a new interpreter, as the tests themselves import some of these
+    code = "import sys, synapse.cli; print([m for m in synapse.cli.LAZY_IMPORTS if m in sys.modules])"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+
+    assert output.strip() == "[]"
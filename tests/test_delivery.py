@@ -0,0 +1,176 @@
+# Deps for testing
+import smtplib
+
+import pytest
+
+# Deps to test
+from synapse.delivery import (
+    Mailer,
+    TokenBucket,
+    is_rejected_smtp_error,
+    is_transient_smtp_error,
+    partially_refused_error,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeSMTP:
+    def __init__(self, errors=None):
+        self.errors = errors if errors is not None else []
+        self.sent = []
+        self.closed = False
+
+    def sendmail(self, from_, to, message):
+        if self.errors:
+            error = self.errors.pop(0)
+            if isinstance(error, dict):
+                refused = {email: error[email] for email in to if email in error}
+                self.sent.append(
+                    (from_, [email for email in to if email not in error], message)
+                )
+                return refused
+            raise error
+        self.sent.append((from_, to, message))
+        return {}
+
+    def close(self):
+        self.closed = True
+
+    def quit(self):
+        self.closed = True
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(60, burst=2, clock=clock, sleeper=clock.sleep)
+
+    # Burst goes through at once, then one per second
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.now == pytest.approx(1)
+    bucket.acquire()
+    assert clock.now == pytest.approx(2)
+
+    # Tokens build back up while idle, up to the burst size
+    clock.now += 10
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.now == pytest.approx(12)
+    bucket.acquire()
+    assert clock.now == pytest.approx(13)
+
+    with pytest.raises(Exception):
+        TokenBucket(0)
+
+
+def test_mailer():
+    connections = []
+    errors = [smtplib.SMTPServerDisconnected("gone")]
+
+    def connect():
+        connection = FakeSMTP(errors)
+        connections.append(connection)
+        return connection
+
+    sleeps = []
+    mailer = Mailer(connect, rate_per_minute=6000, burst=10, sleeper=sleeps.append)
+
+    # Dropped connection is replaced and the message retried
+    mailer.send("a@b.c", ["d@e.f"], "message")
+    assert len(connections) == 2
+    assert connections[0].closed
+    assert connections[1].sent == [("a@b.c", ["d@e.f"], "message")]
+    assert mailer.retry_count == 1
+    assert len(sleeps) == 1
+
+    # Connection is reused
+    sent = []
+    mailer.send_all([("a@b.c", ["g@h.i"], "message 2")], on_sent=sent.append)
+    assert sent == [0]
+    assert len(connections) == 2
+    assert len(connections[1].sent) == 2
+
+    # Permanent errors are not retried
+    connections[1].errors = [smtplib.SMTPDataError(550, "no")]
+    with pytest.raises(smtplib.SMTPDataError):
+        mailer.send_all([("a@b.c", ["g@h.i"], "message 3")])
+    assert mailer.retry_count == 1
+
+    # Or are passed on, and the other messages still sent
+    failed = []
+    errors.append(smtplib.SMTPDataError(550, "no"))
+    mailer.send_all(
+        [("a@b.c", ["g@h.i"], "message 4"), ("a@b.c", ["j@k.l"], "message 5")],
+        on_sent=sent.append,
+        on_failed=lambda i, error: failed.append(i),
+    )
+    assert failed == [0]
+    assert sent == [0, 1]
+
+    # Recipients refused for a while are sent to again, without the others
+    connections[-1].errors = [{"j@k.l": (450, b"later")}]
+    mailer.send("a@b.c", ["g@h.i", "j@k.l"], "message 6")
+    assert connections[-1].sent[-2:] == [
+        ("a@b.c", ["g@h.i"], "message 6"),
+        ("a@b.c", ["j@k.l"], "message 6"),
+    ]
+
+    # Recipients refused for good fail the message, as it was partly sent
+    connections[-1].errors = [{"j@k.l": (550, b"no")}]
+    mailer.send_all(
+        [("a@b.c", ["g@h.i", "j@k.l"], "message 7")],
+        on_sent=sent.append,
+        on_failed=lambda i, error: failed.append(error.recipients),
+    )
+    assert failed == [0, {"j@k.l": (550, b"no")}]
+    assert sent == [0, 1]
+
+    mailer.quit()
+    assert mailer.opened == 0
+
+
+def test_mailer_rate_limits_retries():
+    clock = FakeClock()
+    errors = [smtplib.SMTPServerDisconnected("gone")]
+    mailer = Mailer(lambda: FakeSMTP(errors), backoff=0.1, sleeper=clock.sleep)
+    mailer.bucket = TokenBucket(60, clock=clock, sleeper=clock.sleep)
+
+    # The retry waits for a token too, on top of its backoff
+    mailer.send("a@b.c", ["d@e.f"], "message")
+    assert len(clock.sleeps) == 2
+    assert clock.now == pytest.approx(1)
+
+
+def test_is_transient_smtp_error():
+    assert is_transient_smtp_error(smtplib.SMTPServerDisconnected())
+    assert is_transient_smtp_error(smtplib.SMTPDataError(421, "busy"))
+    assert not is_transient_smtp_error(smtplib.SMTPDataError(550, "no"))
+    assert is_transient_smtp_error(smtplib.SMTPRecipientsRefused({"a@b.c": (450, "")}))
+    assert not is_transient_smtp_error(
+        smtplib.SMTPRecipientsRefused({"a@b.c": (550, "")})
+    )
+    assert is_transient_smtp_error(ConnectionResetError())
+    assert not is_transient_smtp_error(ValueError())
+
+
+def test_is_rejected_smtp_error():
+    assert is_rejected_smtp_error(smtplib.SMTPRecipientsRefused({"a@b.c": (550, "")}))
+    assert is_rejected_smtp_error(smtplib.SMTPDataError(554, "no"))
+    assert is_rejected_smtp_error(partially_refused_error({"a@b.c": (450, "")}))
+    assert not is_rejected_smtp_error(smtplib.SMTPDataError(451, "later"))
+    assert not is_rejected_smtp_error(smtplib.SMTPAuthenticationError(535, "no"))
+    assert not is_rejected_smtp_error(ConnectionResetError())
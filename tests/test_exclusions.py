@@ -0,0 +1,69 @@
+# Deps for testing
+import pytest
+
+# Deps to test
+from synapse.exclusions import (
+    ExclusionIndex,
+    column_index,
+    exclusions_from_rows,
+    parse_exclusion_cell,
+    read_exclusion_file,
+)
+from synapse.matching import match_optimal
+
+
+def test_exclusion_index():
+    exclusions = ExclusionIndex([("a", "b"), ("b", "a"), ("a", "c"), ("d", "d")])
+    assert len(exclusions) == 2
+    assert sorted(sorted(pair) for pair in exclusions.pairs()) == [
+        ["a", "b"],
+        ["a", "c"],
+    ]
+
+    # A group's mask excludes everyone any member excludes
+    mask = exclusions.mask("b") | exclusions.mask("c")
+    assert exclusions.blocks(mask, "a")
+    assert not exclusions.blocks(mask, "d")
+    assert not exclusions.blocks(mask, "unknown")
+    assert exclusions.allows(["b", "c", "d"])
+    assert not exclusions.allows(["c", "d", "a"])
+
+    # Someone who excludes everyone else can not be grouped
+    exclusions.check(["a", "b", "c", "d"])
+    with pytest.raises(Exception, match="a excludes everyone"):
+        exclusions.check(["a", "b", "c"])
+
+
+def test_read_exclusions(tmp_path):
+    assert parse_exclusion_cell("A@b.c, c@d.e;f@g.h  ") == ["a@b.c", "c@d.e", "f@g.h"]
+    assert parse_exclusion_cell(None) == []
+
+    filename = tmp_path / "exclusions.csv"
+    filename.write_text(
+        "Manager,Reports\nboss@a.bc,one@a.bc; two@a.bc\nthree@a.bc,four@a.bc\n"
+    )
+    exclusions = read_exclusion_file(str(filename))
+    assert len(exclusions) == 3
+    assert not exclusions.allows(["boss@a.bc", "two@a.bc"])
+    assert exclusions.allows(["boss@a.bc", "four@a.bc"])
+
+    # Reports of the same manager can still be paired with each other
+    assert exclusions.allows(["one@a.bc", "two@a.bc"])
+    score, pairs = match_optimal(
+        ["boss@a.bc", "one@a.bc", "two@a.bc", "five@a.bc"], exclusions=exclusions
+    )
+    assert sorted(map(sorted, pairs)) == [
+        ["boss@a.bc", "five@a.bc"],
+        ["one@a.bc", "two@a.bc"],
+    ]
+
+    exclusions = exclusions_from_rows(
+        [("Email", "Avoid"), ("Boss@a.bc", "one@a.bc"), ("two@a.bc", "")]
+    )
+    assert list(exclusions.pairs()) == [("boss@a.bc", "one@a.bc")]
+
+    assert column_index("A") == 0
+    assert column_index("b") == 1
+    assert column_index("AB") == 27
+    with pytest.raises(Exception):
+        column_index("B2")
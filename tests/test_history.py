@@ -0,0 +1,187 @@
+# Deps for testing
+import pytest
+
+# Deps to test
+from synapse.history import (
+    HistoryIndex,
+    HistoryRound,
+    HistorySnapshot,
+    build_history_index,
+    pair_key,
+)
+
+
+def test_pair_key():
+    assert pair_key("a@b.c", "b@b.c") == ("a@b.c", "b@b.c")
+    assert pair_key("b@b.c", "a@b.c") == ("a@b.c", "b@b.c")
+
+
+def test_history_index():
+    test_history = [
+        {
+            "score": 100,
+            "pairs": [
+                ["ex1@a.bc", "ex2@a.bc"],
+                ["ex9@a.bc", "ex10@a.bc", "ex11@a.bc"],
+            ],
+        },
+        {
+            "score": 50,
+            "pairs": [
+                ["ex2@a.bc", "ex1@a.bc"],
+                ["ex9@a.bc", "ex5@a.bc"],
+            ],
+        },
+    ]
+    index = HistoryIndex(test_history)
+
+    assert len(index) == 2
+    assert index.pair_score("ex1@a.bc", "ex2@a.bc") == 150
+    assert index.pair_score("ex2@a.bc", "ex1@a.bc") == 150
+    assert index.pair_score("ex10@a.bc", "ex11@a.bc") == 100
+    assert index.pair_score("ex1@a.bc", "ex5@a.bc") == 0
+
+    # A round only counts once for a group, even with several matches
+    assert index.group_score(["ex9@a.bc", "ex10@a.bc", "ex11@a.bc"]) == 100
+    assert index.group_score(["ex9@a.bc", "ex10@a.bc", "ex5@a.bc"]) == 150
+
+    assert index.score([["ex1@a.bc", "ex2@a.bc"], ["ex9@a.bc", "ex5@a.bc"]]) == 200
+
+    pair_scores = {frozenset([a, b]): score for a, b, score in index.pair_score_items()}
+    assert len(pair_scores) == 5
+    assert pair_scores[frozenset(["ex1@a.bc", "ex2@a.bc"])] == 150
+    assert pair_scores[frozenset(["ex5@a.bc", "ex9@a.bc"])] == 50
+
+    # Existing index is reused
+    assert build_history_index(index) is index
+    assert len(build_history_index(None)) == 0
+
+
+def test_history_index_pairwise_score():
+    index = HistoryIndex(
+        [
+            {"score": 100, "pairs": [["ex1@a.bc", "ex2@a.bc", "ex3@a.bc"]]},
+            {"score": 50, "pairs": [["ex1@a.bc", "ex4@a.bc"]]},
+        ]
+    )
+
+    # Each pair counts, even from the same round
+    group = ["ex1@a.bc", "ex2@a.bc", "ex3@a.bc", "ex4@a.bc", "ex5@a.bc"]
+    assert index.group_score(group) == 150
+    assert index.pairwise_score(group) == 350
+    assert index.score([group[:2], group[2:]], pairwise=True) == 100
+    assert index.member_score("ex1@a.bc", group) == 250
+
+
+def test_history_index_age():
+    def rounds(first, second, third=None):
+        history = [
+            {
+                "score": first,
+                "pairs": [["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc"]],
+            },
+            {"score": second, "pairs": [["ex1@a.bc", "ex2@a.bc", "ex3@a.bc"]]},
+        ]
+        if third is not None:
+            history.append({"score": third, "pairs": [["ex1@a.bc", "ex4@a.bc"]]})
+        return history
+
+    index = HistoryIndex(rounds(10, 300))
+
+    # Same as building the index with aged scores
+    index.age(7)
+    assert sorted(index.pair_score_items()) == sorted(
+        HistoryIndex(rounds(3, 293)).pair_score_items()
+    )
+
+    # Expired rounds score 1, and rounds added later age too
+    index.age(7)
+    index.add_round(rounds(0, 0, 300)[2]["pairs"], 300)
+    index.age(100)
+    assert sorted(index.pair_score_items()) == sorted(
+        HistoryIndex(rounds(1, 186, 200)).pair_score_items()
+    )
+    assert index.group_score(["ex1@a.bc", "ex2@a.bc", "ex3@a.bc"]) == 187
+    assert index.last_round_score("ex1@a.bc", "ex2@a.bc") == 186
+    assert index.last_round_score("ex1@a.bc", "ex5@a.bc") is None
+
+
+def test_history_index_fingerprint():
+    history = [{"score": 100, "pairs": [["ex1@a.bc", "ex2@a.bc"]]}]
+    index = HistoryIndex(history)
+    fingerprint = index.fingerprint()
+    assert fingerprint == HistoryIndex(history).fingerprint()
+    assert fingerprint != HistoryIndex().fingerprint()
+
+    # Aging does not change it, but a new round does
+    index.age(10)
+    assert index.fingerprint() == fingerprint
+    index.add_round([["ex1@a.bc", "ex3@a.bc"]], 300)
+    assert index.fingerprint() != fingerprint
+
+    # Groups of snapshot rounds count too, not only their pairs
+    pairs = {("ex1@a.bc", "ex2@a.bc"): 1, ("ex1@a.bc", "ex3@a.bc"): 1}
+    fingerprints = []
+    for groups in [{}, {frozenset(["ex1@a.bc", "ex2@a.bc", "ex3@a.bc"]): 1}]:
+        index = HistoryIndex()
+        index.add_snapshot(HistorySnapshot(2, dict(pairs), groups), 1)
+        fingerprints.append(index.fingerprint())
+    assert fingerprints[0] != fingerprints[1]
+
+
+def test_history_snapshot():
+    rounds = [
+        [["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc", "ex5@a.bc"]],
+        [["ex1@a.bc", "ex3@a.bc"], ["ex2@a.bc", "ex4@a.bc"], ["ex2@a.bc", "ex4@a.bc"]],
+        [["ex3@a.bc", "ex4@a.bc", "ex5@a.bc"], ["ex1@a.bc", "ex2@a.bc"]],
+    ]
+    snapshot = HistorySnapshot()
+    for pairs in rounds:
+        snapshot.add_round(pairs)
+
+    assert snapshot.rounds == 3
+    assert snapshot.pair_counts[("ex1@a.bc", "ex2@a.bc")] == 2
+    assert snapshot.pair_counts[("ex2@a.bc", "ex4@a.bc")] == 1
+    assert snapshot.group_counts == {frozenset(["ex3@a.bc", "ex4@a.bc", "ex5@a.bc"]): 2}
+
+    # Same scores as the rounds themselves, when they all have the same score
+    snapshot = HistorySnapshot.from_dict(snapshot.as_dict())
+    full = HistoryIndex([{"score": 1, "pairs": pairs} for pairs in rounds])
+    index = HistoryIndex(
+        [{"score": 100, "pairs": [["ex1@a.bc", "ex5@a.bc"]]}],
+        snapshot=snapshot,
+        snapshot_score=1,
+    )
+    assert len(index) == 4
+    for group in [
+        ["ex1@a.bc", "ex2@a.bc"],
+        ["ex3@a.bc", "ex4@a.bc", "ex5@a.bc"],
+        ["ex3@a.bc", "ex4@a.bc", "ex1@a.bc"],
+        ["ex1@a.bc", "ex2@a.bc", "ex3@a.bc"],
+    ]:
+        assert index.group_score(group) == full.group_score(group)
+    assert index.group_score(["ex1@a.bc", "ex5@a.bc", "ex4@a.bc"]) == 100 + 2
+
+
+def test_history_round():
+    round = HistoryRound(10)
+    round.add_group([0, 1])
+    round.add_group([2, 3, 4])
+    assert [list(group) for group in round.groups()] == [[0, 1], [2, 3, 4]]
+
+    other = HistoryRound(10)
+    other.add_group([5, 6])
+    round.extend(other)
+    assert [list(group) for group in round.groups()][-1] == [5, 6]
+
+    unpacked = HistoryRound.unpack(20, *round.pack())
+    assert unpacked.score == 20
+    assert list(unpacked.members) == list(round.members)
+    assert list(unpacked.ends) == [2, 5, 7]
+
+    # Packed rounds score the same as lists of pairs
+    index = HistoryIndex(emails=["ex0@a.bc", "ex1@a.bc", "ex2@a.bc", "ex3@a.bc"])
+    index.add_packed_round(unpacked)
+    assert index.pair_score("ex0@a.bc", "ex1@a.bc") == 20
+    assert index.group_score(["ex2@a.bc", "ex3@a.bc", "ex0@a.bc"]) == 20
+    assert index.pair_score("ex0@a.bc", "ex9@a.bc") == 0
@@ -0,0 +1,41 @@
+# Deps for testing
+import pytest
+
+# Deps to test
+from synapse.journal import SendJournal
+
+
+def test_send_journal(tmp_path):
+    filename = str(tmp_path / "journal" / "round.jsonl")
+    journal = SendJournal(filename)
+    assert journal.is_finished()
+
+    pairs = [["a", "b"], ["c", "d"], ["e", "f", "g"]]
+    journal.start("file:///roster.csv", "2022-01-01T00:00:00", pairs)
+    journal.mark_sent(1)
+    journal.mark_sent(0)
+    journal.mark_saved([1])
+    assert journal.pending() == [2]
+    assert journal.unsaved() == [0]
+
+    # Read back, ignoring a partly written line
+    with open(filename, "a") as f:
+        f.write('{"type": "sent", "pa')
+    journal = SendJournal(filename)
+    assert journal.roster == "file:///roster.csv"
+    assert journal.date == "2022-01-01T00:00:00"
+    assert journal.pairs == pairs
+    assert journal.pending() == [2]
+    assert journal.unsaved() == [0]
+    assert not journal.is_finished()
+
+    # A rejected email is not sent again
+    journal.mark_failed(2)
+    assert journal.pending() == []
+    assert SendJournal(filename).failed == {2}
+    journal.mark_saved([0])
+    assert journal.is_finished()
+
+    journal.finish()
+    assert journal.is_finished()
+    assert SendJournal(filename).pairs == []
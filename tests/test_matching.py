@@ -0,0 +1,452 @@
+# Deps for testing
+from time import perf_counter
+
+import pytest
+
+# Deps to test
+from synapse.exclusions import ExclusionIndex
+from synapse.history import HistoryIndex
+from synapse.matching import (
+    SearchBudget,
+    TopPairings,
+    build_groups,
+    greedy_mate,
+    match_local_search,
+    match_optimal,
+    match_random,
+    match_random_alternatives,
+    match_random_parallel,
+    match_random_parallel_alternatives,
+    pair_emails,
+    pair_emails_alternatives,
+    split_groups,
+)
+
+
+test_emails = [
+    "ex1@a.bc",
+    "ex2@a.bc",
+    "ex3@a.bc",
+    "ex4@a.bc",
+    "ex5@a.bc",
+    "ex6@a.bc",
+]
+
+
+def test_match_random():
+    # Not enough
+    assert match_random([]) == (0, [])
+
+    index = HistoryIndex(
+        [{"score": 10, "pairs": [["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc"]]}]
+    )
+    test_score, test_pairs = match_random(test_emails, index, sample_count=100)
+    assert test_score == index.score(test_pairs)
+    assert sorted(email for pair in test_pairs for email in pair) == test_emails
+
+    # Same seed, same pairing
+    assert match_random(test_emails, index, sample_count=5, seed=1) == match_random(
+        test_emails, index, sample_count=5, seed=1
+    )
+
+
+def test_match_random_parallel():
+    index = HistoryIndex(
+        [{"score": 10, "pairs": [["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc"]]}]
+    )
+
+    # Same seed and workers, same pairing
+    test_score, test_pairs = match_random_parallel(
+        test_emails, index, sample_count=50, seed=1, workers=2
+    )
+    assert test_score == index.score(test_pairs)
+    assert (test_score, test_pairs) == match_random_parallel(
+        test_emails, index, sample_count=50, seed=1, workers=2
+    )
+
+    # More workers than samples
+    test_score, test_pairs = match_random_parallel(
+        test_emails, index, sample_count=1, seed=1, workers=3
+    )
+    assert len(test_pairs) == 3
+
+
+def test_match_optimal():
+    # Not enough
+    assert match_optimal([]) == (0, [])
+    assert match_optimal(["a@b.com"]) == (0, [])
+
+    # Person 1 has history with everyone, least with person 2
+    index = HistoryIndex(
+        [
+            {
+                "score": 10,
+                "pairs": [["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc"]],
+            },
+            {
+                "score": 20,
+                "pairs": [["ex1@a.bc", "ex3@a.bc"], ["ex5@a.bc", "ex6@a.bc"]],
+            },
+            {
+                "score": 30,
+                "pairs": [["ex1@a.bc", "ex4@a.bc"], ["ex2@a.bc", "ex5@a.bc"]],
+            },
+            {
+                "score": 40,
+                "pairs": [["ex1@a.bc", "ex5@a.bc"], ["ex2@a.bc", "ex6@a.bc"]],
+            },
+            {
+                "score": 50,
+                "pairs": [["ex1@a.bc", "ex6@a.bc"], ["ex3@a.bc", "ex5@a.bc"]],
+            },
+        ]
+    )
+    for seed in range(10):
+        test_score, test_pairs = match_optimal(test_emails, index, seed=seed)
+        assert test_score == 10
+        assert sorted(sorted(pair) for pair in test_pairs) == [
+            ["ex1@a.bc", "ex2@a.bc"],
+            ["ex3@a.bc", "ex6@a.bc"],
+            ["ex4@a.bc", "ex5@a.bc"],
+        ]
+
+    # Odd number of emails adds the leftover to a pair
+    test_score, test_pairs = match_optimal(test_emails + ["ex7@a.bc"], index)
+    assert len(test_pairs) == 3
+    assert sorted(len(pair) for pair in test_pairs) == [2, 2, 3]
+    assert test_score == index.score(test_pairs)
+
+    # Without history, nothing is repeated
+    test_score, test_pairs = match_optimal(test_emails)
+    assert test_score == 0
+    assert len(test_pairs) == 3
+
+
+def test_greedy_mate():
+    assert greedy_mate(4, {}) == [1, 0, 3, 2]
+    assert greedy_mate(3, {(1, 2): 10, (0, 2): 10}) == [1, 0, -1]
+
+
+def test_match_local_search():
+    # Not enough
+    assert match_local_search([]) == (0, [])
+    assert match_local_search(["a@b.com"]) == (0, [])
+
+    index = HistoryIndex(
+        [
+            {
+                "score": 10,
+                "pairs": [["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc"]],
+            },
+            {
+                "score": 20,
+                "pairs": [["ex1@a.bc", "ex3@a.bc"], ["ex5@a.bc", "ex6@a.bc"]],
+            },
+            {
+                "score": 30,
+                "pairs": [["ex1@a.bc", "ex4@a.bc"], ["ex2@a.bc", "ex5@a.bc"]],
+            },
+        ]
+    )
+
+    # Finds a pairing without repetition
+    test_score, test_pairs = match_local_search(test_emails, index, seed=1)
+    assert test_score == 0
+    assert index.score(test_pairs) == 0
+    assert sorted(email for pair in test_pairs for email in pair) == test_emails
+
+    # Same seed, same pairing
+    assert match_local_search(test_emails, index, seed=2) == match_local_search(
+        test_emails, index, seed=2
+    )
+
+    # Odd number of emails keeps a triple
+    test_score, test_pairs = match_local_search(test_emails + ["ex7@a.bc"], index)
+    assert sorted(len(pair) for pair in test_pairs) == [2, 2, 3]
+    assert test_score == index.score(test_pairs)
+
+
+def test_split_groups():
+    assert split_groups(list(range(5)), 2) == [[0, 1], [2, 3, 4]]
+    assert split_groups(list(range(11)), 3) == [[0, 1, 2], [3, 4, 5, 10], [6, 7, 8, 9]]
+    assert split_groups(list(range(3)), 4) == [[0, 1, 2]]
+
+    # More people left over than groups make one more, smaller, group
+    assert split_groups(list(range(9)), 5) == [[0, 1, 2, 3], [4, 5, 6, 7, 8]]
+    assert [len(group) for group in split_groups(list(range(11)), 4)] == [3, 4, 4]
+    assert [len(group) for group in split_groups(list(range(10)), 4)] == [5, 5]
+
+
+def test_match_groups():
+    emails = [f"ex{i}@a.bc" for i in range(1, 14)]
+    index = HistoryIndex(
+        [
+            {"score": 10, "pairs": [emails[0:3], emails[3:6]]},
+            {"score": 20, "pairs": [emails[0:2], emails[6:9]]},
+        ]
+    )
+
+    # Groups of four, with the leftover in one of them, scored by their pairs
+    for matcher, kwargs in [
+        (match_random, {"sample_count": 200}),
+        (match_local_search, {"iterations": 2000}),
+    ]:
+        test_score, test_groups = matcher(emails, index, seed=1, group_size=4, **kwargs)
+        assert sorted(len(group) for group in test_groups) == [4, 4, 5]
+        assert sorted(email for group in test_groups for email in group) == sorted(
+            emails
+        )
+        assert test_score == index.score(test_groups, pairwise=True)
+
+    # The local search finds groups where nobody met before
+    assert match_local_search(emails, index, seed=1, group_size=4)[0] == 0
+
+    # Across processes
+    test_score, test_groups = match_random_parallel(
+        emails, index, sample_count=20, seed=1, workers=2, group_size=3
+    )
+    assert sorted(len(group) for group in test_groups) == [3, 3, 3, 4]
+    assert test_score == index.score(test_groups, pairwise=True)
+
+
+def test_match_exclusions():
+    emails = [f"ex{i}@a.bc" for i in range(1, 21)]
+    index = HistoryIndex([{"score": 10, "pairs": [emails[0:2], emails[2:4]]}])
+
+    # Everyone in the first half excludes everyone else in it
+    exclusions = ExclusionIndex(
+        (a, b) for i, a in enumerate(emails[:10]) for b in emails[i + 1 : 10]
+    )
+    assert build_groups(emails[:12], 2, exclusions) is None
+    assert all(
+        exclusions.allows(group) for group in build_groups(emails, 2, exclusions)
+    )
+
+    for matcher, kwargs in [
+        (match_random, {"sample_count": 50}),
+        (match_local_search, {"iterations": 2000}),
+        (match_optimal, {}),
+        (match_random_parallel, {"sample_count": 20, "workers": 2}),
+    ]:
+        test_score, test_pairs = matcher(
+            emails, index, seed=1, exclusions=exclusions, **kwargs
+        )
+        assert all(exclusions.allows(pair) for pair in test_pairs)
+        assert sorted(email for pair in test_pairs for email in pair) == sorted(emails)
+        assert test_score == index.score(test_pairs)
+
+    # Groups, with leftovers only where allowed
+    exclusions = ExclusionIndex((emails[0], b) for b in emails[1:5])
+    for seed in range(10):
+        test_score, test_groups = match_random(
+            emails[:11], seed=seed, sample_count=5, group_size=3, exclusions=exclusions
+        )
+        assert all(exclusions.allows(group) for group in test_groups)
+        assert sorted(len(group) for group in test_groups) == [3, 4, 4]
+
+    # More people left over than groups of the size asked for
+    exclusions = ExclusionIndex([(emails[0], emails[1])])
+    for people, group_size, sizes in [(11, 4, [3, 4, 4]), (9, 5, [4, 5])]:
+        for matcher, kwargs in [
+            (match_random, {"sample_count": 5}),
+            (match_local_search, {"iterations": 200}),
+        ]:
+            test_score, test_groups = matcher(
+                emails[:people],
+                seed=1,
+                group_size=group_size,
+                exclusions=exclusions,
+                **kwargs,
+            )
+            assert all(exclusions.allows(group) for group in test_groups)
+            assert sorted(len(group) for group in test_groups) == sizes
+
+    exclusions = ExclusionIndex(
+        (a, b) for i, a in enumerate(emails[:10]) for b in emails[i + 1 : 10]
+    )
+
+    # No valid pairing
+    with pytest.raises(Exception, match="No valid pairing"):
+        match_optimal(emails[:12], seed=1, exclusions=exclusions)
+    with pytest.raises(Exception, match="No pairing without excluded pairs"):
+        match_random(emails[:12], seed=1, sample_count=10, exclusions=exclusions)
+
+
+def test_search_budget():
+    emails = [f"ex{i}@a.bc" for i in range(40)]
+    index = HistoryIndex([{"score": 10, "pairs": [emails]}])
+
+    # Steps, a target score, or 0 stop a search
+    budget = SearchBudget(steps=10)
+    assert not budget.is_done(9, 5)
+    assert budget.is_done(10, 5)
+    assert budget.is_done(0, 0)
+    assert SearchBudget(target_score=5).is_done(0, 5)
+    assert SearchBudget.for_samples(None).steps == 1
+    assert SearchBudget.for_samples(None, seconds=1).steps is None
+
+    # Everyone met, so only time stops these searches
+    for matcher, kwargs in [
+        (match_random, {"sample_count": None}),
+        (match_local_search, {}),
+    ]:
+        start = perf_counter()
+        test_score, test_pairs = matcher(
+            emails, index, seed=1, time_budget=0.2, **kwargs
+        )
+        assert 0.2 <= perf_counter() - start < 2
+        assert test_score == index.score(test_pairs)
+
+    # Stops once good enough
+    start = perf_counter()
+    test_score, test_pairs = match_random(
+        emails, index, sample_count=None, time_budget=10, target_score=10**6
+    )
+    assert perf_counter() - start < 1
+
+
+def test_top_pairings():
+    top = TopPairings(3)
+    assert top.bound() is None
+    assert top.push(5, [["a", "b"], ["c", "d"]])
+    assert not top.push(5, [["d", "c"], ["b", "a"]])
+    assert top.push(3, [["a", "c"], ["b", "d"]])
+    assert top.push(5, [["a", "d"], ["b", "c"]])
+    assert top.bound() == 5
+
+    # Better ones push out the worst, and the first of a tie stays
+    assert not top.push(7, [["a", "b"], ["c", "e"]])
+    assert top.push(1, [["a", "e"], ["b", "d"]])
+    assert len(top) == 3
+    assert top.pairings() == [
+        (1, [["a", "e"], ["b", "d"]]),
+        (3, [["a", "c"], ["b", "d"]]),
+        (5, [["a", "b"], ["c", "d"]]),
+    ]
+
+    # The pushed out pairing can come back
+    assert top.push(0, [["a", "d"], ["b", "c"]])
+
+
+def test_match_random_alternatives():
+    emails = [f"ex{i}@a.bc" for i in range(10)]
+    index = HistoryIndex([{"score": 10, "pairs": [emails[0:5], emails[5:10]]}])
+
+    pairings = match_random_alternatives(
+        emails, index, sample_count=200, seed=1, alternatives=5
+    )
+    assert len(pairings) == 5
+    assert [score for score, pairs in pairings] == sorted(
+        score for score, pairs in pairings
+    )
+    assert all(score == index.score(pairs) for score, pairs in pairings)
+    assert len({str(sorted(map(sorted, pairs))) for score, pairs in pairings}) == 5
+
+    # The best is the same as without alternatives
+    assert pairings[0] == match_random(emails, index, sample_count=200, seed=1)
+
+    # Across processes
+    pairings = match_random_parallel_alternatives(
+        emails, index, sample_count=50, seed=1, workers=2, alternatives=3
+    )
+    assert len(pairings) == 3
+    assert pairings[0] == match_random_parallel(
+        emails, index, sample_count=50, seed=1, workers=2
+    )
+
+
+def test_pair_emails():
+    test_emails = [
+        "ex1@a.bc",
+        "ex2@a.bc",
+        "ex3@a.bc",
+        "ex4@a.bc",
+        "ex5@a.bc",
+        "ex6@a.bc",
+        "ex7@a.bc",
+        "ex8@a.bc",
+        "ex9@a.bc",
+    ]
+
+    # Test basic example
+    test_score, test_pairs = pair_emails(test_emails)
+    assert test_score == 0
+    assert len(test_pairs) == 4
+    assert len(test_pairs[0]) == 2
+    assert len(test_pairs[1]) == 2
+    assert len(test_pairs[2]) == 2
+    assert len(test_pairs[3]) == 3
+
+    # Test not enough
+    assert pair_emails([]) == (0, [])
+    assert pair_emails(["a@b.com"]) == (0, [])
+
+    # Test with history
+    test_history = [
+        {
+            "score": 100,
+            "pairs": [
+                ["ex1@a.bc", "ex2@a.bc"],
+                ["ex3@a.bc", "ex4@a.bc"],
+            ],
+        },
+    ]
+    test_score, test_pairs_with_history = pair_emails(test_emails, history=test_history)
+    assert len(test_pairs_with_history) == 4
+
+    # Test optimal matcher
+    test_score, test_pairs_optimal = pair_emails(
+        test_emails, history=test_history, matcher="optimal"
+    )
+    assert test_score == 0
+    assert len(test_pairs_optimal) == 4
+
+    # Test local search matcher
+    test_score, test_pairs_anneal = pair_emails(
+        test_emails, history=test_history, matcher="anneal", seed=1
+    )
+    assert test_score == 0
+    assert len(test_pairs_anneal) == 4
+
+    # Test seed gives the same pairs
+    assert pair_emails(test_emails, sample_count=10, seed=1) == pair_emails(
+        test_emails, sample_count=10, seed=1
+    )
+
+    # Test unknown matcher
+    with pytest.raises(Exception):
+        pair_emails(test_emails, matcher="unknown")
+
+    # Test groups
+    test_score, test_groups = pair_emails(test_emails, sample_count=10, group_size=3)
+    assert sorted(len(group) for group in test_groups) == [3, 3, 3]
+    with pytest.raises(Exception):
+        pair_emails(test_emails, matcher="optimal", group_size=3)
+
+    # Test alternatives, with every matcher
+    pairings = pair_emails_alternatives(
+        test_emails, sample_count=100, seed=1, alternatives=3
+    )
+    assert len(pairings) == 3
+    assert pairings[0] == pair_emails(test_emails, sample_count=100, seed=1)
+    assert (
+        len(pair_emails_alternatives(test_emails, matcher="optimal", alternatives=3))
+        == 1
+    )
+    assert pair_emails_alternatives(["ex1@a.bc"], alternatives=3) == [(0, [])]
+    with pytest.raises(Exception):
+        pair_emails_alternatives(test_emails, alternatives=0)
+
+    # Test exclusions, with every backend and matcher
+    exclusions = ExclusionIndex([("ex1@a.bc", "ex2@a.bc"), ("ex3@a.bc", "ex4@a.bc")])
+    for options in [
+        {"backend": "numpy", "sample_count": 10},
+        {"matcher": "optimal"},
+        {"matcher": "anneal"},
+    ]:
+        test_score, test_pairs = pair_emails(
+            test_emails, history=test_history, exclusions=exclusions, **options
+        )
+        assert all(exclusions.allows(pair) for pair in test_pairs)
+    with pytest.raises(Exception, match="No valid pairing"):
+        pair_emails(test_emails[:2], exclusions=exclusions)
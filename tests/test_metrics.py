@@ -0,0 +1,77 @@
+# Deps for testing
+import pytest
+
+# Deps to test
+from synapse import metrics as metrics_module
+from synapse.metrics import Metrics, get_metrics, timed
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_metrics():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+
+    with metrics.span("pair emails"):
+        clock.now += 2
+    with pytest.raises(ValueError):
+        with metrics.span("pair emails"):
+            clock.now += 1
+            raise ValueError()
+    assert metrics.seconds("pair emails") == 3
+    assert metrics.seconds("send emails") == 0
+
+    metrics.count("samples evaluated", 100)
+    metrics.count("samples evaluated", 50)
+    metrics.record("best score", 12)
+    clock.now += 1
+    metrics.record("best score", 3)
+
+    assert metrics.as_dict() == {
+        "seconds": 4,
+        "spans": {"pair emails": {"count": 2, "seconds": 3}},
+        "counters": {"samples evaluated": 150},
+        "series": {
+            "best score": [{"seconds": 3, "value": 12}, {"seconds": 4, "value": 3}]
+        },
+    }
+
+    summary = metrics.summary()
+    assert "pair emails" in summary
+    assert "150" in summary
+    assert "12 (3.00s) → 3 (4.00s)" in summary
+
+
+def test_metrics_subscribe():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+    seen = []
+
+    def subscriber(seconds, value):
+        seen.append((seconds, value))
+
+    metrics.subscribe("best score", subscriber)
+    clock.now += 1
+    metrics.record("best score", 5)
+    metrics.record("round score", 7)
+    metrics.unsubscribe("best score", subscriber)
+    metrics.record("best score", 2)
+    assert seen == [(1, 5)]
+
+
+def test_timed(monkeypatch):
+    monkeypatch.setattr(metrics_module, "global_metrics", None)
+
+    @timed("double")
+    def double(x):
+        return x * 2
+
+    assert double(2) == 4
+    assert double.__name__ == "double"
+    assert get_metrics().spans["double"][0] == 1
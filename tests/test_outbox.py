@@ -0,0 +1,54 @@
+# Deps for testing
+import os
+
+# Deps to test
+from synapse.outbox import Outbox, flags
+
+
+def test_outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox"))
+    assert outbox.pending() == []
+    assert outbox.rosters() == {}
+
+    pairs = [["a@a.bc", "b@a.bc"], ["c@a.bc", "d@a.bc", "e@a.bc"]]
+    messages = [
+        ("from@a.bc", pair, f"Subject: Hi\r\n\r\nHello {i}\r\n")
+        for i, pair in enumerate(pairs)
+    ]
+    names = outbox.add_all("file:///a.csv", "2022-01-01T00:00:00", pairs, messages)
+    names += outbox.add_all(
+        "file:///b.csv", "2022-01-02T00:00:00", pairs[:1], messages[:1], writers=4
+    )
+    assert outbox.pending() == names
+    assert os.listdir(tmp_path / "outbox" / "tmp") == []
+    assert outbox.rosters() == {"file:///a.csv": 2, "file:///b.csv": 1}
+
+    # Read back as written, line endings included
+    message = outbox.read("new", names[1])
+    assert message == {
+        "roster": "file:///a.csv",
+        "date": "2022-01-01T00:00:00",
+        "pair": pairs[1],
+        "from_": "from@a.bc",
+        "to": pairs[1],
+        "message": "Subject: Hi\r\n\r\nHello 1\r\n",
+    }
+
+    # Sent, then saved
+    outbox.mark_sent(names[0])
+    outbox.mark_sent(names[2])
+    assert outbox.pending() == [names[1]]
+    assert outbox.unsaved() == [f"{names[0]}:2,S", f"{names[2]}:2,S"]
+    assert outbox.read("cur", f"{names[0]}:2,S")["pair"] == pairs[0]
+
+    outbox.mark_saved([f"{names[0]}:2,S"])
+    assert outbox.unsaved() == [f"{names[2]}:2,S"]
+    assert flags(outbox.names("cur")[0]) == "PS"
+    assert outbox.rosters() == {"file:///a.csv": 1, "file:///b.csv": 1}
+
+    # Rejected, and no longer waiting
+    outbox.mark_failed(names[1])
+    assert outbox.pending() == []
+    assert outbox.failed() == [f"{names[1]}:2,F"]
+    assert outbox.unsaved() == [f"{names[2]}:2,S"]
+    assert outbox.rosters() == {"file:///b.csv": 1}
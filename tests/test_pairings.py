@@ -0,0 +1,34 @@
+# Deps for testing
+from os import utime
+from time import time
+
+# Deps to test
+from synapse.pairings import PairingCache
+
+
+def test_pairing_cache(tmp_path):
+    cache = PairingCache(str(tmp_path / "pairings"), 3600)
+    assert cache.get("key") is None
+
+    cache.set("key", [(5, [["a", "b"], ["c", "d", "e"]])])
+    assert cache.get("key") == [(5, [["a", "b"], ["c", "d", "e"]])]
+    assert cache.get("other") is None
+
+    # Alternatives
+    alternatives = [(1, [["a", "b"]]), (2, [["a", "c"]])]
+    cache.set("alternatives", alternatives)
+    assert cache.get("alternatives") == alternatives
+
+    # Expired pairings are not used, and are removed when another is saved
+    old = time() - 7200
+    utime(cache.filename("key"), (old, old))
+    assert cache.get("key") is None
+    cache.set("other", [(0, [])])
+    assert not (tmp_path / "pairings" / "key.json").exists()
+    assert cache.get("other") == [(0, [])]
+
+    # Declined pairings are forgotten, alone or as an alternative
+    cache.discard([["a", "c"]])
+    assert cache.get("alternatives") is None
+    cache.discard([["x", "y"]])
+    assert cache.get("other") == [(0, [])]
@@ -0,0 +1,170 @@
+# Deps for testing
+import pytest
+
+# Deps to test
+from synapse.sheets import (
+    SheetsScheduler,
+    is_refused_sheets_error,
+    is_transient_sheets_error,
+    open_spreadsheet,
+    retry_after,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"Error {status_code}")
+        self.response = FakeResponse(status_code, headers)
+
+
+def flaky(errors, result="ok"):
+    calls = []
+
+    def request(*args):
+        calls.append(args)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return request, calls
+
+
+def test_sheets_scheduler_quota():
+    clock = FakeClock()
+    scheduler = SheetsScheduler(60, burst=2, clock=clock, sleeper=clock.sleep)
+    request, calls = flaky([])
+
+    # Requests over the quota wait their turn
+    for x in range(4):
+        assert scheduler.call(request, x) == "ok"
+    assert len(calls) == 4
+    assert clock.now == pytest.approx(2)
+
+
+def test_sheets_scheduler_retries():
+    clock = FakeClock()
+    scheduler = SheetsScheduler(
+        None, retries=3, backoff=2, clock=clock, sleeper=clock.sleep
+    )
+
+    # Refused and failing requests are retried with backoff, or as asked
+    request, calls = flaky(
+        [FakeAPIError(429), FakeAPIError(503), FakeAPIError(429, {"Retry-After": "7"})]
+    )
+    assert scheduler.call(request) == "ok"
+    assert len(calls) == 4
+    assert 2 <= clock.sleeps[0] <= 3
+    assert 4 <= clock.sleeps[1] <= 6
+    assert clock.sleeps[2] == 7
+
+    # Until retries run out
+    request, calls = flaky([FakeAPIError(500)] * 4)
+    with pytest.raises(FakeAPIError):
+        scheduler.call(request)
+    assert len(calls) == 4
+
+    # Other errors are not retried
+    request, calls = flaky([FakeAPIError(403)])
+    with pytest.raises(FakeAPIError):
+        scheduler.call(request)
+    assert len(calls) == 1
+
+
+def test_sheets_scheduler_write():
+    clock = FakeClock()
+    scheduler = SheetsScheduler(None, retries=3, clock=clock, sleeper=clock.sleep)
+
+    # Refused writes are retried as they are
+    request, calls = flaky([FakeAPIError(429)])
+    assert scheduler.write(request) == "ok"
+    assert len(calls) == 2
+
+    # Others only if they were not made anyway
+    request, calls = flaky([FakeAPIError(503)])
+    with pytest.raises(FakeAPIError):
+        scheduler.write(request)
+    assert len(calls) == 1
+
+    request, calls = flaky([FakeAPIError(503), ConnectionResetError()])
+    assert scheduler.write(request, applied=lambda: False) == "ok"
+    assert len(calls) == 3
+
+    request, calls = flaky([FakeAPIError(503)])
+    assert scheduler.write(request, applied=lambda: True) is None
+    assert len(calls) == 1
+
+
+def test_sheets_scheduler_cache():
+    clock = FakeClock()
+    scheduler = SheetsScheduler(None, cache_seconds=30, clock=clock)
+    request, calls = flaky([])
+
+    # Repeated reads are served from the cache until they expire
+    assert scheduler.read(("id", "A:A"), request) == "ok"
+    assert scheduler.read(("id", "A:A"), request) == "ok"
+    assert len(calls) == 1
+    scheduler.read(("id", "A:B"), request)
+    assert len(calls) == 2
+    clock.now += 30
+    scheduler.read(("id", "A:A"), request)
+    assert len(calls) == 3
+
+    # Or the spreadsheet changes
+    scheduler.invalidate("id")
+    scheduler.read(("id", "A:A"), request)
+    assert len(calls) == 4
+
+
+def test_is_transient_sheets_error():
+    assert is_transient_sheets_error(FakeAPIError(429))
+    assert is_transient_sheets_error(FakeAPIError(502))
+    assert not is_transient_sheets_error(FakeAPIError(404))
+    assert is_transient_sheets_error(ConnectionResetError())
+    assert not is_transient_sheets_error(ValueError())
+    assert is_refused_sheets_error(FakeAPIError(429))
+    assert not is_refused_sheets_error(FakeAPIError(503))
+    assert retry_after(FakeAPIError(429, {"Retry-After": "3"})) == 3
+    assert retry_after(FakeAPIError(429)) is None
+
+
+def test_open_spreadsheet():
+    class FakeClient:
+        def __init__(self):
+            self.requests = []
+
+        def request(self, method, url, params=None):
+            self.requests.append((method, url, params))
+            metadata = {
+                "properties": {"title": "Roster"},
+                "sheets": [{"properties": {"sheetId": 0, "title": "Emails"}}],
+            }
+            return type("Response", (), {"json": lambda self: metadata})()
+
+    # The spreadsheet and its sheets come from one request
+    client = FakeClient()
+    spreadsheet, metadata = open_spreadsheet(client, "abc123", "properties,sheets")
+    assert len(client.requests) == 1
+    assert client.requests[0][1].endswith("/spreadsheets/abc123")
+    assert client.requests[0][2]["fields"] == "properties,sheets"
+    assert spreadsheet.id == "abc123"
+    assert spreadsheet.title == "Roster"
+    assert metadata["sheets"][0]["properties"]["title"] == "Emails"
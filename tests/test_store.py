@@ -0,0 +1,70 @@
+# Deps for testing
+import pytest
+
+# Deps to test
+from synapse.store import HistoryStore, digest_row
+
+
+def test_history_store(tmp_path):
+    store = HistoryStore(str(tmp_path / "cache" / "history.sqlite3"))
+    assert len(store) == 0
+    assert store.last_row() is None
+    assert store.rows() == []
+
+    store.append([["2022-01-01", "[]"], ["2022-01-08", "[[1, 2]]"]])
+    store.append([["2022-01-15", "[[3, 4]]"]])
+    assert len(store) == 3
+    assert store.last_row() == ["2022-01-15", "[[3, 4]]"]
+    assert store.rows()[0] == ("2022-01-01", "[]")
+    store.close()
+
+    # Persists
+    store = HistoryStore(str(tmp_path / "cache" / "history.sqlite3"))
+    assert len(store) == 3
+
+    # Rows are also packed, except the ones that are not JSON
+    store.append([["2022-01-16", "not json"]])
+    store.append([["2022-01-17", '[["ex1@a.bc", "ex2@a.bc"]]']])
+    store.append([["2022-01-18", '[["ex2@a.bc", "ex3@a.bc"]]']])
+    assert store.emails()[-3:] == ["ex1@a.bc", "ex2@a.bc", "ex3@a.bc"]
+    packed = store.packed_rows()
+    assert [date for date, members, ends in packed][-2:] == ["2022-01-17", "2022-01-18"]
+    assert "2022-01-16" not in [date for date, members, ends in packed]
+    store.replace(store.rows()[:3])
+    assert "ex1@a.bc" not in store.emails()
+
+    # Compacted rows still count as synced
+    assert store.numbered_rows()[0] == (0, "2022-01-01", "[]")
+    store.compact([0, 2], {"rounds": 2})
+    assert store.rows() == [("2022-01-08", "[[1, 2]]")]
+    assert store.snapshot() == {"rounds": 2}
+    assert len(store) == 3
+    assert store.last_row() == ["2022-01-15", "[[3, 4]]"]
+    store.append([["2022-01-22", "[]"]])
+    assert len(store) == 4
+    assert store.last_row() == ["2022-01-22", "[]"]
+    assert store.row_digests([0, 3, 4]) == {
+        0: digest_row("2022-01-01", "[]"),
+        3: digest_row("2022-01-22", "[]"),
+    }
+
+    # Replacing is all or nothing
+    with pytest.raises(Exception):
+        store.replace([["2022-02-01", "[]"], None])
+    assert len(store) == 4
+    assert store.snapshot() == {"rounds": 2}
+
+    store.replace([["2022-02-01", "[]"]])
+    store.close()
+
+    # A copy from another version is dropped
+    store = HistoryStore(str(tmp_path / "cache" / "history.sqlite3"))
+    store.connection.execute("PRAGMA user_version = 1")
+    store.close()
+    store = HistoryStore(str(tmp_path / "cache" / "history.sqlite3"))
+    assert len(store) == 0
+    store.replace([["2022-02-01", "[]"]])
+    assert store.rows() == [("2022-02-01", "[]")]
+    assert store.snapshot() is None
+    assert len(store) == 1
+    store.close()
@@ -0,0 +1,135 @@
+# Deps for testing
+from time import perf_counter
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+# Deps to test
+from synapse import vectorized
+from synapse.cli import calculate_history_score
+from synapse.history import HistoryIndex
+from synapse.matching import pair_emails
+from synapse.vectorized import (
+    PairScores,
+    calculate_history_scores,
+    match_random_numpy,
+    match_random_numpy_alternatives,
+)
+
+
+test_emails = [
+    "ex1@a.bc",
+    "ex2@a.bc",
+    "ex3@a.bc",
+    "ex4@a.bc",
+    "ex5@a.bc",
+    "ex6@a.bc",
+    "ex7@a.bc",
+]
+test_history = [
+    {
+        "score": 100,
+        "pairs": [
+            ["ex1@a.bc", "ex2@a.bc"],
+            ["ex3@a.bc", "ex4@a.bc"],
+            ["ex5@a.bc", "ex6@a.bc", "ex7@a.bc"],
+        ],
+    },
+    {
+        "score": 50,
+        "pairs": [
+            ["ex1@a.bc", "ex3@a.bc"],
+            ["ex2@a.bc", "ex5@a.bc"],
+            ["ex4@a.bc", "ex6@a.bc", "ex7@a.bc"],
+        ],
+    },
+]
+
+
+@pytest.mark.parametrize("dense_limit", [4096, 0])
+def test_pair_scores(monkeypatch, dense_limit):
+    monkeypatch.setattr(vectorized, "NUMPY_DENSE_LIMIT", dense_limit)
+    pair_scores = PairScores(test_emails, HistoryIndex(test_history))
+
+    a = np.array([0, 1, 5, 0])
+    b = np.array([1, 0, 6, 6])
+    assert list(pair_scores.lookup(a, b)) == [100, 100, 150, 0]
+
+
+@pytest.mark.parametrize("dense_limit", [4096, 0])
+def test_calculate_history_scores(monkeypatch, dense_limit):
+    monkeypatch.setattr(vectorized, "NUMPY_DENSE_LIMIT", dense_limit)
+    test_pairings = [
+        [["ex1@a.bc", "ex2@a.bc"], ["ex3@a.bc", "ex4@a.bc"]],
+        [["ex1@a.bc", "ex4@a.bc"], ["ex5@a.bc", "ex6@a.bc", "ex7@a.bc"]],
+        [["ex2@a.bc", "ex3@a.bc"], ["ex4@a.bc", "ex6@a.bc", "ex5@a.bc"]],
+        [["ex1@a.bc", "ex2@a.bc", "ex3@a.bc", "ex4@a.bc"]],
+    ]
+
+    assert calculate_history_scores(test_pairings, test_history) == [
+        calculate_history_score(pairs, test_history) for pairs in test_pairings
+    ]
+    assert calculate_history_scores([], test_history) == []
+    assert (
+        calculate_history_score(test_pairings[1], test_history, backend="numpy") == 150
+    )
+
+
+def test_match_random_numpy():
+    # Not enough
+    assert match_random_numpy([]) == (0, [])
+
+    index = HistoryIndex(test_history)
+    test_score, test_pairs = match_random_numpy(test_emails, index, sample_count=500)
+    assert test_score == index.score(test_pairs)
+    assert sorted(len(pair) for pair in test_pairs) == [2, 2, 3]
+    assert sorted(email for pair in test_pairs for email in pair) == test_emails
+
+    # Same seed, same pairing
+    assert match_random_numpy(
+        test_emails, index, sample_count=5, seed=1
+    ) == match_random_numpy(test_emails, index, sample_count=5, seed=1)
+
+    # Through pair_emails
+    test_score, test_pairs = pair_emails(test_emails, history=index, backend="numpy")
+    assert test_score == index.score(test_pairs)
+
+
+def test_match_random_numpy_groups():
+    index = HistoryIndex(test_history)
+    test_score, test_groups = match_random_numpy(
+        test_emails, index, sample_count=50, seed=1, group_size=3
+    )
+    assert sorted(len(group) for group in test_groups) == [3, 4]
+    assert sorted(email for group in test_groups for email in group) == test_emails
+    assert test_score == index.score(test_groups, pairwise=True)
+
+
+def test_match_random_numpy_time_budget():
+    emails = [f"ex{i}@a.bc" for i in range(40)]
+    index = HistoryIndex([{"score": 10, "pairs": [emails]}])
+
+    start = perf_counter()
+    test_score, test_pairs = match_random_numpy(
+        emails, index, sample_count=None, seed=1, time_budget=0.2
+    )
+    assert 0.2 <= perf_counter() - start < 2
+    assert test_score == calculate_history_score(test_pairs, index)
+
+
+def test_match_random_numpy_alternatives():
+    emails = [f"ex{i}@a.bc" for i in range(10)]
+    index = HistoryIndex([{"score": 10, "pairs": [emails[0:5], emails[5:10]]}])
+
+    pairings = match_random_numpy_alternatives(
+        emails, index, sample_count=3000, seed=1, alternatives=4
+    )
+    assert len(pairings) == 4
+    assert [score for score, pairs in pairings] == sorted(
+        score for score, pairs in pairings
+    )
+    assert all(
+        score == calculate_history_score(pairs, index) for score, pairs in pairings
+    )
+    assert pairings[0] == match_random_numpy(emails, index, sample_count=3000, seed=1)